@@ -20,6 +20,6 @@ echo "run pytorch ..."
 # WARNING: the following parameters will be set based on the data set
 # --arch-embedding-size=... (sparse feature sizes)
 # --arch-mlp-bot=... (the input to the first layer of bottom mlp)
-$dlrm_pt_bin --arch-sparse-feature-size=64 --arch-mlp-bot="13-512-256-64" --arch-mlp-top="512-512-256-1" --max-ind-range=100000000 --data-generation=dataset --data-set=terabyte --raw-data-file=./input/terabyte/day --processed-data-file=./input/terabyte/terabyte_processed.npz --loss-function=bce --round-targets=True --learning-rate=0.1 --mini-batch-size=2048 --print-freq=1024 --print-time --test-mini-batch-size=16384 --test-num-workers=16 --test-freq=10240 --memory-map --data-sub-sample-rate=0.875 > run_terabyte_pt.log
+$dlrm_pt_bin --preprocess-only --arch-sparse-feature-size=64 --arch-mlp-bot="13-512-256-64" --arch-mlp-top="512-512-256-1" --max-ind-range=100000000 --data-generation=dataset --data-set=terabyte --raw-data-file=./input/terabyte/day --processed-data-file=./input/terabyte/terabyte_processed.npz --loss-function=bce --round-targets=True --learning-rate=0.1 --mini-batch-size=2048 --print-freq=1024 --print-time --test-mini-batch-size=16384 --test-num-workers=16 --test-freq=10240 --memory-map --data-sub-sample-rate=0.875 > run_terabyte_pt.log
 
 echo "done"
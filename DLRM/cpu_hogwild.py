@@ -0,0 +1,228 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# Description: Hogwild-style multithreaded CPU training
+#
+# Several worker threads, each pinned to its own set of cores, train on
+# disjoint shards of the batches (batch j goes to worker j % num_workers).
+# Every worker holds a replica of the model whose embedding tables share
+# their storage with the tables of the model:
+#   - the embedding updates (sparse and very unlikely to collide) are applied
+#     straight to the shared tables, without any lock,
+#   - the MLPs are private to the worker; with dense="lock" every update is
+#     applied to the shared MLPs under a lock and the replica is refreshed,
+#     with dense="average" the worker takes local SGD steps and every
+#     sync_freq steps averages its replica into the shared MLPs (under the
+#     same lock).
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import copy
+import queue
+import threading
+
+import torch
+import torch.nn as nn
+
+from cpu_partition import WorkerPool
+
+
+def _shared_replica(module):
+    # deep copy of module whose parameters share the storage of the original
+    memo = {}
+    for p in module.parameters():
+        memo[id(p)] = nn.Parameter(p.data, requires_grad=p.requires_grad)
+    return copy.deepcopy(module, memo)
+
+
+class _Replica:
+    def __init__(self, dlrm):
+        self.emb_l = _shared_replica(dlrm.emb_l)
+        self.bot_l = copy.deepcopy(dlrm.bot_l)
+        self.top_l = copy.deepcopy(dlrm.top_l)
+        self.steps = 0
+
+    def dense_parameters(self):
+        return list(self.bot_l.parameters()) + list(self.top_l.parameters())
+
+
+class HogwildTrainer:
+    """Lock-free multithreaded training on shards of the batches.
+
+    dlrm is expected to provide emb_l, bot_l, top_l, apply_emb, apply_mlp,
+    interact_features and loss_threshold (as DLRM_Net does). The embedding
+    tables live on the CPU, the MLPs may live on dense_device.
+    """
+
+    def __init__(
+            self,
+            dlrm,
+            num_workers,
+            cores=None,
+            dense="lock",
+            sync_freq=1,
+            dense_device=torch.device("cpu")
+    ):
+        if dense not in ["lock", "average"]:
+            raise ValueError("dense must be lock or average, got " + dense)
+        if cores is None or len(cores) == 0:
+            cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") \
+                else list(range(os.cpu_count()))
+        self.dlrm = dlrm
+        self.num_workers = num_workers
+        self.dense = dense
+        self.sync_freq = max(1, sync_freq)
+        self.dense_device = dense_device
+        self.lock = threading.Lock()
+        self.last_output = None
+
+        # split the cores evenly (workers share cores if there are too few)
+        self.pools = []
+        self.replicas = []
+        n = len(cores)
+        for w in range(num_workers):
+            if n >= num_workers:
+                w_cores = cores[(n * w) // num_workers:(n * (w + 1)) // num_workers]
+            else:
+                w_cores = [cores[w % n]]
+            self.pools.append(WorkerPool("hogwild" + str(w), w_cores))
+            self.replicas.append(_Replica(dlrm))
+
+        print(
+            "Hogwild: {} workers on cores {}, dense updates: {}".format(
+                num_workers, cores, dense
+            )
+        )
+
+    def _step(self, rep, X, lS_o, lS_i, T, loss_fn_wrap, lr):
+        dlrm = self.dlrm
+        x = dlrm.apply_mlp(X.to(self.dense_device), rep.bot_l)
+        ly = dlrm.apply_emb(lS_o, lS_i, rep.emb_l)
+        ly = [y.to(self.dense_device) for y in ly]
+        z = dlrm.interact_features(x, ly)
+        p = dlrm.apply_mlp(z, rep.top_l)
+        if 0.0 < dlrm.loss_threshold and dlrm.loss_threshold < 1.0:
+            p = torch.clamp(p, min=dlrm.loss_threshold, max=(1.0 - dlrm.loss_threshold))
+        E = loss_fn_wrap(p, T)
+
+        E.backward()
+
+        with torch.no_grad():
+            # lock-free update of the shared embedding tables
+            for w in rep.emb_l.parameters():
+                if w.grad is not None:
+                    w.add_(w.grad, alpha=-lr)
+                    w.grad = None
+
+            rep.steps += 1
+            local = rep.dense_parameters()
+            shared = list(dlrm.bot_l.parameters()) + list(dlrm.top_l.parameters())
+            if self.dense == "lock":
+                with self.lock:
+                    for (s, l) in zip(shared, local):
+                        s.add_(l.grad, alpha=-lr)
+                        l.copy_(s)
+            else:
+                for l in local:
+                    l.add_(l.grad, alpha=-lr)
+                if rep.steps % self.sync_freq == 0:
+                    self._average(rep)
+            for l in local:
+                l.grad = None
+
+        return p.detach(), E.detach()
+
+    def _average(self, rep):
+        # move the shared mlps 1/num_workers of the way towards the replica
+        # and restart the replica from the result
+        with torch.no_grad(), self.lock:
+            shared = list(self.dlrm.bot_l.parameters()) + list(self.dlrm.top_l.parameters())
+            for (s, l) in zip(shared, rep.dense_parameters()):
+                s.add_(l - s, alpha=1.0 / self.num_workers)
+                l.copy_(s)
+
+    def _worker(self, w, in_q, out_q, loss_fn_wrap, optimizer):
+        rep = self.replicas[w]
+        # the replica starts from the current shared mlps
+        with torch.no_grad(), self.lock:
+            shared = list(self.dlrm.bot_l.parameters()) + list(self.dlrm.top_l.parameters())
+            for (s, l) in zip(shared, rep.dense_parameters()):
+                l.copy_(s)
+        try:
+            while True:
+                batch = in_q.get()
+                if batch is None:
+                    break
+                (X, lS_o, lS_i, T) = batch
+                lr = optimizer.param_groups[0]["lr"]
+                Z, E = self._step(rep, X, lS_o, lS_i, T, loss_fn_wrap, lr)
+                out_q.put((batch, Z, E))
+            if self.dense == "average" and rep.steps % self.sync_freq != 0:
+                self._average(rep)
+        except BaseException as e:
+            out_q.put(e)
+            # keep the feeder from blocking until it sees the error
+            while in_q.get() is not None:
+                pass
+        finally:
+            out_q.put(None)
+
+    def train(self, loader, nbatches, loss_fn_wrap, optimizer):
+        # generator over the batches of loader (at most nbatches if > 0), in
+        # completion order; the output and loss of the batch just yielded
+        # are in last_output
+        in_qs = [queue.Queue(maxsize=2) for _ in range(self.num_workers)]
+        out_q = queue.Queue()
+        futures = [
+            self.pools[w].submit(self._worker, w, in_qs[w], out_q, loss_fn_wrap, optimizer)
+            for w in range(self.num_workers)
+        ]
+
+        def drain(block):
+            # results available so far (all of them once the workers are done)
+            while True:
+                try:
+                    r = out_q.get(block=block)
+                except queue.Empty:
+                    return
+                if r is None:
+                    drain.done += 1
+                    if drain.done == self.num_workers:
+                        return
+                    continue
+                if isinstance(r, BaseException):
+                    raise r
+                yield r
+        drain.done = 0
+
+        try:
+            for j, batch in enumerate(loader):
+                if nbatches > 0 and j >= nbatches:
+                    break
+                in_qs[j % self.num_workers].put(batch)
+                for (b, Z, E) in drain(False):
+                    self.last_output = (Z, E)
+                    yield b
+            for q in in_qs:
+                q.put(None)
+            for (b, Z, E) in drain(True):
+                self.last_output = (Z, E)
+                yield b
+        finally:
+            # also reached when the caller stops early
+            for q in in_qs:
+                try:
+                    while True:
+                        q.get_nowait()
+                except queue.Empty:
+                    pass
+                q.put(None)
+            for f in futures:
+                f.result()
+
+    def shutdown(self):
+        for pool in self.pools:
+            pool.shutdown()
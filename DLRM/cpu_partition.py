@@ -0,0 +1,277 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# Description: core partitioning between embedding and MLP work on CPU
+#
+# torch.set_num_threads is process-wide, so by default the memory-bound
+# embedding gathers and the compute-bound MLP GEMMs share (and fight over)
+# a single intra-op pool. Here a mini-batch is split into micro-batches
+# that are pipelined across two worker pools:
+#   - the embedding pool runs the embedding lookups, their backward pass
+#     and the (sparse) embedding update,
+#   - the MLP pool runs the bottom mlp, the interaction, the top mlp,
+#     their backward pass and the dense optimizer step.
+# Each pool is a single Python thread pinned to its own set of cores with
+# its own number of intra-op (OpenMP) threads, so that the embedding lookup
+# of micro-batch i+1 overlaps with the top mlp of micro-batch i.
+#
+# The embedding outputs are detached at the pool boundary: the MLP pool
+# back-propagates into the detached copies and hands their gradients back to
+# the embedding pool. Gradients are accumulated over the micro-batches and
+# a single update is applied per mini-batch, so the result matches the
+# sequential mini-batch SGD update.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+def parse_core_list(value):
+    # parse a Linux cpulist, e.g. "0-13,28-41" -> [0, ..., 13, 28, ..., 41]
+    cores = []
+    for part in value.split(","):
+        part = part.strip()
+        if part == "":
+            continue
+        if "-" in part:
+            lo, hi = part.split("-")
+            cores += list(range(int(lo), int(hi) + 1))
+        else:
+            cores.append(int(part))
+    return cores
+
+
+def _read_core_times(cores):
+    # (busy, total) jiffies summed over the given cores, from /proc/stat
+    busy = 0
+    total = 0
+    try:
+        with open("/proc/stat") as f:
+            for line in f:
+                if not line.startswith("cpu") or line.startswith("cpu "):
+                    continue
+                fields = line.split()
+                if int(fields[0][3:]) not in cores:
+                    continue
+                t = [int(x) for x in fields[1:]]
+                idle = t[3] + (t[4] if len(t) > 4 else 0)  # idle + iowait
+                busy += sum(t) - idle
+                total += sum(t)
+    except (IOError, OSError, ValueError):
+        return None
+    return busy, total
+
+
+class WorkerPool:
+    """Single-threaded executor pinned to a set of cores."""
+
+    def __init__(self, name, cores, num_threads=-1):
+        self.name = name
+        self.cores = cores
+        self.num_threads = num_threads if num_threads > 0 else len(cores)
+        self.busy_time = 0.0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=name, initializer=self._init_thread
+        )
+        self._executor.submit(lambda: None).result()  # force initialization
+        self.reset_stats()
+
+    def _init_thread(self):
+        # both calls apply to the calling thread only: the affinity mask is
+        # inherited by the OpenMP threads it spawns and the OpenMP thread count
+        # is a per-thread setting
+        if len(self.cores) > 0 and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, self.cores)
+        torch.set_num_threads(self.num_threads)
+
+    def _run(self, fn, *args):
+        t0 = time.time()
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.busy_time += time.time() - t0
+
+    def submit(self, fn, *args):
+        return self._executor.submit(self._run, fn, *args)
+
+    def reset_stats(self):
+        with self._lock:
+            self.busy_time = 0.0
+        self._core_times = _read_core_times(self.cores)
+
+    def stats(self, wall_time):
+        # busy: fraction of the wall time with work running on the pool
+        # util: utilization of the pinned cores (as seen by the OS)
+        busy = self.busy_time / wall_time if wall_time > 0 else 0.0
+        util = -1.0
+        core_times = _read_core_times(self.cores)
+        if core_times is not None and self._core_times is not None:
+            d_busy = core_times[0] - self._core_times[0]
+            d_total = core_times[1] - self._core_times[1]
+            util = d_busy / d_total if d_total > 0 else 0.0
+        return busy, util
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+def _split_sparse(lS_o, lS_i, b0, b1, batch_size):
+    # slice the bags [b0, b1) out of offsets/indices of every table
+    lS_o_mb = []
+    lS_i_mb = []
+    for k in range(len(lS_o)):
+        S_o = lS_o[k]
+        S_i = lS_i[k]
+        start = int(S_o[b0])
+        end = int(S_o[b1]) if b1 < batch_size else S_i.shape[0]
+        lS_o_mb.append(S_o[b0:b1] - start)
+        lS_i_mb.append(S_i[start:end])
+    return lS_o_mb, lS_i_mb
+
+
+class PartitionedTrainer:
+    """Pipelined training step with embedding and MLP work on separate cores.
+
+    dlrm is expected to provide emb_l, bot_l, top_l, apply_emb, apply_mlp,
+    interact_features and loss_threshold (as DLRM_Net does). The embedding
+    tables live on the CPU, the MLPs may live on dense_device.
+    """
+
+    def __init__(
+            self,
+            emb_cores,
+            mlp_cores,
+            emb_threads=-1,
+            mlp_threads=-1,
+            num_micro_batches=2,
+            dense_device=torch.device("cpu")
+    ):
+        self.emb_pool = WorkerPool("emb", emb_cores, emb_threads)
+        self.mlp_pool = WorkerPool("mlp", mlp_cores, mlp_threads)
+        self.num_micro_batches = max(1, num_micro_batches)
+        self.dense_device = dense_device
+        self.stats_begin = time.time()
+
+        print(
+            "CPU partition: emb pool cores {} ({} threads), "
+            "mlp pool cores {} ({} threads), {} micro-batches".format(
+                emb_cores, self.emb_pool.num_threads,
+                mlp_cores, self.mlp_pool.num_threads,
+                self.num_micro_batches
+            )
+        )
+
+    def _emb_forward(self, dlrm, lS_o, lS_i):
+        return dlrm.apply_emb(lS_o, lS_i, dlrm.emb_l)
+
+    def _mlp_forward_backward(self, dlrm, X, f_ly, T, scale, loss_fn_wrap, train):
+        x = dlrm.apply_mlp(X.to(self.dense_device), dlrm.bot_l)
+        ly = f_ly.result()
+        # cut the graph at the pool boundary
+        ly_d = [y.detach().to(self.dense_device).requires_grad_(train) for y in ly]
+        z = dlrm.interact_features(x, ly_d)
+        p = dlrm.apply_mlp(z, dlrm.top_l)
+        if 0.0 < dlrm.loss_threshold and dlrm.loss_threshold < 1.0:
+            p = torch.clamp(p, min=dlrm.loss_threshold, max=(1.0 - dlrm.loss_threshold))
+        E = loss_fn_wrap(p, T)
+        if train:
+            (E * scale).backward()
+            return p.detach(), E.detach(), [y.grad for y in ly_d]
+        return p.detach(), E.detach(), None
+
+    def _emb_backward(self, f_ly, f_mlp):
+        ly = f_ly.result()
+        _, _, g_ly = f_mlp.result()
+        g_ly = [g.to(y.device) for (y, g) in zip(ly, g_ly)]
+        torch.autograd.backward(ly, g_ly)
+
+    def _emb_update(self, dlrm, lr, detached):
+        # plain SGD on the embedding tables (sparse or dense gradients);
+        # the gradients are detached from the parameters first, so that the
+        # concurrent dense optimizer step on the other pool skips them
+        grads = []
+        for p in dlrm.emb_l.parameters():
+            if p.grad is not None:
+                grads.append((p, p.grad))
+                p.grad = None
+        detached.set()
+        with torch.no_grad():
+            for (p, g) in grads:
+                p.add_(g, alpha=-lr)
+
+    def _dense_update(self, optimizer, detached):
+        detached.wait()
+        optimizer.step()
+
+    def train_step(self, dlrm, X, lS_o, lS_i, T, loss_fn_wrap, optimizer=None):
+        # returns the (detached) output and mean loss of the whole mini-batch;
+        # when optimizer is given the gradients are computed and applied
+        train = optimizer is not None
+        batch_size = X.shape[0]
+        nmb = min(self.num_micro_batches, batch_size)
+        bounds = [(batch_size * m) // nmb for m in range(nmb + 1)]
+
+        if train:
+            optimizer.zero_grad()
+
+        # embedding pool: all lookups first, then the backward passes,
+        # so that lookup i+1 overlaps with the mlp work on micro-batch i
+        f_ly = []
+        for m in range(nmb):
+            lS_o_mb, lS_i_mb = _split_sparse(lS_o, lS_i, bounds[m], bounds[m + 1], batch_size)
+            f_ly.append(self.emb_pool.submit(self._emb_forward, dlrm, lS_o_mb, lS_i_mb))
+        f_mlp = []
+        for m in range(nmb):
+            b0, b1 = bounds[m], bounds[m + 1]
+            f_mlp.append(self.mlp_pool.submit(
+                self._mlp_forward_backward,
+                dlrm, X[b0:b1], f_ly[m], T[b0:b1], float(b1 - b0) / batch_size,
+                loss_fn_wrap, train
+            ))
+        if train:
+            f_bwd = [self.emb_pool.submit(self._emb_backward, f_ly[m], f_mlp[m])
+                     for m in range(nmb)]
+            for f in f_bwd:
+                f.result()
+
+        outputs = [f.result() for f in f_mlp]
+        Z = torch.cat([o[0] for o in outputs], dim=0)
+        E = sum(o[1] * float(bounds[m + 1] - bounds[m]) / batch_size
+                for (m, o) in enumerate(outputs))
+
+        if train:
+            lr = optimizer.param_groups[0]["lr"]
+            detached = threading.Event()
+            f_emb_step = self.emb_pool.submit(self._emb_update, dlrm, lr, detached)
+            f_dense_step = self.mlp_pool.submit(self._dense_update, optimizer, detached)
+            f_emb_step.result()
+            f_dense_step.result()
+
+        return Z, E
+
+    def report(self):
+        # print per-pool busy time and core utilization since the last report
+        wall = time.time() - self.stats_begin
+        for pool in [self.emb_pool, self.mlp_pool]:
+            busy, util = pool.stats(wall)
+            print(
+                "Pool_{} busy {:.1f} % core_util {} ".format(
+                    pool.name, 100 * busy,
+                    "n/a" if util < 0 else "{:.1f} %".format(100 * util)
+                )
+            )
+            pool.reset_stats()
+        self.stats_begin = time.time()
+
+    def shutdown(self):
+        self.emb_pool.shutdown()
+        self.mlp_pool.shutdown()
@@ -7,18 +7,31 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import os
+import mmap
+import queue
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import torch
+import torch.multiprocessing as mp
 import time
 import math
 from tqdm import tqdm
 import argparse
 
+import data_utils
+
 
 class DataLoader:
     """
     DataLoader dedicated for the Criteo Terabyte Click Logs dataset
+
+    With num_workers > 0 the batches are produced by worker processes, each
+    one owning a day (or a row range of a day if there are fewer days than
+    workers), into a ring of prefetch_batches preallocated shared memory
+    batches per worker. A yielded batch stays valid until the next one is
+    requested (copy it to keep it longer).
     """
 
     def __init__(
@@ -29,13 +42,17 @@ class DataLoader:
             batch_size,
             max_ind_range=-1,
             split="train",
-            drop_last_batch=False
+            drop_last_batch=False,
+            num_workers=0,
+            prefetch_batches=4
     ):
         self.data_filename = data_filename
         self.data_directory = data_directory
         self.days = days
         self.batch_size = batch_size
         self.max_ind_range = max_ind_range
+        self.num_workers = num_workers
+        self.prefetch_batches = max(1, prefetch_batches)
 
         total_file = os.path.join(
             data_directory,
@@ -44,13 +61,18 @@ class DataLoader:
         with np.load(total_file) as data:
             total_per_file = data["total_per_file"][np.array(days)]
 
-        self.length = sum(total_per_file)
-        if split == "test" or split == "val":
-            self.length = int(np.ceil(self.length / 2.))
+        self.total_per_file = total_per_file
+        # test and val are the halves of each day
+        self.length = 0
+        for samples_in_file in total_per_file:
+            begin, end = _day_range(int(samples_in_file), split)
+            self.length += end - begin
         self.split = split
         self.drop_last_batch = drop_last_batch
 
     def __iter__(self):
+        if self.num_workers > 0:
+            return _PrefetchIterator(self)
         return iter(
             _batch_generator(
                 self.data_filename, self.data_directory, self.days,
@@ -71,14 +93,20 @@ def _transform_features(
     if max_ind_range > 0:
         x_cat_batch = x_cat_batch % max_ind_range
 
+    # floating point dense features are already log-transformed
+    # (see data_utils.precomputeFeatures)
     if flag_input_torch_tensor:
-        x_int_batch = torch.log(x_int_batch.clone().detach().type(torch.float) + 1)
+        precomputed = x_int_batch.is_floating_point()
+        x_int_batch = x_int_batch.clone().detach().type(torch.float)
         x_cat_batch = x_cat_batch.clone().detach().type(torch.long)
         y_batch = y_batch.clone().detach().type(torch.float32).view(-1, 1)
     else:
-        x_int_batch = torch.log(torch.tensor(x_int_batch, dtype=torch.float) + 1)
+        precomputed = x_int_batch.dtype.kind == "f"
+        x_int_batch = torch.tensor(x_int_batch, dtype=torch.float)
         x_cat_batch = torch.tensor(x_cat_batch, dtype=torch.long)
         y_batch = torch.tensor(y_batch, dtype=torch.float32).view(-1, 1)
+    if not precomputed:
+        x_int_batch = torch.log(x_int_batch + 1)
 
     batch_size = x_cat_batch.shape[0]
     feature_count = x_cat_batch.shape[1]
@@ -98,7 +126,7 @@ def _batch_generator(
         )
 
         # print('Loading file: ', filepath)
-        with np.load(filepath) as data:
+        with data_utils.loadArrays(filepath, mmap_mode="r") as data:
             x_int = data["X_int"]
             x_cat = data["X_cat"]
             y = data["y"]
@@ -172,6 +200,209 @@ def _batch_generator(
         )
 
 
+def _day_range(samples_in_file, split):
+    # rows of a day used by the split (test and val are the halves of the day)
+    if split == "test" or split == "val":
+        length = int(np.ceil(samples_in_file / 2.))
+        if split == "test":
+            return 0, length
+        elif split == "val":
+            return samples_in_file - length, samples_in_file
+    return 0, samples_in_file
+
+
+def _work_units(loader):
+    # Splits the rows of the days into units of work (day, begin, end, offset),
+    # offset being the position of the first row in the stream of batches.
+    # There is a unit per day, the days are split into row ranges if there
+    # are fewer days than workers.
+    units = []
+    pieces = int(np.ceil(loader.num_workers / float(len(loader.days))))
+    offset = 0
+    for day, samples_in_file in zip(loader.days, loader.total_per_file):
+        begin, end = _day_range(int(samples_in_file), loader.split)
+        bounds = np.linspace(begin, end, pieces + 1).astype(np.int64)
+        for i in range(pieces):
+            if bounds[i + 1] > bounds[i]:
+                units.append((day, int(bounds[i]), int(bounds[i + 1]), offset))
+                offset += int(bounds[i + 1] - bounds[i])
+    return units
+
+
+def _prefetch_worker(loader, units, slots, free_slots, out_queue):
+    # Produces the batches of its units: the rows of a unit forming complete
+    # batches are transformed into free slots of the ring, the rows before the
+    # first and after the last batch boundary (the batch is shared with the
+    # neighbouring units) are sent as they are, to be stitched by the reader.
+    try:
+        torch.set_num_threads(1)
+        batch_size = loader.batch_size
+        loaded_day = None
+        for day, begin, end, offset in units:
+            if day != loaded_day:
+                filepath = os.path.join(
+                    loader.data_directory,
+                    loader.data_filename + "_{}_reordered.npz".format(day)
+                )
+                with data_utils.loadArrays(filepath, mmap_mode="r") as data:
+                    x_int = data["X_int"]
+                    x_cat = data["X_cat"]
+                    y = data["y"]
+                loaded_day = day
+
+            batch_start_idx = min(end, begin + (-offset) % batch_size)
+            if batch_start_idx > begin:
+                current_slice = slice(begin, batch_start_idx)
+                out_queue.put(("rows", (
+                    np.array(x_int[current_slice]),
+                    np.array(x_cat[current_slice]),
+                    np.array(y[current_slice])
+                )))
+            while batch_start_idx + batch_size <= end:
+                current_slice = slice(batch_start_idx, batch_start_idx + batch_size)
+                k = free_slots.get()
+                x_int_slot, x_cat_slot, y_slot = slots[k]
+
+                x_int_slot.numpy()[:] = x_int[current_slice]
+                if x_int.dtype.kind != "f":
+                    x_int_slot.add_(1).log_()
+                x_cat_batch = x_cat_slot.numpy()
+                x_cat_batch[:] = x_cat[current_slice].T
+                if loader.max_ind_range > 0:
+                    np.remainder(x_cat_batch, loader.max_ind_range, out=x_cat_batch)
+                y_slot.numpy()[:, 0] = y[current_slice]
+
+                out_queue.put(("batch", k))
+                batch_start_idx += batch_size
+            if end > batch_start_idx:
+                current_slice = slice(batch_start_idx, end)
+                out_queue.put(("rows", (
+                    np.array(x_int[current_slice]),
+                    np.array(x_cat[current_slice]),
+                    np.array(y[current_slice])
+                )))
+            out_queue.put(("end", None))
+    except Exception:
+        out_queue.put(("error", traceback.format_exc()))
+
+
+class _PrefetchIterator:
+    """
+    Iterates over the batches of a DataLoader produced by worker processes
+    (unit u is produced by worker u % num_workers). The units are read in
+    order and the rows of consecutive units sharing a batch are stitched
+    here, which gives the same batches as _batch_generator.
+    """
+
+    def __init__(self, loader):
+        self.workers = []
+        self.loader = loader
+        self.batch_size = loader.batch_size
+
+        units = _work_units(loader)
+        num_workers = max(1, min(loader.num_workers, len(units)))
+        self.order = [u % num_workers for u in range(len(units))]
+
+        # offsets of a complete batch (the same for all of them)
+        self.lS_o = torch.arange(self.batch_size).reshape(1, -1).repeat(26, 1)
+
+        ctx = mp.get_context()
+        self.slots = []
+        self.free_slots = []
+        self.out_queues = []
+        for w in range(num_workers):
+            slots = [(
+                torch.empty((self.batch_size, 13), dtype=torch.float32).share_memory_(),
+                torch.empty((26, self.batch_size), dtype=torch.long).share_memory_(),
+                torch.empty((self.batch_size, 1), dtype=torch.float32).share_memory_()
+            ) for _ in range(loader.prefetch_batches)]
+            free_slots = ctx.Queue()
+            for k in range(len(slots)):
+                free_slots.put(k)
+            out_queue = ctx.Queue()
+            worker = ctx.Process(
+                target=_prefetch_worker,
+                args=(loader, units[w::num_workers], slots, free_slots, out_queue)
+            )
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+            self.slots.append(slots)
+            self.free_slots.append(free_slots)
+            self.out_queues.append(out_queue)
+
+        # slot of the last yielded batch, given back on the next request
+        self.in_use = None
+        self.generator = self._generate()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.in_use is not None:
+            w, k = self.in_use
+            self.free_slots[w].put(k)
+            self.in_use = None
+        try:
+            batch, self.in_use = next(self.generator)
+        except BaseException:
+            self.close()
+            raise
+        return batch
+
+    def _get(self, w):
+        # next message of worker w, fails if the worker failed or died
+        while True:
+            try:
+                kind, value = self.out_queues[w].get(timeout=5.0)
+            except queue.Empty:
+                if not self.workers[w].is_alive():
+                    raise RuntimeError("DataLoader worker %d exited unexpectedly" % w)
+                continue
+            if kind == "error":
+                raise RuntimeError("DataLoader worker %d failed:\n%s" % (w, value))
+            return kind, value
+
+    def _generate(self):
+        previous_rows = []
+        previous_count = 0
+        for w in self.order:
+            kind, value = self._get(w)
+            while kind != "end":
+                if kind == "batch":
+                    x_int_slot, x_cat_slot, y_slot = self.slots[w][value]
+                    yield (x_int_slot, self.lS_o, x_cat_slot, y_slot), (w, value)
+                else:
+                    previous_rows.append(value)
+                    previous_count += value[2].shape[0]
+                    if previous_count == self.batch_size:
+                        yield self._stitch(previous_rows), None
+                        previous_rows = []
+                        previous_count = 0
+                kind, value = self._get(w)
+
+        if previous_count > 0 and not self.loader.drop_last_batch:
+            yield self._stitch(previous_rows), None
+
+    def _stitch(self, rows):
+        return _transform_features(
+            np.concatenate([r[0] for r in rows], axis=0),
+            np.concatenate([r[1] for r in rows], axis=0),
+            np.concatenate([r[2] for r in rows], axis=0),
+            self.loader.max_ind_range
+        )
+
+    def close(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+        self.workers = []
+
+    def __del__(self):
+        self.close()
+
+
 def _test():
     generator = _batch_generator(
         data_filename='day',
@@ -193,10 +424,22 @@ def _test():
 
 
 class CriteoBinDataset(Dataset):
-    """Binary version of criteo dataset."""
+    """
+    Binary version of criteo dataset.
+
+    The file is memory-mapped (separately in each process, so the dataset can
+    be read by several DataLoader workers), batch idx is a view of rows
+    [idx * batch_size, (idx + 1) * batch_size). With shuffle_window > 0 the
+    dataset can also be indexed with (epoch, idx), as done by
+    CriteoBinShuffleSampler: the rows of each window of shuffle_window batches
+    are permuted (a permutation per window and epoch) and batch idx takes its
+    rows from the permutation of its window. With read_ahead the kernel is
+    asked to read the whole window (or the next batch) ahead.
+    """
 
     def __init__(self, data_file, counts_file,
-                 batch_size=1, max_ind_range=-1, bytes_per_feature=4):
+                 batch_size=1, max_ind_range=-1, bytes_per_feature=4,
+                 shuffle_window=0, seed=0, read_ahead=False):
         # dataset
         self.tar_fea = 1   # single target
         self.den_fea = 13  # 13 dense  features
@@ -209,19 +452,111 @@ class CriteoBinDataset(Dataset):
         self.bytes_per_entry = (bytes_per_feature * self.tot_fea * batch_size)
 
         self.num_entries = math.ceil(os.path.getsize(data_file) / self.bytes_per_entry)
+        self.num_samples = os.path.getsize(data_file) // (bytes_per_feature * self.tot_fea)
 
         print('data file:', data_file, 'number of batches:', self.num_entries)
-        self.file = open(data_file, 'rb')
+        self.data_file = data_file
+        self.shuffle_window = shuffle_window
+        self.seed = seed
+        self.read_ahead = read_ahead
+        self._reset()
 
         with np.load(counts_file) as data:
             self.counts = data["counts"]
 
+        # precomputed dense features are stored as float32 bits
+        self.dense_log = False
+        index_file = data_utils.binaryIndexFile(data_file)
+        if os.path.exists(index_file):
+            with np.load(index_file) as data:
+                self.dense_log = "dense_log" in data.files and bool(data["dense_log"])
+
         # hardcoded for now
         self.m_den = 13
 
+    def _reset(self):
+        # the memory map and the permutation buffer belong to a process
+        self.pid = os.getpid()
+        self.data = None
+        self.window = None
+        self.permutation = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["data"] = None
+        state["permutation"] = None
+        state["window"] = None
+        return state
+
+    def _rows(self):
+        if self.pid != os.getpid() or self.data is None:
+            self._reset()
+            # copy-on-write: writable (for torch.from_numpy) but never written back
+            self.data = np.memmap(self.data_file, dtype=np.int32, mode="c",
+                                  shape=(self.num_samples, self.tot_fea))
+        return self.data
+
+    def _advise(self, begin, end):
+        # asks the kernel to read rows [begin, end) ahead
+        m = getattr(self.data, "_mmap", None)
+        if m is None or not hasattr(mmap, "MADV_WILLNEED"):
+            return
+        row_bytes = self.data.itemsize * self.tot_fea
+        start = (begin * row_bytes // mmap.PAGESIZE) * mmap.PAGESIZE
+        # nothing past the last row (the mapping ends there)
+        if end <= begin or start >= len(m):
+            return
+        m.madvise(mmap.MADV_WILLNEED, start, min(end * row_bytes, len(m)) - start)
+
+    def _window_permutation(self, epoch, window):
+        # rows of a window in shuffled order (kept until the next window)
+        if self.window != (epoch, window):
+            begin = window * self.shuffle_window * self.batch_size
+            end = min(begin + self.shuffle_window * self.batch_size, self.num_samples)
+            rng = np.random.RandomState([self.seed, epoch, window])
+            self.permutation = begin + rng.permutation(end - begin)
+            self.window = (epoch, window)
+            if self.read_ahead:
+                self._advise(begin, end)
+        return self.permutation
+
     def __len__(self):
         return self.num_entries
 
+    def __getitem__(self, idx):
+        data = self._rows()
+        if isinstance(idx, tuple):
+            epoch, idx = idx
+        else:
+            epoch = None
+
+        if epoch is None or self.shuffle_window <= 0:
+            begin = idx * self.batch_size
+            end = min(begin + self.batch_size, self.num_samples)
+            rows = data[begin:end]
+            if self.read_ahead:
+                # the next batch
+                self._advise(end, min(end + self.batch_size, self.num_samples))
+        else:
+            window, k = divmod(idx, self.shuffle_window)
+            permutation = self._window_permutation(epoch, window)
+            # sorted, the rows are read in file order
+            rows = data[np.sort(permutation[k * self.batch_size:(k + 1) * self.batch_size])]
+
+        tensor = torch.from_numpy(rows)
+        if self.dense_log:
+            x_int_batch = torch.from_numpy(rows[:, 1:14].view(np.float32))
+        else:
+            x_int_batch = tensor[:, 1:14]
+
+        return _transform_features(x_int_batch=x_int_batch,
+                                   x_cat_batch=tensor[:, 14:],
+                                   y_batch=tensor[:, 0],
+                                   max_ind_range=self.max_ind_range,
+                                   flag_input_torch_tensor=True)
+
+    '''
+    # seek and read on a file handle shared by the workers
     def __getitem__(self, idx):
         self.file.seek(idx * self.bytes_per_entry, 0)
         raw_data = self.file.read(self.bytes_per_entry)
@@ -233,8 +568,125 @@ class CriteoBinDataset(Dataset):
                                    y_batch=tensor[:, 0],
                                    max_ind_range=self.max_ind_range,
                                    flag_input_torch_tensor=True)
+    '''
+
+
+class CriteoBinShuffleSampler(Sampler):
+    """
+    Shuffles a CriteoBinDataset at sample granularity: the windows are visited
+    in random order, the batches of a window in order, and every index carries
+    the epoch (a new permutation of the rows of each window per epoch).
+    """
+
+    def __init__(self, data, seed=0):
+        self.data = data
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        epoch = self.epoch
+        self.epoch += 1
+        window_batches = max(1, self.data.shuffle_window)
+        num_windows = int(math.ceil(len(self.data) / float(window_batches)))
+        rng = np.random.RandomState([self.seed, epoch])
+        for window in rng.permutation(num_windows):
+            begin = window * window_batches
+            for idx in range(begin, min(begin + window_batches, len(self.data))):
+                yield (epoch, int(idx))
+
+    def __len__(self):
+        return len(self.data)
+
+
+def _convert_rows(input_file, output_file_path, begin, end, offset, chunk_rows):
+    # writes rows [begin, end) of a day as int32 rows (y, X_int, X_cat) at row
+    # offset of the output file, chunk_rows rows at a time (precomputed float32
+    # dense features are stored as their bits)
+    row_bytes = 4 * 40
+    chunks = zip(
+        data_utils.iterArrayChunks(input_file, "y", chunk_rows, begin, end),
+        data_utils.iterArrayChunks(input_file, "X_int", chunk_rows, begin, end),
+        data_utils.iterArrayChunks(input_file, "X_cat", chunk_rows, begin, end),
+    )
+    fd = os.open(output_file_path, os.O_WRONLY)
+    try:
+        position = offset * row_bytes
+        for y, x_int, x_cat in chunks:
+            block = np.empty((y.shape[0], 40), dtype=np.int32)
+            block[:, 0] = y
+            if x_int.dtype.kind == "f":
+                block[:, 1:14] = x_int.astype(np.float32).view(np.int32)
+            else:
+                block[:, 1:14] = x_int
+            block[:, 14:] = x_cat
+            data = memoryview(block).cast("B")
+            while len(data) > 0:
+                written = os.pwrite(fd, data, position)
+                position += written
+                data = data[written:]
+    finally:
+        os.close(fd)
+
+
+def numpy_to_binary(input_files, output_file_path, split='train',
+                    num_workers=1, chunk_rows=1 << 19):
+    """
+    Convert the data to a binary format to be read with CriteoBinDataset.
+
+    The days are converted chunk_rows rows at a time (by num_workers processes)
+    directly into their place in the output file; the row offsets of the days
+    are saved in data_utils.binaryIndexFile(output_file_path), together with
+    dense_log, set if the dense features are precomputed float32 numbers.
+    """
+
+    # WARNING - both categorical and numerical data must fit into int32 for
+    # the following code to work correctly
+
+    if split == 'train':
+        ranges = [(0, data_utils.arrayHeader(f, "y")[0][0]) for f in input_files]
+    else:
+        assert len(input_files) == 1
+        samples_in_file = data_utils.arrayHeader(input_files[0], "y")[0][0]
+        midpoint = int(np.ceil(samples_in_file / 2.))
+        if split == "test":
+            ranges = [(0, midpoint)]
+        elif split == "val":
+            ranges = [(midpoint, samples_in_file)]
+        else:
+            raise ValueError('Unknown split value: ', split)
+
+    offsets = np.zeros(len(input_files) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([end - begin for begin, end in ranges])
+
+    # the file is allocated first, the days are then written in any order
+    tmp_file = output_file_path + ".tmp"
+    with open(tmp_file, 'wb') as output_file:
+        output_file.truncate(int(offsets[-1]) * 4 * 40)
+
+    jobs = [
+        (input_file, tmp_file, begin, end, int(offset), chunk_rows)
+        for input_file, (begin, end), offset in zip(input_files, ranges, offsets)
+    ]
+    if num_workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(min(num_workers, len(jobs))) as executor:
+            futures = [executor.submit(_convert_rows, *job) for job in jobs]
+            for input_file, future in zip(input_files, futures):
+                future.result()
+                print('Processed file: ', input_file)
+    else:
+        for job in jobs:
+            print('Processing file: ', job[0])
+            _convert_rows(*job)
+
+    dense_log = data_utils.arrayHeader(input_files[0], "X_int")[1].kind == "f"
+    np.savez(data_utils.binaryIndexFile(output_file_path),
+             files=np.array(input_files), begin=np.array([r[0] for r in ranges]),
+             offsets=offsets, dense_log=dense_log)
+    os.replace(tmp_file, output_file_path)
 
 
+'''
+# loads whole days and converts them one after another
 def numpy_to_binary(input_files, output_file_path, split='train'):
     """Convert the data to a binary format to be read with CriteoBinDataset."""
 
@@ -246,7 +698,7 @@ def numpy_to_binary(input_files, output_file_path, split='train'):
             for input_file in input_files:
                 print('Processing file: ', input_file)
 
-                np_data = np.load(input_file)
+                np_data = data_utils.loadArrays(input_file)
                 np_data = np.concatenate([np_data['y'].reshape(-1, 1),
                                           np_data['X_int'],
                                           np_data['X_cat']], axis=1)
@@ -255,7 +707,7 @@ def numpy_to_binary(input_files, output_file_path, split='train'):
                 output_file.write(np_data.tobytes())
         else:
             assert len(input_files) == 1
-            np_data = np.load(input_files[0])
+            np_data = data_utils.loadArrays(input_files[0])
             np_data = np.concatenate([np_data['y'].reshape(-1, 1),
                                       np_data['X_int'],
                                       np_data['X_cat']], axis=1)
@@ -273,6 +725,7 @@ def numpy_to_binary(input_files, output_file_path, split='train'):
                 raise ValueError('Unknown split value: ', split)
 
             output_file.write(np_data[begin:end].tobytes())
+'''
 
 
 def _preprocess(args):
@@ -38,9 +38,14 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import sys
-# import os
+import os
+import time
+import shutil
+import zipfile
 from os import path
-from multiprocessing import Process, Manager
+from multiprocessing import Process, Pool, cpu_count
+from concurrent.futures import ThreadPoolExecutor
+from preprocess_manifest import Pipeline, Stage, run_command
 # import io
 # from io import StringIO
 # import collections as coll
@@ -48,6 +53,252 @@ from multiprocessing import Process, Manager
 import numpy as np
 
 
+# Intermediate files (parsed, processed and reordered days) are written either
+# as compressed archives <name>.npz ("npz") or as a directory <name>_npy with a
+# raw .npy file per array ("npy"), which loads without inflating and can be
+# memory-mapped. The final (archival) output is always compressed.
+def npyDirName(filename):
+    # directory holding the arrays of <name>.npz in "npy" format
+    return (filename[:-4] if filename.endswith(".npz") else filename) + "_npy"
+
+
+class NpyDir:
+    # Read access to a directory of .npy files with the interface of the
+    # NpzFile returned by np.load (data.files, data["X_int"], with ... as data)
+
+    def __init__(self, dirname, mmap_mode=None):
+        self.dirname = dirname
+        self.mmap_mode = mmap_mode
+        self.files = sorted(
+            f[:-4] for f in os.listdir(dirname) if f.endswith(".npy")
+        )
+
+    def __getitem__(self, key):
+        if key not in self.files:
+            raise KeyError("%s is not a file in %s" % (key, self.dirname))
+        return np.load(path.join(self.dirname, key + ".npy"), mmap_mode=self.mmap_mode)
+
+    def __contains__(self, key):
+        return key in self.files
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        return
+
+
+def arraysPath(filename, intermediate_format="npz"):
+    # file (or directory) holding <name>.npz in the given format
+    return npyDirName(filename) if intermediate_format == "npy" else filename
+
+
+def existsArrays(filename):
+    # checks if <name>.npz exists in any of the formats
+    return path.exists(filename) or path.isdir(npyDirName(filename))
+
+
+def removeArrays(filename):
+    # removes <name>.npz in all the formats (a stage writing it in one format
+    # must not find the output of an earlier run in the other one)
+    dirname = npyDirName(filename)
+    if path.isdir(dirname):
+        shutil.rmtree(dirname)
+    if path.exists(filename):
+        os.remove(filename)
+
+
+def loadArrays(filename, mmap_mode=None):
+    # loads <name>.npz from whichever format exists ("npy" first), mmap_mode
+    # only applies to the "npy" format
+    dirname = npyDirName(filename)
+    if path.isdir(dirname):
+        return NpyDir(dirname, mmap_mode)
+    return np.load(filename)
+
+
+def saveArrays(filename, intermediate_format="npz", **arrays):
+    # saves the arrays as <name>.npz in the given format, the "npy" directory
+    # is written aside and renamed once complete
+    if intermediate_format == "npy":
+        dirname = npyDirName(filename)
+        tmpname = dirname + ".tmp"
+        if path.isdir(tmpname):
+            shutil.rmtree(tmpname)
+        os.makedirs(tmpname)
+        for key, value in arrays.items():
+            np.save(path.join(tmpname, key + ".npy"), value)
+        if path.isdir(dirname):
+            shutil.rmtree(dirname)
+        os.rename(tmpname, dirname)
+    elif intermediate_format == "npz":
+        np.savez_compressed(filename, **arrays)
+    else:
+        sys.exit("ERROR: intermediate format is neither npz nor npy")
+
+
+def _npzMemberHeader(f):
+    # reads the header of a .npy stream, returns (shape, fortran_order, dtype)
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    return np.lib.format.read_array_header_2_0(f)
+
+
+def arrayHeader(filename, key):
+    # (shape, dtype) of array key of <name>.npz (whichever format exists)
+    # without reading its data
+    dirname = npyDirName(filename)
+    if path.isdir(dirname):
+        a = np.load(path.join(dirname, key + ".npy"), mmap_mode="r")
+        return a.shape, a.dtype
+    with zipfile.ZipFile(filename) as z, z.open(key + ".npy") as f:
+        shape, _, dtype = _npzMemberHeader(f)
+        return shape, dtype
+
+
+def narrowestIntType(counts):
+    # narrowest signed integer type holding the ids 0, ..., max(counts) - 1
+    for dtype in (np.int8, np.int16, np.int32):
+        if np.max(counts) - 1 <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def precomputeFeatures(X_int, X_cat, counts):
+    # Dense features log-transformed once, log(x + 1) as float32 (the loaders
+    # skip the transform for floating point X_int), categorical features in the
+    # narrowest integer type holding the ids of every table.
+    X_int = np.log(X_int.astype(np.float32) + 1)
+    return X_int, X_cat.astype(narrowestIntType(counts))
+
+
+def denseFeatures(X_int):
+    # log(x + 1) of the dense features as float32, unless precomputed
+    if X_int.dtype.kind == "f":
+        return X_int.astype(np.float32)
+    return np.log(X_int.astype(np.float32) + 1)
+
+
+def iterArrayChunks(filename, key, chunk_rows, begin=0, end=None):
+    # Yields rows [begin, end) of array key of <name>.npz in chunks of at most
+    # chunk_rows rows without loading the whole array: "npy" files are
+    # memory-mapped and the members of npz archives are inflated as a stream.
+    dirname = npyDirName(filename)
+    if path.isdir(dirname):
+        a = np.load(path.join(dirname, key + ".npy"), mmap_mode="r")
+        end = a.shape[0] if end is None else end
+        for i in range(begin, end, chunk_rows):
+            yield np.array(a[i:min(i + chunk_rows, end)])
+        return
+    with zipfile.ZipFile(filename) as z, z.open(key + ".npy") as f:
+        shape, fortran_order, dtype = _npzMemberHeader(f)
+        end = shape[0] if end is None else end
+        if fortran_order or dtype.hasobject:
+            # not stored row by row
+            with np.load(filename) as data:
+                a = data[key]
+            for i in range(begin, end, chunk_rows):
+                yield a[i:min(i + chunk_rows, end)]
+            return
+        row_shape = tuple(shape[1:])
+        row_bytes = int(np.prod(row_shape, dtype=np.int64)) * dtype.itemsize
+        i = 0
+        while i < end:
+            n = min(chunk_rows, end - i)
+            if i < begin:
+                n = min(n, begin - i)
+            buf = f.read(n * row_bytes)
+            if len(buf) != n * row_bytes:
+                sys.exit("ERROR: truncated array " + key + " in " + filename)
+            if i >= begin:
+                yield np.frombuffer(buf, dtype=dtype).reshape((n,) + row_shape)
+            i += n
+
+
+# Trace files (memory references of an embedding table, see the synthetic
+# trace functions of dlrm_data_pytorch.py): a 64 byte header followed by the
+# references as a raw little-endian array, so that a trace is memory-mapped
+# and read in chunks instead of parsed into a list.
+TRACE_MAGIC = b"DLRMTRC1"
+traceHeaderType = np.dtype([
+    ("magic", "S8"),
+    ("dtype", "S8"),        # element type, e.g. <u8
+    ("count", "<u8"),       # number of references
+    ("table", "<i8"),       # embedding table (-1: unknown)
+    ("line_size", "<u8"),   # cache line size of the references
+    ("reserved", "<u8", (3,)),
+])
+
+
+def isTraceFile(filename):
+    # checks if filename is a trace file with a header (and not the text or
+    # headerless binary traces of earlier versions)
+    with open(filename, "rb") as f:
+        return f.read(len(TRACE_MAGIC)) == TRACE_MAGIC
+
+
+def readTraceHeader(filename):
+    # header of a trace file as a dict (dtype, count, table, line_size)
+    header = np.fromfile(filename, dtype=traceHeaderType, count=1)
+    if len(header) != 1 or header["magic"][0] != TRACE_MAGIC:
+        sys.exit("ERROR: " + filename + " is not a trace file")
+    return {
+        "dtype": np.dtype(header["dtype"][0].decode()),
+        "count": int(header["count"][0]),
+        "table": int(header["table"][0]),
+        "line_size": int(header["line_size"][0]),
+    }
+
+
+def loadTraceFile(filename, mode="r"):
+    # (header, references memory-mapped)
+    header = readTraceHeader(filename)
+    if header["count"] == 0:
+        return header, np.zeros(0, dtype=header["dtype"])
+    return header, np.memmap(
+        filename, dtype=header["dtype"], mode=mode,
+        offset=traceHeaderType.itemsize, shape=(header["count"],)
+    )
+
+
+def iterTraceChunks(filename, chunk_size=1 << 22):
+    # yields the references of a trace file in chunks of at most chunk_size,
+    # traces larger than the memory are paged in and out by the kernel
+    _, trace = loadTraceFile(filename)
+    for i in range(0, len(trace), chunk_size):
+        yield np.array(trace[i:i + chunk_size])
+
+
+def writeTraceFile(filename, trace, table=-1, line_size=1, dtype="<u8"):
+    # writes trace (an array, or an iterable of arrays written one after the
+    # other) with its header; the file is written aside and renamed once
+    # complete, the count is known at the end
+    dtype = np.dtype(dtype)
+    chunks = [trace] if isinstance(trace, (np.ndarray, list)) else trace
+    header = np.zeros(1, dtype=traceHeaderType)
+    header["magic"] = TRACE_MAGIC
+    header["dtype"] = dtype.str.encode()
+    header["table"] = table
+    header["line_size"] = line_size
+    count = 0
+    tmp_file = filename + ".tmp"
+    with open(tmp_file, "wb") as f:
+        header.tofile(f)
+        for chunk in chunks:
+            chunk = np.asarray(chunk).astype(dtype, copy=False).reshape(-1)
+            chunk.tofile(f)
+            count += len(chunk)
+        header["count"] = count
+        f.seek(0)
+        header.tofile(f)
+    os.replace(tmp_file, filename)
+    return count
+
+
 def convertUStringToDistinctIntsDict(mat, convertDicts, counts):
     # Converts matrix of unicode strings into distinct integers.
     #
@@ -109,7 +360,32 @@ def convertUStringToDistinctIntsUnique(mat, mat_uni, counts):
     return out, mat_uni, counts
 
 
-def processCriteoAdData(d_path, d_file, npzfile, i, convertDicts, pre_comp_counts):
+def convertDictsToArrays(convertDicts):
+    # Turns the dictionary of each column into a pair of arrays
+    # (keys sorted, values in the same order), used for vectorized lookups.
+    convertArrays = []
+    for d in convertDicts:
+        keys = np.fromiter(d.keys(), dtype=np.int64, count=len(d))
+        values = np.fromiter(d.values(), dtype=np.int32, count=len(d))
+        order = np.argsort(keys)
+        convertArrays.append((keys[order], values[order]))
+    return convertArrays
+
+
+def remapColumn(col, keys, values):
+    # Maps every element of col to the value of its key (keys must be sorted
+    # and contain all the elements of col).
+    pos = np.searchsorted(keys, col)
+    pos[pos == len(keys)] = 0
+    if not np.array_equal(np.take(keys, pos), col):
+        sys.exit("ERROR: categorical value missing from the dictionary")
+    return np.take(values, pos)
+
+
+def processCriteoAdData(
+        d_path, d_file, npzfile, i, convertDicts, pre_comp_counts, convertArrays=None,
+        intermediate_format="npz", precompute_features=False
+):
     # Process Kaggle Display Advertising Challenge or Terabyte Dataset
     # by converting unicode strings in X_cat to integers and
     # converting negative integer values in X_int.
@@ -119,15 +395,20 @@ def processCriteoAdData(d_path, d_file, npzfile, i, convertDicts, pre_comp_count
     # Inputs:
     #   d_path (str): path for {kaggle|terabyte}_day_i.npz files
     #   i (int): splits in the dataset (typically 0 to 7 or 0 to 24)
+    #   convertArrays (list): sorted (keys, values) of each convertDicts column,
+    #                         computed from convertDicts if not given
+    #   intermediate_format (str): format of the processed file (npz or npy)
+    #   precompute_features (bool): store the transformed features
+    #                               (see precomputeFeatures)
 
     # process data if not all files exist
     filename_i = npzfile + "_{0}_processed.npz".format(i)
 
-    if path.exists(filename_i):
+    if existsArrays(filename_i):
         print("Using existing " + filename_i, end="\n")
     else:
         print("Not existing " + filename_i)
-        with np.load(npzfile + "_{0}.npz".format(i)) as data:
+        with loadArrays(npzfile + "_{0}.npz".format(i)) as data:
             # categorical features
             '''
             # Approach 1a: using empty dictionaries
@@ -141,21 +422,39 @@ def processCriteoAdData(d_path, d_file, npzfile, i, convertDicts, pre_comp_count
                 data["X_cat"], convertDicts, counts
             )
             '''
+            '''
             # Approach 2a: using pre-computed dictionaries
             X_cat_t = np.zeros(data["X_cat_t"].shape)
             for j in range(26):
                 for k, x in enumerate(data["X_cat_t"][j, :]):
                     X_cat_t[j, k] = convertDicts[j][x]
+            '''
+            # Approach 2b: using pre-computed dictionaries as sorted arrays
+            # (vectorized lookups, the columns are converted in parallel threads)
+            if convertArrays is None:
+                convertArrays = convertDictsToArrays(convertDicts)
+            X_cat_raw = data["X_cat_t"]
+            X_cat_t = np.zeros(X_cat_raw.shape, dtype=np.int32)
+
+            def remap(j):
+                X_cat_t[j, :] = remapColumn(X_cat_raw[j, :], *convertArrays[j])
+
+            with ThreadPoolExecutor(max_workers=min(26, cpu_count())) as executor:
+                list(executor.map(remap, range(26)))
             # continuous features
             X_int = data["X_int"]
             X_int[X_int < 0] = 0
             # targets
             y = data["y"]
 
-        np.savez_compressed(
+        X_cat = np.transpose(X_cat_t)  # transpose of the data
+        if precompute_features:
+            X_int, X_cat = precomputeFeatures(X_int, X_cat, pre_comp_counts)
+
+        saveArrays(
             filename_i,
-            # X_cat = X_cat,
-            X_cat=np.transpose(X_cat_t),  # transpose of the data
+            intermediate_format,
+            X_cat=X_cat,
             X_int=X_int,
             y=y,
         )
@@ -169,6 +468,217 @@ def processCriteoAdData(d_path, d_file, npzfile, i, convertDicts, pre_comp_count
     return
 
 
+def loadCriteoFreqMap(d_path, d_file):
+    # Loads the id map and the (descending) frequencies saved when the
+    # dictionaries are renumbered by frequency (see criteoDictStage), returns
+    # two lists indexed by table.
+    map_file = d_path + d_file + "_fea_freq_map.npz"
+    if not path.exists(map_file):
+        sys.exit("ERROR: " + map_file + " does not exist, "
+                 + "pre-process the data with renumbering by frequency")
+    with np.load(map_file) as data:
+        n = len(data.files) // 2
+        id_map = [data["map_{0}".format(j)] for j in range(n)]
+        freq = [data["freq_{0}".format(j)] for j in range(n)]
+    return id_map, freq
+
+
+def saveArraysInParts(filename, intermediate_format, fields, num_rows, parts):
+    # saves <name>.npz like saveArrays, the rows of the arrays come in parts
+    # (dictionaries of arrays) that are written sequentially one at a time in
+    # the "npy" format, but need to be concatenated in memory for "npz"
+    #
+    # Inputs:
+    #   fields (dict): name -> (dtype, shape of a row) of every array
+    #   num_rows (int): total number of rows
+    #   parts (iterable): dictionaries name -> array holding consecutive rows
+    if intermediate_format != "npy":
+        parts = list(parts)
+        saveArrays(
+            filename,
+            intermediate_format,
+            **dict((key, np.concatenate([p[key] for p in parts])) for key in fields)
+        )
+        return
+    dirname = npyDirName(filename)
+    tmpname = dirname + ".tmp"
+    if path.isdir(tmpname):
+        shutil.rmtree(tmpname)
+    os.makedirs(tmpname)
+    out = {}
+    for key, (dtype, shape) in fields.items():
+        out[key] = np.lib.format.open_memmap(
+            path.join(tmpname, key + ".npy"), mode="w+", dtype=dtype,
+            shape=(num_rows,) + tuple(shape)
+        )
+    pos = 0
+    for p in parts:
+        n = len(p[list(fields)[0]])
+        for key in fields:
+            out[key][pos:pos + n] = p[key]
+        pos += n
+    if pos != num_rows:
+        sys.exit("ERROR: sanity check on number of samples failed")
+    for key in fields:
+        out[key].flush()
+    del out
+    if path.isdir(dirname):
+        shutil.rmtree(dirname)
+    os.rename(tmpname, dirname)
+
+
+def fillBuckets(rng, num, capacity):
+    # Draws how many of num rows go to each bucket, proportionally to its
+    # remaining capacity and without exceeding it (num <= sum(capacity)).
+    counts = rng.multinomial(num, capacity / np.sum(capacity))
+    counts = np.minimum(counts, capacity)
+    excess = num - np.sum(counts)
+    while excess > 0:
+        spare = capacity - counts
+        add = np.minimum(rng.multinomial(excess, spare / np.sum(spare)), spare)
+        counts += add
+        excess -= np.sum(add)
+    return counts
+
+
+def shuffleCriteoAdData(
+        npzfile, days, data_split, randomize, total_per_file, intermediate_format="npz",
+        mem_gb=16.0
+):
+    # Shuffles the processed days into the reordered days with a bucketed
+    # external shuffle whose memory use is bounded by about mem_gb:
+    # 1st pass: streams every processed day in chunks, draws the output day of
+    #   every row (keeping the number of rows per day, with randomize="total"
+    #   the rows move across days, otherwise they stay in their day) and a random
+    #   bucket within that day, and appends the rows to the bucket files;
+    # 2nd pass: loads the buckets of each output day one at a time, shuffles
+    #   them in memory and appends them to the reordered day.
+    # Buckets are sized to fit in half of the budget, the files are only read
+    # and written sequentially. With data_split other than "none" the last day is
+    # held out and keeps its order. Processed days in the "npz" format are
+    # loaded whole (only "npy" days are streamed), as are reordered days
+    # written in the "npz" format.
+    #
+    # Inputs:
+    #   npzfile (str): prefix of the {kaggle|terabyte}_day_i_processed.npz files
+    #   total_per_file (list): number of samples in each day
+    #   mem_gb (float): memory budget in GB
+    budget = int(mem_gb * 1024 ** 3)
+    rng = np.random.default_rng(np.random.randint(0, 2 ** 31 - 1))
+    total_per_file = np.array(total_per_file, dtype=np.int64)
+    total_count = int(np.sum(total_per_file))
+
+    # a row is stored as a record (target, dense and sparse features)
+    with loadArrays(npzfile + "_0_processed.npz", mmap_mode="r") as data:
+        rec = np.dtype([
+            ("y", data["y"].dtype),
+            ("X_int", data["X_int"].dtype, data["X_int"].shape[1:]),
+            ("X_cat", data["X_cat"].dtype, data["X_cat"].shape[1:]),
+        ])
+    chunk_rows = max(1, budget // (4 * rec.itemsize))
+
+    days_to_sample = days if data_split == "none" else days - 1
+    permute = [
+        randomize in ["day", "total"] and (data_split == "none" or j < days - 1)
+        for j in range(days)
+    ]
+    # buckets per output day and their offsets
+    num_buckets = np.maximum(
+        1, -(-(total_per_file * rec.itemsize) // max(1, budget // 2))
+    ).astype(np.int64)
+    bucket_offset = np.concatenate(([0], np.cumsum(num_buckets)))
+    tmp_dir = npzfile + "_shuffle_tmp"
+    if path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    def bucket_file(b):
+        return path.join(tmp_dir, "bucket_{0}.bin".format(b))
+
+    # 1st pass: scatter the rows into the buckets
+    capacity = total_per_file[:days_to_sample].copy()
+    done = 0
+    t0 = time.time()
+    for i in range(days):
+        filename_i = npzfile + "_{0}_processed.npz".format(i)
+        with loadArrays(filename_i, mmap_mode="r") as data:
+            X_cat = data["X_cat"]
+            X_int = data["X_int"]
+            y = data["y"]
+            size = len(y)
+            # sanity check
+            if total_per_file[i] != size:
+                sys.exit("ERROR: sanity check on number of samples failed")
+            for start in range(0, size, chunk_rows):
+                end = min(start + chunk_rows, size)
+                n = end - start
+                rows = np.empty(n, dtype=rec)
+                rows["y"] = y[start:end]
+                rows["X_int"] = X_int[start:end]
+                rows["X_cat"] = X_cat[start:end]
+                # output day of every row
+                if randomize == "total" and i < days_to_sample:
+                    counts = fillBuckets(rng, n, capacity)
+                    capacity -= counts
+                    day = np.repeat(np.arange(days_to_sample), counts)
+                    rng.shuffle(day)
+                else:
+                    day = np.full(n, i, dtype=np.int64)
+                # bucket within the day (random, or by position to keep the order)
+                if permute[i]:
+                    sub = rng.integers(0, num_buckets[day])
+                else:
+                    sub = (np.arange(start, end) * num_buckets[i]) // size
+                b = bucket_offset[day] + sub
+                order = np.argsort(b, kind="stable")
+                b = b[order]
+                rows = rows[order]
+                bounds = np.flatnonzero(np.diff(b)) + 1
+                for lo, hi in zip(
+                        np.concatenate(([0], bounds)), np.concatenate((bounds, [n]))
+                ):
+                    with open(bucket_file(b[lo]), "ab") as f:
+                        rows[lo:hi].tofile(f)
+                del rows, order, b
+                done += n
+                elapsed = time.time() - t0
+                print(
+                    "Reordering (1st pass) %d/%d (%d%%) Day: %d  %.1f MB/s"
+                    % (done, total_count, (100 * done) // total_count, i,
+                       done * rec.itemsize / (1024 ** 2) / max(elapsed, 1e-6)),
+                    end="\r",
+                )
+    print("")
+
+    # 2nd pass: shuffle every bucket and write the reordered days
+    fields = dict((key, (rec[key].base, rec[key].shape)) for key in rec.names)
+    done = 0
+    t0 = time.time()
+    for j in range(days):
+        filename_r = npzfile + "_{0}_reordered.npz".format(j)
+
+        def parts(j=j):
+            for b in range(bucket_offset[j], bucket_offset[j + 1]):
+                if not path.exists(bucket_file(b)):
+                    continue
+                rows = np.fromfile(bucket_file(b), dtype=rec)
+                os.remove(bucket_file(b))
+                if permute[j]:
+                    rows = rows[rng.permutation(len(rows))]
+                yield dict((key, rows[key]) for key in rec.names)
+
+        print("Reordering (2nd pass) " + filename_r)
+        saveArraysInParts(filename_r, intermediate_format, fields, int(total_per_file[j]), parts())
+        done += total_per_file[j]
+        elapsed = time.time() - t0
+        print(
+            "Reordered %d/%d (%d%%)  %.1f MB/s"
+            % (done, total_count, (100 * done) // total_count,
+               done * rec.itemsize / (1024 ** 2) / max(elapsed, 1e-6))
+        )
+    shutil.rmtree(tmp_dir)
+
+
 def concatCriteoAdData(
         d_path,
         d_file,
@@ -180,7 +690,9 @@ def concatCriteoAdData(
         total_per_file,
         total_count,
         memory_map,
-        o_filename
+        o_filename,
+        intermediate_format="npz",
+        shuffle_mem_gb=16.0
 ):
     # Concatenates different days and saves the result.
     #
@@ -188,6 +700,9 @@ def concatCriteoAdData(
     #   days (int): total number of days in the dataset (typically 7 or 24)
     #   d_path (str): path for {kaggle|terabyte}_day_i.npz files
     #   o_filename (str): output file name
+    #   intermediate_format (str): format of the reordered files (npz or npy),
+    #                              the output file is always compressed
+    #   shuffle_mem_gb (float): memory budget of the shuffle (memory_map)
     #
     # Output:
     #   o_file (str): output file path
@@ -551,7 +1066,7 @@ def concatCriteoAdData(
         else:
             print("Reordered day files already exist, skipping ...")
         '''
-
+        '''
         # Approach 4: Fisher-Yates-Rao (FYR) shuffle algorithm
         # 1st pass of FYR shuffle
         # check if data already exists
@@ -587,7 +1102,7 @@ def concatCriteoAdData(
             total_counter = [0] * days
             for i in range(days):
                 filename_i = npzfile + "_{0}_processed.npz".format(i)
-                with np.load(filename_i) as data:
+                with loadArrays(filename_i) as data:
                     X_cat = data["X_cat"]
                     X_int = data["X_int"]
                     y = data["y"]
@@ -673,7 +1188,7 @@ def concatCriteoAdData(
         # check if data already exists
         for j in range(days):
             filename_j = npzfile + "_{0}_reordered.npz".format(j)
-            if path.exists(filename_j):
+            if existsArrays(filename_j):
                 print("Using existing " + filename_j)
             else:
                 recreate_flag = True
@@ -694,12 +1209,25 @@ def concatCriteoAdData(
 
                 filename_r = npzfile + "_{0}_reordered.npz".format(j)
                 print("Reordering (2nd pass) " + filename_r)
-                np.savez_compressed(
+                saveArrays(
                     filename_r,
+                    intermediate_format,
                     X_cat=fj_s[indices, :],
                     X_int=fj_d[indices, :],
                     y=fj_y[indices],
                 )
+        '''
+
+        # Approach 5: bucketed external shuffle (bounded memory, sequential I/O)
+        shuffleCriteoAdData(
+            npzfile,
+            days,
+            data_split,
+            randomize,
+            total_per_file,
+            intermediate_format,
+            shuffle_mem_gb
+        )
 
         '''
         # sanity check (under no reordering norms should be zero)
@@ -727,7 +1255,7 @@ def concatCriteoAdData(
         # load and concatenate data
         for i in range(days):
             filename_i = npzfile + "_{0}_processed.npz".format(i)
-            with np.load(filename_i) as data:
+            with loadArrays(filename_i) as data:
                 if i == 0:
                     X_cat = data["X_cat"]
                     X_int = data["X_int"]
@@ -832,15 +1360,15 @@ def transformCriteoAdData(X_cat, X_int, y, days, data_split, randomize, total_pe
         print("Split data according to indices...")
 
         X_cat_train = X_cat_train.astype(np.long)
-        X_int_train = np.log(X_int_train.astype(np.float32) + 1)
+        X_int_train = denseFeatures(X_int_train)
         y_train = y_train.astype(np.float32)
 
         X_cat_val = X_cat_val.astype(np.long)
-        X_int_val = np.log(X_int_val.astype(np.float32) + 1)
+        X_int_val = denseFeatures(X_int_val)
         y_val = y_val.astype(np.float32)
 
         X_cat_test = X_cat_test.astype(np.long)
-        X_int_test = np.log(X_int_test.astype(np.float32) + 1)
+        X_int_test = denseFeatures(X_int_test)
         y_test = y_test.astype(np.float32)
 
         print("Converted to tensors...done!")
@@ -865,7 +1393,7 @@ def transformCriteoAdData(X_cat, X_int, y, days, data_split, randomize, total_pe
             print("Randomized indices...")
 
         X_cat = X_cat[indices].astype(np.long)
-        X_int = np.log(X_int[indices].astype(np.float32) + 1)
+        X_int = denseFeatures(X_int[indices])
         y = y[indices].astype(np.float32)
 
         print("Converted to tensors...done!")
@@ -873,6 +1401,448 @@ def transformCriteoAdData(X_cat, X_int, y, days, data_split, randomize, total_pe
         return (X_cat, X_int, y, [], [], [], [], [], [])
 
 
+# lookup table from an ASCII character to its (hex) digit value
+_HEX_DIGIT = np.zeros(256, dtype=np.int64)
+_HEX_DIGIT[ord("0"):ord("9") + 1] = np.arange(10)
+_HEX_DIGIT[ord("a"):ord("f") + 1] = np.arange(10, 16)
+_HEX_DIGIT[ord("A"):ord("F") + 1] = np.arange(10, 16)
+
+
+def countLines(filename, block_bytes=64 * 1024 * 1024):
+    # Counts the lines of a (text) file reading it in large binary blocks.
+    count = 0
+    last = b"\n"
+    with open(str(filename), "rb") as f:
+        block = f.read(block_bytes)
+        while block:
+            count += block.count(b"\n")
+            last = block[-1:]
+            block = f.read(block_bytes)
+    # last line without a trailing newline
+    if last != b"\n":
+        count += 1
+    return count
+
+
+def splitFileByLines(filename, out_prefix, lines_per_split, block_bytes=64 * 1024 * 1024):
+    # Splits a text file into files out_prefix_0, out_prefix_1, ... holding
+    # lines_per_split[i] lines each, copying large binary blocks.
+    file_id = 0
+    remaining = lines_per_split[0]
+    nf = open(out_prefix + "_" + str(file_id), "wb")
+    with open(str(filename), "rb") as f:
+        block = f.read(block_bytes)
+        while block:
+            while block and file_id < len(lines_per_split):
+                newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10)
+                if remaining > len(newlines):
+                    nf.write(block)
+                    remaining -= len(newlines)
+                    block = b""
+                else:
+                    cut = newlines[remaining - 1] + 1 if remaining > 0 else 0
+                    nf.write(block[:cut])
+                    nf.close()
+                    block = block[cut:]
+                    file_id += 1
+                    if file_id < len(lines_per_split):
+                        nf = open(out_prefix + "_" + str(file_id), "wb")
+                        remaining = lines_per_split[file_id]
+            block = f.read(block_bytes)
+    if not nf.closed:
+        nf.close()
+    return
+
+
+def getChunkBounds(filename, chunk_bytes):
+    # Splits a text file into byte ranges of about chunk_bytes each,
+    # aligned to the line boundaries.
+    size = path.getsize(str(filename))
+    bounds = [0]
+    with open(str(filename), "rb") as f:
+        while bounds[-1] < size:
+            pos = bounds[-1] + chunk_bytes
+            if pos >= size:
+                bounds.append(size)
+            else:
+                f.seek(pos)
+                f.readline()
+                bounds.append(min(f.tell(), size))
+    return bounds
+
+
+def parseIntFields(buf, starts, ends, base=10):
+    # Converts the ASCII fields buf[starts:ends] (digits with an optional sign,
+    # empty fields as 0) into int64 without leaving numpy, processing one
+    # character position of all the fields at a time.
+    #
+    # Inputs:
+    #   buf (np.array): uint8 view of the text
+    #   starts, ends (np.array): start and end (exclusive) offset of every field
+    #   base (int): 10 or 16
+    out = np.zeros(starts.shape, dtype=np.int64)
+    neg = np.zeros(starts.shape, dtype=bool)
+    width = int(np.max(ends - starts)) if starts.size > 0 else 0
+    for p in range(width):
+        pos = starts + p
+        valid = pos < ends
+        c = buf[np.where(valid, pos, 0)]
+        if p == 0:
+            neg = np.logical_and(valid, c == ord("-"))
+            valid = np.logical_and(valid, np.logical_not(neg))
+        out = np.where(valid, out * base + _HEX_DIGIT[c], out)
+    return np.where(neg, -out, out)
+
+
+def parseCriteoChunk(task):
+    # Parses a byte range of a Criteo TSV file (one sample per line: label,
+    # 13 continuous and 26 categorical hex features, missing values are empty).
+    #
+    # Inputs:
+    #   task (tuple): (datfile, start, end, max_ind_range, sub_sample_rate, seed)
+    #
+    # Outputs:
+    #   y (np.array), X_int (np.array), X_cat (np.array): int32 samples
+    #   uniques (list): sorted unique categorical values of each column and
+    #                   their number of occurrences, (unique, count) pairs
+    datfile, start, end, max_ind_range, sub_sample_rate, seed = task
+    with open(str(datfile), "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    if data.endswith(b"\n"):
+        data = data[:-1]
+    if len(data) == 0:
+        return (
+            np.zeros(0, dtype=np.int32),
+            np.zeros((0, 13), dtype=np.int32),
+            np.zeros((0, 26), dtype=np.int32),
+            [(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64))
+             for _ in range(26)],
+        )
+
+    # locate all the fields at once (every line holds 40 fields)
+    num_lines = data.count(b"\n") + 1
+    if data.count(b"\t") != 39 * num_lines:
+        # malformed lines, pad (or cut) each line to 40 fields
+        data = b"\n".join([
+            b"\t".join((line.split(b"\t") + [b""] * 40)[0:40])
+            for line in data.split(b"\n")
+        ])
+    buf = np.frombuffer(data, dtype=np.uint8)
+    sep = np.flatnonzero(np.logical_or(buf == ord("\t"), buf == ord("\n")))
+    starts = np.concatenate(([0], sep + 1)).reshape(num_lines, 40)
+    ends = np.concatenate((sep, [len(buf)])).reshape(num_lines, 40)
+    del sep
+
+    # convert (missing values are set to zero)
+    y = parseIntFields(buf, starts[:, 0], ends[:, 0]).astype(np.int32)
+    X_int = parseIntFields(buf, starts[:, 1:14], ends[:, 1:14]).astype(np.int32)
+    X_cat = parseIntFields(buf, starts[:, 14:40], ends[:, 14:40], base=16)
+    if max_ind_range > 0:
+        X_cat = X_cat % max_ind_range
+    X_cat = X_cat.astype(np.int32)
+    del starts, ends
+
+    # sub-sample data by dropping zero targets, if needed
+    if sub_sample_rate > 0.0:
+        rand_u = np.random.RandomState(seed).uniform(low=0.0, high=1.0, size=len(y))
+        keep = np.logical_not(np.logical_and(y == 0, rand_u < sub_sample_rate))
+        y = y[keep]
+        X_int = X_int[keep]
+        X_cat = X_cat[keep]
+
+    # count uniques
+    uniques = [np.unique(X_cat[:, j], return_counts=True) for j in range(26)]
+
+    return y, X_int, X_cat, uniques
+
+
+def mergeUniqueCounts(a, b):
+    # Merges two (sorted unique values, counts) pairs.
+    unique = np.union1d(a[0], b[0])
+    count = np.zeros(len(unique), dtype=np.int64)
+    count[np.searchsorted(unique, a[0])] += a[1]
+    count[np.searchsorted(unique, b[0])] += b[1]
+    return unique, count
+
+
+def reduceUniqueCounts(parts):
+    # Merges a list of (sorted unique values, counts) pairs in a tree reduction.
+    if len(parts) == 0:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64)
+    while len(parts) > 1:
+        merged = [
+            mergeUniqueCounts(parts[k], parts[k + 1])
+            for k in range(0, len(parts) - 1, 2)
+        ]
+        if len(parts) % 2 == 1:
+            merged.append(parts[-1])
+        parts = merged
+    return parts[0]
+
+
+def processCriteoDayFile(task):
+    # Parses a day (split) of the Criteo dataset and saves it as
+    # {kaggle|terabyte}_day_i.npz, the file is parsed in chunks of about
+    # chunk_bytes on num_workers processes.
+    #
+    # Inputs:
+    #   task (tuple): (datfile, npzfile, split, num_data_in_split, max_ind_range,
+    #                  sub_sample_rate, seed, num_workers, chunk_bytes,
+    #                  intermediate_format)
+    #
+    # Outputs:
+    #   i (int): number of samples stored
+    #   uniques (list): per column (sorted unique values, counts) of the day
+    (datfile, npzfile, split, num_data_in_split, max_ind_range,
+     sub_sample_rate, seed, num_workers, chunk_bytes, intermediate_format) = task
+
+    bounds = getChunkBounds(datfile, chunk_bytes)
+    seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1, size=len(bounds) - 1)
+    tasks = [
+        (datfile, bounds[c], bounds[c + 1], max_ind_range, sub_sample_rate, seeds[c])
+        for c in range(len(bounds) - 1)
+    ]
+
+    y = np.zeros(num_data_in_split, dtype="i4")  # 4 byte int
+    X_int = np.zeros((num_data_in_split, 13), dtype="i4")  # 4 byte int
+    X_cat = np.zeros((num_data_in_split, 26), dtype="i4")  # 4 byte int
+
+    num_workers = min(num_workers, len(tasks))
+    pool = Pool(num_workers) if num_workers > 1 else None
+    chunks = pool.imap(parseCriteoChunk, tasks) if pool else map(parseCriteoChunk, tasks)
+
+    i = 0
+    uniques = [[] for _ in range(26)]
+    for c, (y_c, X_int_c, X_cat_c, uniques_c) in enumerate(chunks):
+        n = len(y_c)
+        y[i:i + n] = y_c
+        X_int[i:i + n] = X_int_c
+        X_cat[i:i + n] = X_cat_c
+        i += n
+        for j in range(26):
+            uniques[j].append(uniques_c[j])
+        # debug prints
+        print(
+            "Load %d/%d (%d%%) Split: %d  Chunk: %d/%d"
+            % (i, num_data_in_split, (100 * (c + 1)) // len(tasks),
+               split, c + 1, len(tasks)),
+            end="\n" if pool is None else "\r",
+        )
+    if pool:
+        pool.close()
+        pool.join()
+
+    # count uniques
+    uniques = [reduceUniqueCounts(uniques[j]) for j in range(26)]
+
+    # store num_data_in_split samples or extras at the end of file
+    # store parsed
+    filename_s = npzfile + "_{0}.npz".format(split)
+    if existsArrays(filename_s):
+        print("\nSkip existing " + filename_s)
+    else:
+        saveArrays(
+            filename_s,
+            intermediate_format,
+            X_int=X_int[0:i, :],
+            # X_cat=X_cat[0:i, :],
+            X_cat_t=np.transpose(X_cat[0:i, :]),  # transpose of the data
+            y=y[0:i],
+        )
+        print("\nSaved " + npzfile + "_{0}.npz!".format(split))
+
+    return i, uniques
+
+
+def uniqueToArrays(unique):
+    # Same as convertDictsToArrays for a dictionary stored as an array of
+    # unique values (the id of a value is its position in the array).
+    order = np.argsort(unique, kind="stable")
+    return unique[order].astype(np.int64), order.astype(np.int32)
+
+
+def criteoManifestDir(d_path, d_file):
+    # directory holding the manifests of the preprocessing stages
+    return d_path + d_file + "_manifest"
+
+
+def criteoSplitStage(datafile, npzfile, days):
+    # Splits the Kaggle train.txt into days text files npzfile_i with the same
+    # number of lines (simplifies code later on).
+    # WARNING: The raw data consists of a single train.txt file
+    # Each line in the file is a sample, consisting of 13 continuous and
+    # 26 categorical features (an extra space indicates that feature is
+    # missing and will be interpreted as 0).
+    print("Reading data from path=%s" % (datafile))
+    total_count = countLines(datafile)
+    num_data_per_split, extras = divmod(total_count, days)
+    total_per_file = [num_data_per_split] * days
+    for j in range(extras):
+        total_per_file[j] += 1
+    splitFileByLines(datafile, npzfile, total_per_file)
+
+
+def criteoParseStage(
+        datfile, npzfile, i, max_ind_range, sub_sample_rate, seed, num_workers,
+        intermediate_format
+):
+    # Parses day i into npzfile_i.npz (see processCriteoDayFile) and saves the
+    # number of samples and the sorted unique values (and their counts) of
+    # every column into npzfile_i_uniques.npz, the map step of the dictionaries.
+    removeArrays(npzfile + "_{0}.npz".format(i))
+    print("Reading data from path=%s" % (str(datfile)))
+    num_data_in_split = countLines(datfile)
+    num_samples, uniques = processCriteoDayFile(
+        (datfile, npzfile, i, num_data_in_split, max_ind_range, sub_sample_rate,
+         seed, num_workers, 64 * 1024 * 1024, intermediate_format)
+    )
+    arrays = {"num_samples": num_samples}
+    for j in range(26):
+        arrays["unique_{0}".format(j)] = uniques[j][0]
+        arrays["count_{0}".format(j)] = uniques[j][1]
+    np.savez_compressed(npzfile + "_{0}_uniques.npz".format(i), **arrays)
+
+
+def criteoDictStage(d_path, d_file, npzfile, days, renumber_by_freq):
+    # Reduce step: merges the uniques of all days into the dictionary of every
+    # column, _fea_dict_j.npz holds the unique values (the id of a category is
+    # its position) and their number of occurrences (freq). Also saves the
+    # number of categories (_fea_count.npz) and of samples per day
+    # (_day_count.npz).
+    #
+    # With renumber_by_freq the categories of every table are numbered by
+    # descending frequency, so that id 0 is the most frequently accessed row,
+    # id 1 the second most, etc. The hottest k_t rows of table t are simply the
+    # ids k < k_t, i.e. a contiguous prefix of the embedding table. The id map
+    # (from the ids in value order) and the frequencies are saved into
+    # _fea_freq_map.npz (see loadCriteoFreqMap).
+    uniques_files = [npzfile + "_{0}_uniques.npz".format(i) for i in range(days)]
+    total_per_file = []
+    for f in uniques_files:
+        with np.load(f) as data:
+            total_per_file.append(int(data["num_samples"]))
+    total_file = d_path + d_file + "_day_count.npz"
+    np.savez_compressed(total_file, total_per_file=np.array(total_per_file))
+    print("Total number of samples:", np.sum(total_per_file))
+    print("Divided into days/splits:\n", total_per_file)
+
+    print("Constructing dictionaries")
+    counts = np.zeros(26, dtype=np.int32)
+    maps = {}
+    for j in range(26):
+        parts = []
+        for f in uniques_files:
+            with np.load(f) as data:
+                parts.append((data["unique_{0}".format(j)], data["count_{0}".format(j)]))
+        unique, freq = reduceUniqueCounts(parts)
+        del parts
+        if renumber_by_freq:
+            # rank the categories (stable, ties keep their value order)
+            order = np.argsort(-freq, kind="stable")
+            new_id = np.empty(len(unique), dtype=np.int64)
+            new_id[order] = np.arange(len(unique))
+            unique = unique[order]
+            freq = freq[order]
+            maps["map_{0}".format(j)] = new_id
+            maps["freq_{0}".format(j)] = freq
+        np.savez_compressed(
+            d_path + d_file + "_fea_dict_{0}.npz".format(j),
+            unique=unique.astype(np.int32),
+            freq=freq
+        )
+        counts[j] = len(unique)
+    np.savez_compressed(d_path + d_file + "_fea_count.npz", counts=counts)
+
+    map_file = d_path + d_file + "_fea_freq_map.npz"
+    if renumber_by_freq:
+        np.savez_compressed(map_file, **maps)
+        print("Saved " + map_file)
+    elif path.exists(map_file):
+        os.remove(map_file)
+
+
+def criteoRemapStage(
+        d_path, d_file, npzfile, i, intermediate_format, precompute_features=False
+):
+    # Converts the categorical values of day i to their dictionary ids
+    # (see processCriteoAdData).
+    removeArrays(npzfile + "_{0}_processed.npz".format(i))
+    convertArrays = []
+    for j in range(26):
+        with np.load(d_path + d_file + "_fea_dict_{0}.npz".format(j)) as data:
+            convertArrays.append(uniqueToArrays(data["unique"]))
+    with np.load(d_path + d_file + "_fea_count.npz") as data:
+        counts = data["counts"]
+    processCriteoAdData(
+        d_path, d_file, npzfile, i, None, counts, convertArrays, intermediate_format,
+        precompute_features
+    )
+
+
+def criteoConcatStage(
+        d_path, d_file, npzfile, trafile, days, data_split, randomize, memory_map,
+        o_filename, intermediate_format, shuffle_mem_gb=16.0
+):
+    # Shuffles the processed days into the reordered days (memory_map) or
+    # concatenates them into o_filename.npz (see concatCriteoAdData).
+    if memory_map:
+        for i in range(days):
+            removeArrays(npzfile + "_{0}_reordered.npz".format(i))
+    with np.load(d_path + d_file + "_day_count.npz") as data:
+        total_per_file = list(data["total_per_file"])
+    concatCriteoAdData(
+        d_path,
+        d_file,
+        npzfile,
+        trafile,
+        days,
+        data_split,
+        randomize,
+        total_per_file,
+        np.sum(total_per_file),
+        memory_map,
+        o_filename,
+        intermediate_format,
+        shuffle_mem_gb
+    )
+
+
+def binaryIndexFile(bin_file):
+    # sidecar of a binary file with the row offsets of its input files
+    return path.splitext(bin_file)[0] + "_index.npz"
+
+
+def criteoBinStage(input_files, output_file, split, num_workers=1):
+    # Converts reordered days into a binary file read by CriteoBinDataset
+    # (imported here, data_loader_terabyte requires torch).
+    import data_loader_terabyte
+    data_loader_terabyte.numpy_to_binary(
+        input_files=input_files, output_file_path=output_file, split=split,
+        num_workers=num_workers
+    )
+
+
+def criteoBinStages(npzfile, days, bin_prefix, intermediate_format="npz", num_workers=1):
+    # Stages converting the reordered days into <bin_prefix>_{train,val,test}.bin
+    # (and their index files), all but the last day are used for training, the
+    # last day is split into test and validation. The training days are
+    # converted by num_workers processes.
+    stages = []
+    reordered = [npzfile + "_{0}_reordered.npz".format(i) for i in range(days)]
+    for split in ["train", "val", "test"]:
+        input_files = reordered[:-1] if split == "train" else reordered[-1:]
+        output_file = bin_prefix + "_{0}.bin".format(split)
+        stages.append(Stage(
+            "bin_" + split,
+            criteoBinStage,
+            args=(input_files, output_file, split, num_workers if split == "train" else 1),
+            inputs=[arraysPath(f, intermediate_format) for f in input_files],
+            outputs=[output_file, binaryIndexFile(output_file)],
+        ))
+    return stages
+
+
 def getCriteoAdData(
         datafile,
         o_filename,
@@ -883,14 +1853,43 @@ def getCriteoAdData(
         randomize='total',
         criteo_kaggle=True,
         memory_map=False,
-        dataset_multiprocessing=False
+        dataset_multiprocessing=False,
+        renumber_by_freq=False,
+        intermediate_format="npz",
+        bin_prefix="",
+        profile_argv=None,
+        profile_outputs=(),
+        shuffle_mem_gb=16.0,
+        precompute_features=False
 ):
     # Passes through entire dataset and defines dictionaries for categorical
     # features and determines the number of total categories.
     #
+    # The preprocessing is a pipeline of stages (see preprocess_manifest.py):
+    #   split (Kaggle) -> parse_i -> dictionary -> remap_i -> shuffle or
+    #   concatenate -> bin_{train,val,test} (optional) -> profile (optional)
+    # with a manifest per stage under <d_file>_manifest. Only the stages whose
+    # inputs, parameters or outputs have changed since their last completion
+    # are run again, so an interrupted run resumes where it stopped. With
+    # dataset_multiprocessing independent stages (e.g. the days) run in
+    # parallel processes, otherwise the chunks of each day do.
+    #
     # Inputs:
     #    datafile : path to downloaded raw data file
     #    o_filename (str): saves results under o_filename if filename is not ""
+    #    renumber_by_freq (bool): renumber the categories of every table by
+    #                             descending frequency (see criteoDictStage)
+    #    intermediate_format (str): format of the parsed, processed and reordered
+    #                               day files, "npz" (compressed) or "npy" (raw)
+    #    bin_prefix (str): also convert the reordered days (memory_map) into
+    #                      <bin_prefix>_{train,val,test}.bin if not ""
+    #    profile_argv (list): command (e.g. FAE profiler) run on the result
+    #                         as the last stage if not None
+    #    profile_outputs (list): files written by the profile_argv command
+    #    shuffle_mem_gb (float): memory budget of the shuffle (memory_map) in GB
+    #    precompute_features (bool): store the dense features log-transformed
+    #                                and the categorical features in the
+    #                                narrowest type (see precomputeFeatures)
     #
     # Output:
     #   o_file (str): output file path
@@ -901,306 +1900,145 @@ def getCriteoAdData(
     d_file = lstr[-1].split(".")[0] if criteo_kaggle else lstr[-1]
     npzfile = d_path + ((d_file + "_day") if criteo_kaggle else d_file)
     trafile = d_path + ((d_file + "_fea") if criteo_kaggle else "fea")
+    manifest_dir = criteoManifestDir(d_path, d_file)
 
-    # count number of datapoints in training set
-    total_file = d_path + d_file + "_day_count.npz"
-    if path.exists(total_file):
-        with np.load(total_file) as data:
-            total_per_file = list(data["total_per_file"])
-        total_count = np.sum(total_per_file)
-        print("Skipping counts per file (already exist)")
+    # raw data (text files, a day per file)
+    if criteo_kaggle:
+        day_files = [npzfile + "_{0}".format(i) for i in range(days)]
+        if not path.exists(datafile) and not path.isdir(manifest_dir):
+            sys.exit("ERROR: Criteo Kaggle Display Ad Challenge Dataset path is invalid; please download from https://labs.criteo.com/2014/02/kaggle-display-advertising-challenge-dataset")
     else:
-        total_count = 0
-        total_per_file = []
-        if criteo_kaggle:
-            # WARNING: The raw data consists of a single train.txt file
-            # Each line in the file is a sample, consisting of 13 continuous and
-            # 26 categorical features (an extra space indicates that feature is
-            # missing and will be interpreted as 0).
-            if path.exists(datafile):
-                print("Reading data from path=%s" % (datafile))
-                with open(str(datafile)) as f:
-                    for _ in f:
-                        total_count += 1
-                total_per_file.append(total_count)
-                # reset total per file due to split
-                num_data_per_split, extras = divmod(total_count, days)
-                total_per_file = [num_data_per_split] * days
-                for j in range(extras):
-                    total_per_file[j] += 1
-                # split into days (simplifies code later on)
-                file_id = 0
-                boundary = total_per_file[file_id]
-                nf = open(npzfile + "_" + str(file_id), "w")
-                with open(str(datafile)) as f:
-                    for j, line in enumerate(f):
-                        if j == boundary:
-                            nf.close()
-                            file_id += 1
-                            nf = open(npzfile + "_" + str(file_id), "w")
-                            boundary += total_per_file[file_id]
-                        nf.write(line)
-                nf.close()
-            else:
-                sys.exit("ERROR: Criteo Kaggle Display Ad Challenge Dataset path is invalid; please download from https://labs.criteo.com/2014/02/kaggle-display-advertising-challenge-dataset")
-        else:
-            # WARNING: The raw data consist of day_0.gz,... ,day_23.gz text files
-            # Each line in the file is a sample, consisting of 13 continuous and
-            # 26 categorical features (an extra space indicates that feature is
-            # missing and will be interpreted as 0).
-            for i in range(days):
-                datafile_i = datafile + "_" + str(i)  # + ".gz"
-                if path.exists(str(datafile_i)):
-                    print("Reading data from path=%s" % (str(datafile_i)))
-                    # file day_<number>
-                    total_per_file_count = 0
-                    with open(str(datafile_i)) as f:
-                        for _ in f:
-                            total_per_file_count += 1
-                    total_per_file.append(total_per_file_count)
-                    total_count += total_per_file_count
-                else:
-                    sys.exit("ERROR: Criteo Terabyte Dataset path is invalid; please download from https://labs.criteo.com/2013/12/download-terabyte-click-logs")
-
-    # process a file worth of data and reinitialize data
-    # note that a file main contain a single or multiple splits
-    def process_one_file(
-            datfile,
-            npzfile,
-            split,
-            num_data_in_split,
-            dataset_multiprocessing,
-            convertDictsDay=None,
-            resultDay=None
-    ):
-        if dataset_multiprocessing:
-            convertDicts_day = [{} for _ in range(26)]
-
-        with open(str(datfile)) as f:
-            y = np.zeros(num_data_in_split, dtype="i4")  # 4 byte int
-            X_int = np.zeros((num_data_in_split, 13), dtype="i4")  # 4 byte int
-            X_cat = np.zeros((num_data_in_split, 26), dtype="i4")  # 4 byte int
-            if sub_sample_rate == 0.0:
-                rand_u = 1.0
-            else:
-                rand_u = np.random.uniform(low=0.0, high=1.0, size=num_data_in_split)
-
-            i = 0
-            percent = 0
-            for k, line in enumerate(f):
-                # process a line (data point)
-                line = line.split('\t')
-                # set missing values to zero
-                for j in range(len(line)):
-                    if (line[j] == '') or (line[j] == '\n'):
-                        line[j] = '0'
-                # sub-sample data by dropping zero targets, if needed
-                target = np.int32(line[0])
-                if target == 0 and \
-                   (rand_u if sub_sample_rate == 0.0 else rand_u[k]) < sub_sample_rate:
-                    continue
-
-                y[i] = target
-                X_int[i] = np.array(line[1:14], dtype=np.int32)
-                if max_ind_range > 0:
-                    X_cat[i] = np.array(
-                        list(map(lambda x: int(x, 16) % max_ind_range, line[14:])),
-                        dtype=np.int32
-                    )
-                else:
-                    X_cat[i] = np.array(
-                        list(map(lambda x: int(x, 16), line[14:])),
-                        dtype=np.int32
-                    )
-
-                # count uniques
-                if dataset_multiprocessing:
-                    for j in range(26):
-                        convertDicts_day[j][X_cat[i][j]] = 1
-                    # debug prints
-                    if float(i)/num_data_in_split*100 > percent+1:
-                        percent = int(float(i)/num_data_in_split*100)
-                        print(
-                            "Load %d/%d (%d%%) Split: %d  Label True: %d  Stored: %d"
-                            % (
-                                i,
-                                num_data_in_split,
-                                percent,
-                                split,
-                                target,
-                                y[i],
-                            ),
-                            end="\n",
-                        )
-                else:
-                    for j in range(26):
-                        convertDicts[j][X_cat[i][j]] = 1
-                    # debug prints
-                    print(
-                        "Load %d/%d  Split: %d  Label True: %d  Stored: %d"
-                        % (
-                            i,
-                            num_data_in_split,
-                            split,
-                            target,
-                            y[i],
-                        ),
-                        end="\r",
-                    )
-                i += 1
-
-            # store num_data_in_split samples or extras at the end of file
-            # count uniques
-            # X_cat_t  = np.transpose(X_cat)
-            # for j in range(26):
-            #     for x in X_cat_t[j,:]:
-            #         convertDicts[j][x] = 1
-            # store parsed
-            filename_s = npzfile + "_{0}.npz".format(split)
-            if path.exists(filename_s):
-                print("\nSkip existing " + filename_s)
-            else:
-                np.savez_compressed(
-                    filename_s,
-                    X_int=X_int[0:i, :],
-                    # X_cat=X_cat[0:i, :],
-                    X_cat_t=np.transpose(X_cat[0:i, :]),  # transpose of the data
-                    y=y[0:i],
-                )
-                print("\nSaved " + npzfile + "_{0}.npz!".format(split))
-
-        if dataset_multiprocessing:
-            resultDay[split] = i
-            convertDictsDay[split] = convertDicts_day
-            return
-        else:
-            return i
-
-    # create all splits (reuse existing files if possible)
-    recreate_flag = False
-    convertDicts = [{} for _ in range(26)]
-    # WARNING: to get reproducable sub-sampling results you must reset the seed below
-    # np.random.seed(123)
-    # in this case there is a single split in each day
+        # WARNING: The raw data consist of day_0.gz,... ,day_23.gz text files
+        # Each line in the file is a sample, consisting of 13 continuous and
+        # 26 categorical features (an extra space indicates that feature is
+        # missing and will be interpreted as 0).
+        day_files = [datafile + "_" + str(i) for i in range(days)]  # + ".gz"
+        for datafile_i in day_files:
+            if not path.exists(str(datafile_i)) and not path.isdir(manifest_dir):
+                sys.exit("ERROR: Criteo Terabyte Dataset path is invalid; please download from https://labs.criteo.com/2013/12/download-terabyte-click-logs")
+
+    pipeline = Pipeline(
+        manifest_dir, min(days, cpu_count()) if dataset_multiprocessing else 1
+    )
+    if criteo_kaggle:
+        pipeline.add(Stage(
+            "split",
+            criteoSplitStage,
+            args=(datafile, npzfile, days),
+            inputs=[datafile],
+            outputs=day_files,
+            params={"days": days},
+        ))
+
+    # map: every day emits its sorted unique values and counts
+    # (the seeds are fixed to get reproducible sub-sampling results)
+    seeds = np.random.RandomState(123).randint(0, 2 ** 31 - 1, size=days)
+    parsed = [npzfile + "_{0}.npz".format(i) for i in range(days)]
+    uniques_files = [npzfile + "_{0}_uniques.npz".format(i) for i in range(days)]
     for i in range(days):
-        npzfile_i = npzfile + "_{0}.npz".format(i)
-        npzfile_p = npzfile + "_{0}_processed.npz".format(i)
-        if path.exists(npzfile_i):
-            print("Skip existing " + npzfile_i)
-        elif path.exists(npzfile_p):
-            print("Skip existing " + npzfile_p)
-        else:
-            recreate_flag = True
-
-    if recreate_flag:
-        if dataset_multiprocessing:
-            resultDay = Manager().dict()
-            convertDictsDay = Manager().dict()
-            processes = [Process(target=process_one_file,
-                                 name="process_one_file:%i" % i,
-                                 args=(npzfile + "_{0}".format(i),
-                                       npzfile,
-                                       i,
-                                       total_per_file[i],
-                                       dataset_multiprocessing,
-                                       convertDictsDay,
-                                       resultDay,
-                                       )
-                                 ) for i in range(0, days)]
-            for process in processes:
-                process.start()
-            for process in processes:
-                process.join()
-            for day in range(days):
-                total_per_file[day] = resultDay[day]
-                print("Constructing convertDicts Split: {}".format(day))
-                convertDicts_tmp = convertDictsDay[day]
-                for i in range(26):
-                    for j in convertDicts_tmp[i]:
-                        convertDicts[i][j] = 1
-        else:
-            for i in range(days):
-                total_per_file[i] = process_one_file(
-                    npzfile + "_{0}".format(i),
-                    npzfile,
-                    i,
-                    total_per_file[i],
-                    dataset_multiprocessing,
-                )
-
-    # report and save total into a file
-    total_count = np.sum(total_per_file)
-    if not path.exists(total_file):
-        np.savez_compressed(total_file, total_per_file=total_per_file)
-    print("Total number of samples:", total_count)
-    print("Divided into days/splits:\n", total_per_file)
-
-    # dictionary files
-    counts = np.zeros(26, dtype=np.int32)
-    if recreate_flag:
-        # create dictionaries
-        for j in range(26):
-            for i, x in enumerate(convertDicts[j]):
-                convertDicts[j][x] = i
-            dict_file_j = d_path + d_file + "_fea_dict_{0}.npz".format(j)
-            if not path.exists(dict_file_j):
-                np.savez_compressed(
-                    dict_file_j,
-                    unique=np.array(list(convertDicts[j]), dtype=np.int32)
-                )
-            counts[j] = len(convertDicts[j])
-        # store (uniques and) counts
-        count_file = d_path + d_file + "_fea_count.npz"
-        if not path.exists(count_file):
-            np.savez_compressed(count_file, counts=counts)
-    else:
-        # create dictionaries (from existing files)
-        for j in range(26):
-            with np.load(d_path + d_file + "_fea_dict_{0}.npz".format(j)) as data:
-                unique = data["unique"]
-            for i, x in enumerate(unique):
-                convertDicts[j][x] = i
-        # load (uniques and) counts
-        with np.load(d_path + d_file + "_fea_count.npz") as data:
-            counts = data["counts"]
+        pipeline.add(Stage(
+            "parse_{0}".format(i),
+            criteoParseStage,
+            args=(day_files[i], npzfile, i, max_ind_range, sub_sample_rate, seeds[i],
+                  1 if dataset_multiprocessing else cpu_count(), intermediate_format),
+            inputs=[day_files[i]],
+            outputs=[arraysPath(parsed[i], intermediate_format), uniques_files[i]],
+            params={"max_ind_range": max_ind_range, "sub_sample_rate": sub_sample_rate,
+                    "seed": int(seeds[i])},
+        ))
+
+    # reduce: dictionaries, counts and (optionally) the renumbering
+    dict_files = [d_path + d_file + "_fea_dict_{0}.npz".format(j) for j in range(26)]
+    count_file = d_path + d_file + "_fea_count.npz"
+    total_file = d_path + d_file + "_day_count.npz"
+    dict_outputs = dict_files + [count_file, total_file]
+    if renumber_by_freq:
+        dict_outputs.append(d_path + d_file + "_fea_freq_map.npz")
+    pipeline.add(Stage(
+        "dictionary",
+        criteoDictStage,
+        args=(d_path, d_file, npzfile, days, renumber_by_freq),
+        inputs=uniques_files,
+        outputs=dict_outputs,
+        params={"renumber_by_freq": renumber_by_freq},
+    ))
 
     # process all splits
-    if dataset_multiprocessing:
-        processes = [Process(target=processCriteoAdData,
-                           name="processCriteoAdData:%i" % i,
-                           args=(d_path,
-                                 d_file,
-                                 npzfile,
-                                 i,
-                                 convertDicts,
-                                 counts,
-                                 )
-                           ) for i in range (0, days)]
-        for process in processes:
-            process.start()
-        for process in processes:
-            process.join()
+    processed = [npzfile + "_{0}_processed.npz".format(i) for i in range(days)]
+    for i in range(days):
+        pipeline.add(Stage(
+            "remap_{0}".format(i),
+            criteoRemapStage,
+            args=(d_path, d_file, npzfile, i, intermediate_format, precompute_features),
+            inputs=[arraysPath(parsed[i], intermediate_format)] + dict_files + [count_file],
+            outputs=[arraysPath(processed[i], intermediate_format)],
+            # (no parameter by default, the manifests of earlier runs stay valid)
+            params={"precompute_features": True} if precompute_features else None,
+        ))
+
+    o_file = d_path + o_filename + ".npz"
+    reordered = [npzfile + "_{0}_reordered.npz".format(i) for i in range(days)]
+    if memory_map:
+        pipeline.add(Stage(
+            "shuffle",
+            criteoConcatStage,
+            args=(d_path, d_file, npzfile, trafile, days, data_split, randomize,
+                  memory_map, o_filename, intermediate_format, shuffle_mem_gb),
+            inputs=[arraysPath(f, intermediate_format) for f in processed] + [total_file],
+            outputs=[arraysPath(f, intermediate_format) for f in reordered],
+            # only "none" changes the split (the last day is held out otherwise)
+            params={"randomize": randomize, "split_none": data_split == "none"},
+        ))
+        if bin_prefix != "":
+            for stage in criteoBinStages(
+                    npzfile, days, bin_prefix, intermediate_format,
+                    min(days, cpu_count()) if dataset_multiprocessing else 1
+            ):
+                pipeline.add(stage)
+        results = [arraysPath(f, intermediate_format) for f in reordered]
     else:
-        for i in range(days):
-            processCriteoAdData(d_path, d_file, npzfile, i, convertDicts, counts)
-
-    o_file = concatCriteoAdData(
-        d_path,
-        d_file,
-        npzfile,
-        trafile,
-        days,
-        data_split,
-        randomize,
-        total_per_file,
-        total_count,
-        memory_map,
-        o_filename
-    )
+        pipeline.add(Stage(
+            "concatenate",
+            criteoConcatStage,
+            args=(d_path, d_file, npzfile, trafile, days, data_split, randomize,
+                  memory_map, o_filename, intermediate_format),
+            inputs=[arraysPath(f, intermediate_format) for f in processed]
+            + [total_file, count_file],
+            outputs=[o_file],
+        ))
+        results = [o_file]
+
+    # optional profiling of the preprocessed data
+    if profile_argv:
+        pipeline.add(Stage(
+            "profile",
+            run_command,
+            args=(profile_argv,),
+            inputs=results,
+            outputs=profile_outputs,
+            params={"argv": list(profile_argv)},
+        ))
+
+    pipeline.run()
 
     return o_file
 
 
+def convertCriteoToBinary(npzfile, days, bin_prefix, manifest_dir):
+    # Converts the reordered days into <bin_prefix>_{train,val,test}.bin
+    # (skipped if they are up to date), the splits and the training days are
+    # converted in parallel.
+    intermediate_format = "npy" if path.isdir(
+        npyDirName(npzfile + "_{0}_reordered.npz".format(days - 1))
+    ) else "npz"
+    pipeline = Pipeline(manifest_dir, 3)
+    for stage in criteoBinStages(
+            npzfile, days, bin_prefix, intermediate_format, min(days, cpu_count())
+    ):
+        pipeline.add(stage)
+    pipeline.run()
+
+
 def loadDataset(
         dataset,
         max_ind_range,
@@ -1209,7 +2047,15 @@ def loadDataset(
         data_split,
         raw_path="",
         pro_data="",
-        memory_map=False
+        memory_map=False,
+        renumber_by_freq=False,
+        intermediate_format="npz",
+        dataset_multiprocessing=False,
+        bin_prefix="",
+        profile_argv=None,
+        profile_outputs=(),
+        shuffle_mem_gb=16.0,
+        precompute_features=False
 ):
     # dataset
     if dataset == "kaggle":
@@ -1233,15 +2079,16 @@ def loadDataset(
     if memory_map:
         for i in range(days):
             reo_data = d_path + npzfile + "_{0}_reordered.npz".format(i)
-            if not path.exists(str(reo_data)):
+            if not existsArrays(str(reo_data)):
                 data_ready = False
     else:
         if not path.exists(str(pro_data)):
             data_ready = False
 
-    # pre-process data if needed
+    # pre-process data if needed (data with manifests is checked and the
+    # stale stages are run again)
     # WARNNING: when memory mapping is used we get a collection of files
-    if data_ready:
+    if data_ready and not path.isdir(criteoManifestDir(d_path, d_file)):
         print("Reading pre-processed data=%s" % (str(pro_data)))
         file = str(pro_data)
     else:
@@ -1255,7 +2102,15 @@ def loadDataset(
             data_split,
             randomize,
             dataset == "kaggle",
-            memory_map
+            memory_map,
+            dataset_multiprocessing,
+            renumber_by_freq=renumber_by_freq,
+            intermediate_format=intermediate_format,
+            bin_prefix=bin_prefix,
+            profile_argv=profile_argv,
+            profile_outputs=profile_outputs,
+            shuffle_mem_gb=shuffle_mem_gb,
+            precompute_features=precompute_features
         )
 
     return file, days
@@ -1264,6 +2119,7 @@ def loadDataset(
 if __name__ == "__main__":
     ### import packages ###
     import argparse
+    import shlex
 
     ### parse arguments ###
     parser = argparse.ArgumentParser(
@@ -1274,6 +2130,18 @@ if __name__ == "__main__":
     parser.add_argument("--data-sub-sample-rate", type=float, default=0.0)  # in [0, 1]
     parser.add_argument("--data-randomize", type=str, default="total")  # or day or none
     parser.add_argument("--memory-map", action="store_true", default=False)
+    parser.add_argument("--renumber-by-freq", action="store_true", default=False)
+    parser.add_argument("--intermediate-format", type=str, default="npz")  # or npy
+    parser.add_argument("--dataset-multiprocessing", action="store_true", default=False)
+    parser.add_argument("--shuffle-mem-gb", type=float, default=16.0)  # --memory-map
+    # store log(x + 1) of the dense and the narrowest type of the sparse features
+    parser.add_argument("--precompute-features", action="store_true", default=False)
+    # convert the reordered days (--memory-map) into <prefix>_{train,val,test}.bin
+    parser.add_argument("--bin-prefix", type=str, default="")
+    # command profiling the preprocessed data (e.g. "python dlrm_input_profiler.py
+    # ...") and the files it writes, run as the last stage of the pipeline
+    parser.add_argument("--profile-cmd", type=str, default="")
+    parser.add_argument("--profile-outputs", type=str, default="")  # comma separated
     parser.add_argument("--data-set", type=str, default="kaggle")  # or terabyte
     parser.add_argument("--raw-data-file", type=str, default="")
     parser.add_argument("--processed-data-file", type=str, default="")
@@ -1287,5 +2155,13 @@ if __name__ == "__main__":
         "train",
         args.raw_data_file,
         args.processed_data_file,
-        args.memory_map
+        args.memory_map,
+        args.renumber_by_freq,
+        args.intermediate_format,
+        args.dataset_multiprocessing,
+        args.bin_prefix,
+        shlex.split(args.profile_cmd) if args.profile_cmd else None,
+        [f for f in args.profile_outputs.split(",") if f],
+        args.shuffle_mem_gb,
+        args.precompute_features
     )
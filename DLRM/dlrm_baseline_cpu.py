@@ -62,6 +62,10 @@ import time
 import json
 # data generation
 import dlrm_data_pytorch as dp
+# cpu core partitioning
+import cpu_partition
+# hogwild multithreaded training
+import cpu_hogwild
 
 # numpy
 import numpy as np
@@ -452,6 +456,16 @@ if __name__ == "__main__":
 						with more than 7 CPU cores and more than 20 GB of memory. \n \
 						The Terabyte dataset can be multiprocessed in an environment \
 						with more than 24 CPU cores and at least 1 TB of memory.")
+	# categories renumbered by descending frequency (hot rows first)
+	parser.add_argument("--data-renumber-by-freq", action="store_true", default=False)
+	# format of the pre-processed day files: npz (compressed) or npy (raw, can be memory-mapped)
+	parser.add_argument("--data-intermediate-format", type=str, choices=["npz", "npy"], default="npz")
+	# memory budget (GB) of the shuffle across days when pre-processing with --memory-map
+	parser.add_argument("--data-shuffle-mem-gb", type=float, default=16.0)
+	# store log(x + 1) of the dense and the narrowest type of the sparse features
+	parser.add_argument("--data-precompute-features", action="store_true", default=False)
+	# cache of the collated batches, replayed by later epochs and runs ("": none)
+	parser.add_argument("--batch-cache-dir", type=str, default="")
 	# training
 	parser.add_argument("--mini-batch-size", type=int, default=1)
 	parser.add_argument("--nepochs", type=int, default=1)
@@ -465,6 +479,19 @@ if __name__ == "__main__":
 	parser.add_argument("--save-onnx", action="store_true", default=False)
 	# gpu
 	parser.add_argument("--use-gpu", action="store_true", default=False)
+	# cpu core partitioning (embedding vs mlp work), cores given as a cpulist
+	# e.g. --emb-cores=0-13 --mlp-cores=14-27
+	parser.add_argument("--emb-cores", type=str, default="")
+	parser.add_argument("--mlp-cores", type=str, default="")
+	parser.add_argument("--emb-threads", type=int, default=-1)
+	parser.add_argument("--mlp-threads", type=int, default=-1)
+	parser.add_argument("--num-micro-batches", type=int, default=2)
+	# hogwild: worker threads train on shards of the batches, embedding
+	# updates are lock-free, mlp updates are locked (lock) or averaged (average)
+	parser.add_argument("--hogwild-workers", type=int, default=0)
+	parser.add_argument("--hogwild-cores", type=str, default="")
+	parser.add_argument("--hogwild-dense", type=str, default="lock")
+	parser.add_argument("--hogwild-sync-freq", type=int, default=1)
 	# debugging and profiling
 	parser.add_argument("--print-freq", type=int, default=1)
 	parser.add_argument("--test-freq", type=int, default=-1)
@@ -485,6 +512,9 @@ if __name__ == "__main__":
 	parser.add_argument("--mlperf-auc-threshold", type=float, default=0.0)
 	parser.add_argument("--mlperf-bin-loader", action='store_true', default=False)
 	parser.add_argument("--mlperf-bin-shuffle", action='store_true', default=False)
+	# shuffle the samples within windows of batches (0: whole batches only)
+	parser.add_argument("--mlperf-bin-shuffle-window", type=int, default=0)
+	parser.add_argument("--mlperf-bin-read-ahead", action='store_true', default=False)
 	# LR policy
 	parser.add_argument("--lr-num-warmup-steps", type=int, default=0)
 	parser.add_argument("--lr-decay-start-step", type=int, default=0)
@@ -712,6 +742,28 @@ if __name__ == "__main__":
 		lr_scheduler = LRPolicyScheduler(optimizer, args.lr_num_warmup_steps, args.lr_decay_start_step,
 										 args.lr_num_decay_steps)
 
+	# run embedding and mlp work on separate (pinned) worker pools if requested
+	partition = None
+	if args.emb_cores != "" and args.mlp_cores != "" and args.hogwild_workers == 0:
+		partition = cpu_partition.PartitionedTrainer(
+			cpu_partition.parse_core_list(args.emb_cores),
+			cpu_partition.parse_core_list(args.mlp_cores),
+			emb_threads=args.emb_threads,
+			mlp_threads=args.mlp_threads,
+			num_micro_batches=args.num_micro_batches,
+		)
+
+	# or train on several hogwild worker threads
+	hogwild = None
+	if args.hogwild_workers > 0 and not args.inference_only:
+		hogwild = cpu_hogwild.HogwildTrainer(
+			dlrm,
+			args.hogwild_workers,
+			cpu_partition.parse_core_list(args.hogwild_cores),
+			dense=args.hogwild_dense,
+			sync_freq=args.hogwild_sync_freq,
+		)
+
 	### main loop ###
 	def time_wrap(use_gpu):
 		return time.time()
@@ -803,7 +855,16 @@ if __name__ == "__main__":
 			if args.mlperf_logging:
 				previous_iteration_time = None
 
-			for j, (X, lS_o, lS_i, T) in enumerate(train_ld):
+			train_iter = train_ld
+			if hogwild is not None:
+				# the batches are trained by the workers, in completion order
+				train_iter = hogwild.train(
+					train_ld, nbatches,
+					lambda Z, T: loss_fn_wrap(Z, T, use_gpu, device),
+					optimizer
+				)
+
+			for j, (X, lS_o, lS_i, T) in enumerate(train_iter):
 				if j == 0 and args.save_onnx:
 					(X_onnx, lS_o_onnx, lS_i_onnx) = (X, lS_o, lS_i)
 
@@ -836,12 +897,24 @@ if __name__ == "__main__":
 				# forward pass
 				begin_forward = time_wrap(use_gpu)
 
-				Z = dlrm_wrap(X, lS_o, lS_i, use_gpu, device)
+				if hogwild is not None:
+					# forward, backward and update already ran on a worker
+					Z, E = hogwild.last_output
+				elif partition is not None:
+					# forward, backward and update are pipelined across the pools
+					Z, E = partition.train_step(
+						dlrm, X, lS_o, lS_i, T,
+						lambda Z, T: loss_fn_wrap(Z, T, use_gpu, device),
+						None if args.inference_only else optimizer
+					)
+				else:
+					Z = dlrm_wrap(X, lS_o, lS_i, use_gpu, device)
 
 				end_forward = time_wrap(use_gpu)
 
 				# loss
-				E = loss_fn_wrap(Z, T, use_gpu, device)
+				if partition is None and hogwild is None:
+					E = loss_fn_wrap(Z, T, use_gpu, device)
 				'''
 				# debug prints
 				print("output and loss")
@@ -855,7 +928,15 @@ if __name__ == "__main__":
 				mbs = T.shape[0]  # = args.mini_batch_size except maybe for last
 				A = np.sum((np.round(S, 0) == T).astype(np.uint8))
 
-				if not args.inference_only:
+				if not args.inference_only and (partition is not None or hogwild is not None):
+					# backward and optimizer already ran inside train_step (or on a worker)
+					end_backward = end_forward
+					end_optimizing = end_forward
+
+					lr_scheduler.step()
+
+					end_scheduling = time_wrap(use_gpu)
+				elif not args.inference_only:
 					# scaled error gradient propagation
 					# (where we do not accumulate gradients across mini-batches)
 					optimizer.zero_grad()
@@ -929,6 +1010,8 @@ if __name__ == "__main__":
 					print("Iteration_time ", gT)
 					print("Loss ", gL)
 					print("Accuracy ", gA*100)
+					if partition is not None:
+						partition.report()
 					print("\n")
 
 					
@@ -1120,6 +1203,11 @@ if __name__ == "__main__":
 
 			k += 1  # nepochs
 
+	if partition is not None:
+		partition.shutdown()
+	if hogwild is not None:
+		hogwild.shutdown()
+
 	# profiling
 	if args.enable_profiling:
 		with open("dlrm_s_pytorch.prof", "w") as prof_f:
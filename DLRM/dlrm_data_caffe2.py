@@ -445,6 +445,89 @@ def trace_generate_rand(
     return ztrace
 
 
+def trace_stack_distances(trace):
+    # Stack distances of a trace in O(n log n) (trace_profile moves every
+    # reference within a Python list, O(n^2)). The distance of an access at
+    # time t to a reference last accessed at time p is the number of distinct
+    # references accessed in [p, t): the t - p accesses minus those that are
+    # no longer the last access of their reference. The latter are counted
+    # with a Fenwick tree over the times, a time is added to it when its
+    # reference is accessed again.
+    #
+    # Inputs:
+    #   trace (array-like): memory references
+    #
+    # Outputs (numpy arrays, in time order):
+    #   refs (np.uint64): line references of the accesses
+    #   sd (np.int64): stack distance of every access (0: new reference)
+    #   prev (np.int64): time of the previous access to the reference (-1: none)
+    refs = np.asarray(trace).astype(np.uint64).reshape(-1) // np.uint64(cache_line_size)
+    n = len(refs)
+    # previous access of every reference (the accesses of a reference are
+    # consecutive in a stable sort)
+    _, inverse = np.unique(refs, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind="stable")
+    same = inverse[order[1:]] == inverse[order[:-1]]
+    prev = np.full(n, -1, dtype=np.int64)
+    prev[order[1:][same]] = order[:-1][same]
+
+    sd = np.zeros(n, dtype=np.int64)
+    tree = [0] * (n + 1)  # 1-based, counts of the replaced times
+    replaced = 0
+    for t, p in zip(np.flatnonzero(prev >= 0).tolist(), prev[prev >= 0].tolist()):
+        # replaced times before p
+        q = 0
+        i = p
+        while i > 0:
+            q += tree[i]
+            i &= i - 1
+        # all the replaced times are before t
+        sd[t] = t - p - (replaced - q)
+        # p is replaced by t
+        i = p + 1
+        while i <= n:
+            tree[i] += 1
+            i += i & -i
+        replaced += 1
+
+    return refs, sd, prev
+
+
+def stack_distance_histogram(stack_distances):
+    # distinct stack distances and their cumulative distribution, the
+    # (list_sd, cumm_sd) of the distribution files
+    list_sd, counts = np.unique(np.asarray(stack_distances, dtype=np.int64), return_counts=True)
+    cumm_sd = np.cumsum(counts) / float(max(len(stack_distances), 1))
+    return list_sd.tolist(), cumm_sd.tolist()
+
+
+def trace_profile(trace, enable_padding=False):
+    # LRU stack, stack distances and new references of a trace, as the lists
+    # of the list based version below: the stack from the least to the most
+    # recently accessed reference, the stack distances and the new references
+    # in reverse time order
+    refs, sd, prev = trace_stack_distances(trace)
+
+    # the last access of every reference, by time
+    last = np.ones(len(refs), dtype=bool)
+    last[prev[prev >= 0]] = False
+    rstack = refs[last].tolist()
+    stack_distances = sd[::-1].tolist()
+    line_accesses = refs[prev < 0][::-1].tolist()
+
+    if enable_padding and len(stack_distances) > 0:
+        # WARNING: see the list based version below
+        l = len(stack_distances)
+        c = max(stack_distances)
+        padding = int(np.ceil(l / c))
+        stack_distances = stack_distances + [0] * padding
+
+    return (rstack, stack_distances, line_accesses)
+
+
+'''
+# list based version, O(n^2)
 def trace_profile(trace, enable_padding=False):
     # number of elements in the array (assuming 1D)
     # n = trace.size
@@ -491,9 +574,40 @@ def trace_profile(trace, enable_padding=False):
         stack_distances = stack_distances + [0] * padding
 
     return (rstack, stack_distances, line_accesses)
+'''
 
 
 # auxiliary read/write routines
+def read_trace_from_file(file_path, binary_type=False):
+    # references of a trace file as a np.uint64 array: memory-mapped for the
+    # files with a header (see data_utils.writeTraceFile), otherwise a raw
+    # binary array (binary_type) or a text line of comma separated references
+    try:
+        if data_utils.isTraceFile(file_path):
+            return data_utils.loadTraceFile(file_path)[1]
+        if binary_type:
+            return np.fromfile(file_path, dtype=np.uint64)
+        with open(file_path) as f:
+            return np.fromstring(f.readline(), dtype=np.uint64, sep=",")
+    except Exception:
+        print("ERROR: no input trace file has been provided")
+
+
+def write_trace_to_file(file_path, trace, binary_type=False, table=-1):
+    # binary_type writes a file with a header (data_utils.writeTraceFile),
+    # otherwise a text line
+    try:
+        if binary_type:
+            data_utils.writeTraceFile(file_path, trace, table, cache_line_size)
+        else:
+            with open(file_path, "w+") as f:
+                f.write(", ".join(map(str, np.asarray(trace).astype(np.uint64).tolist())))
+    except Exception:
+        print("ERROR: no output trace file has been provided")
+
+
+'''
+# list based, with the global args of the __main__ below
 def read_trace_from_file(file_path):
     try:
         with open(file_path) as f:
@@ -519,6 +633,7 @@ def write_trace_to_file(file_path, trace):
                 f.write(s[1 : len(s) - 1])
     except Exception:
         print("ERROR: no output trace file has been provided")
+'''
 
 
 def read_dist_from_file(file_path):
@@ -575,7 +690,7 @@ if __name__ == "__main__":
     np.set_printoptions(precision=args.print_precision)
 
     ### read trace ###
-    trace = read_trace_from_file(args.trace_file)
+    trace = read_trace_from_file(args.trace_file, args.trace_file_binary_type)
     # print(trace)
 
     ### profile trace ###
@@ -588,6 +703,8 @@ if __name__ == "__main__":
     # print(stack_distances)
 
     ### compute probability distribution ###
+    list_sd, cumm_sd = stack_distance_histogram(stack_distances)
+    '''
     # count items
     l = len(stack_distances)
     dc = sorted(
@@ -606,6 +723,7 @@ if __name__ == "__main__":
         else:
             # add the 2nd element of the i-th tuple in the dist_sd list
             cumm_sd.append(cumm_sd[i - 1] + (k / float(l)))
+    '''
 
     ### write stack_distance and line_accesses to a file ###
     write_dist_to_file(args.dist_file, line_accesses, list_sd, cumm_sd)
@@ -618,4 +736,6 @@ if __name__ == "__main__":
     # synthetic_trace = trace_generate_rand(
     #     line_accesses, list_sd, cumm_sd, len(trace), args.trace_enable_padding
     # )
-    write_trace_to_file(args.synthetic_file, synthetic_trace)
+    write_trace_to_file(
+        args.synthetic_file, synthetic_trace, args.trace_file_binary_type
+    )
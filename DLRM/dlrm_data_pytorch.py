@@ -19,11 +19,17 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 # others
+import os
 from os import path
 import bisect
 import collections
+import mmap
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import data_utils
+import batch_cache
+import shared_dataset
 
 # numpy
 import numpy as np
@@ -32,11 +38,122 @@ from numpy import random as ra
 
 # pytorch
 import torch
-from torch.utils.data import Dataset, RandomSampler
+from torch.utils.data import Dataset, RandomSampler, SequentialSampler, BatchSampler
+from torch.utils.data.distributed import DistributedSampler
 
 import data_loader_terabyte
 
 
+class CriteoDayFiles:
+    # Access to the reordered day files of a memory-mapped CriteoDataset.
+    # A global sample index is resolved to (day, offset) with searchsorted over
+    # offset_per_file, so that any access order works (workers, shuffling).
+    # The "npy" days are memory-mapped, the "npz" days are decompressed whole.
+    # While day d is consumed, the next day of the range is prefetched (loaded
+    # or read ahead) on a background thread.
+    #
+    # Inputs:
+    #   npzfile (str): prefix of the {kaggle|terabyte}_day_i_reordered.npz files
+    #   offset_per_file (np.array): index of the first sample of every day
+    #   first_day (int), num_days (int): range of days (prefetch wraps around)
+    #   cache_days (int): number of loaded days kept besides the prefetched one
+
+    def __init__(self, npzfile, offset_per_file, first_day, num_days, cache_days=1):
+        self.npzfile = npzfile
+        self.offset_per_file = np.asarray(offset_per_file, dtype=np.int64)
+        self.first_day = first_day
+        self.num_days = num_days
+        self.cache_days = cache_days
+        self._reset()
+
+    def _reset(self):
+        # per process state (threads do not survive a fork of the loader workers)
+        self.pid = os.getpid()
+        self.cache = collections.OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ["cache", "pending", "lock", "executor"]:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    def load(self, day):
+        fi = self.npzfile + "_{0}_reordered.npz".format(day)
+        with data_utils.loadArrays(fi, mmap_mode="r") as data:
+            arrays = (
+                data["X_int"],  # continuous  feature
+                data["X_cat"],  # categorical feature
+                data["y"],      # target
+            )
+        # ask the kernel to read the memory-mapped days ahead
+        for a in arrays:
+            m = getattr(a, "_mmap", None)
+            if m is not None and hasattr(mmap, "MADV_WILLNEED"):
+                m.madvise(mmap.MADV_WILLNEED)
+        return arrays
+
+    def prefetch(self, day):
+        with self.lock:
+            # (a single day is prefetched at a time)
+            if day in self.cache or len(self.pending) > 0:
+                return
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=1)
+            self.pending[day] = self.executor.submit(self.load, day)
+
+    def get(self, day):
+        # arrays of a day (loaded, waiting for its prefetch if needed)
+        if self.pid != os.getpid():
+            self._reset()
+        with self.lock:
+            arrays = self.cache.get(day)
+            future = self.pending.pop(day, None) if arrays is None else None
+        if arrays is None:
+            arrays = future.result() if future is not None else self.load(day)
+            with self.lock:
+                self.cache[day] = arrays
+                while len(self.cache) > self.cache_days:
+                    self.cache.popitem(last=False)
+        else:
+            with self.lock:
+                self.cache.move_to_end(day)
+        self.prefetch(
+            self.first_day + (day - self.first_day + 1) % self.num_days
+        )
+        return arrays
+
+    def gather(self, index):
+        # rows (X_int, X_cat, y) of a global index or array of indices
+        index = np.asarray(index, dtype=np.int64)
+        day = np.searchsorted(self.offset_per_file, index, side="right") - 1
+        if index.ndim == 0:
+            X_int, X_cat, y = self.get(int(day))
+            i = int(index - self.offset_per_file[day])
+            return X_int[i], X_cat[i], y[i]
+        out = None
+        for d in np.unique(day):
+            sel = np.flatnonzero(day == d)
+            X_int, X_cat, y = self.get(int(d))
+            i = index[sel] - self.offset_per_file[d]
+            if out is None:
+                out = (
+                    np.empty((len(index),) + X_int.shape[1:], dtype=X_int.dtype),
+                    np.empty((len(index),) + X_cat.shape[1:], dtype=X_cat.dtype),
+                    np.empty((len(index),) + y.shape[1:], dtype=y.dtype),
+                )
+            out[0][sel] = X_int[i]
+            out[1][sel] = X_cat[i]
+            out[2][sel] = y[i]
+        return out
+
+
 # Kaggle Display Advertising Challenge Dataset
 # dataset (str): name of dataset (Kaggle or Terabyte)
 # randomize (str): determines randomization scheme
@@ -44,6 +161,11 @@ import data_loader_terabyte
 #            "day": randomizes each day"s data (only works if split = True)
 #            "total": randomizes total dataset
 # split (bool) : to split into train, test, validation data-sets
+# renumber_by_freq (bool): renumber the categories of every table by descending
+#            frequency at pre-processing time (hot rows form a prefix)
+# intermediate_format (str): format of the pre-processed day files, "npz"
+#            (compressed) or "npy" (raw, memory-mapped when memory_map is set)
+# shuffle_mem_gb (float): memory budget of the shuffle across days (memory_map)
 class CriteoDataset(Dataset):
 
     def __init__(
@@ -56,7 +178,11 @@ class CriteoDataset(Dataset):
             raw_path="",
             pro_data="",
             memory_map=False,
-            dataset_multiprocessing=False
+            dataset_multiprocessing=False,
+            renumber_by_freq=False,
+            intermediate_format="npz",
+            shuffle_mem_gb=16.0,
+            precompute_features=False
     ):
         # dataset
         # tar_fea = 1   # single target
@@ -91,15 +217,18 @@ class CriteoDataset(Dataset):
         if memory_map:
             for i in range(days):
                 reo_data = self.npzfile + "_{0}_reordered.npz".format(i)
-                if not path.exists(str(reo_data)):
+                if not data_utils.existsArrays(str(reo_data)):
                     data_ready = False
         else:
             if not path.exists(str(pro_data)):
                 data_ready = False
 
-        # pre-process data if needed
+        # pre-process data if needed (data with manifests is checked and the
+        # stale stages are run again)
         # WARNNING: when memory mapping is used we get a collection of files
-        if data_ready:
+        if data_ready and not path.isdir(
+            data_utils.criteoManifestDir(self.d_path, self.d_file)
+        ):
             print("Reading pre-processed data=%s" % (str(pro_data)))
             file = str(pro_data)
         else:
@@ -114,7 +243,11 @@ class CriteoDataset(Dataset):
                 randomize,
                 dataset == "kaggle",
                 memory_map,
-                dataset_multiprocessing
+                dataset_multiprocessing,
+                renumber_by_freq,
+                intermediate_format,
+                shuffle_mem_gb=shuffle_mem_gb,
+                precompute_features=precompute_features
             )
 
         # get a number of samples per day
@@ -136,12 +269,17 @@ class CriteoDataset(Dataset):
                 self.max_day_range = days if split == 'none' else days - 1
             elif split == 'test' or split == 'val':
                 self.day = days - 1
+                self.max_day_range = 1
                 num_samples = self.offset_per_file[days] - \
                               self.offset_per_file[days - 1]
                 self.test_size = int(np.ceil(num_samples / 2.))
                 self.val_size = num_samples - self.test_size
             else:
                 sys.exit("ERROR: dataset split is neither none, nor train or test.")
+            # the days of the split (first day self.day)
+            self.day_files = CriteoDayFiles(
+                self.npzfile, self.offset_per_file, self.day, self.max_day_range
+            )
 
             '''
             # text
@@ -185,18 +323,6 @@ class CriteoDataset(Dataset):
             self.n_emb = len(self.counts)
             print("Sparse features= %d, Dense features= %d" % (self.n_emb, self.m_den))
 
-            # Load the test data
-            # Only a single day is used for testing
-            if self.split == 'test' or self.split == 'val':
-                # only a single day is used for testing
-                fi = self.npzfile + "_{0}_reordered.npz".format(
-                    self.day
-                )
-                with np.load(fi) as data:
-                    self.X_int = data["X_int"]  # continuous  feature
-                    self.X_cat = data["X_cat"]  # categorical feature
-                    self.y = data["y"]          # target
-
         else:
             # load and preprocess data
             with np.load(file) as data:
@@ -209,6 +335,11 @@ class CriteoDataset(Dataset):
             print("Sparse fea = %d, Dense fea = %d" % (self.n_emb, self.m_den))
 
             # create reordering
+            # (the dataset keeps the arrays and the indices of its split, the
+            # rows are gathered when they are accessed)
+            self.X_int = X_int
+            self.X_cat = X_cat
+            self.y = y
             indices = np.arange(len(y))
 
             if split == "none":
@@ -217,9 +348,7 @@ class CriteoDataset(Dataset):
                     indices = np.random.permutation(indices)
                     print("Randomized indices...")
 
-                X_int[indices] = X_int
-                X_cat[indices] = X_cat
-                y[indices] = y
+                self.indices = indices
 
             else:
                 indices = np.array_split(indices, self.offset_per_file[1:-1])
@@ -243,20 +372,46 @@ class CriteoDataset(Dataset):
 
                 # create training, validation, and test sets
                 if split == 'train':
-                    self.X_int = [X_int[i] for i in train_indices]
-                    self.X_cat = [X_cat[i] for i in train_indices]
-                    self.y = [y[i] for i in train_indices]
+                    self.indices = train_indices
                 elif split == 'val':
-                    self.X_int = [X_int[i] for i in val_indices]
-                    self.X_cat = [X_cat[i] for i in val_indices]
-                    self.y = [y[i] for i in val_indices]
+                    self.indices = val_indices
                 elif split == 'test':
-                    self.X_int = [X_int[i] for i in test_indices]
-                    self.X_cat = [X_cat[i] for i in test_indices]
-                    self.y = [y[i] for i in test_indices]
+                    self.indices = test_indices
 
             print("Split data according to indices...")
 
+    def share_memory(self, shared=None):
+        # moves the arrays of a dataset that is not memory-mapped to shared
+        # memory (see shared_dataset.py), so that the loader workers map them
+        # instead of getting a copy; shared: the arrays of another split of the
+        # same data, used instead of this dataset's own copy
+        if self.memory_map:
+            return None
+        if shared is None:
+            shared = shared_dataset.SharedArrays(
+                {"X_int": self.X_int, "X_cat": self.X_cat, "y": self.y}
+            )
+        self.shared = shared
+        self.X_int = shared["X_int"]
+        self.X_cat = shared["X_cat"]
+        self.y = shared["y"]
+        return shared
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if getattr(self, "shared", None) is not None:
+            # the workers map the shared arrays again
+            for name in ["X_int", "X_cat", "y"]:
+                state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if getattr(self, "shared", None) is not None:
+            self.X_int = self.shared["X_int"]
+            self.X_cat = self.shared["X_cat"]
+            self.y = self.shared["y"]
+
     def __getitem__(self, index):
 
         if isinstance(index, slice):
@@ -266,38 +421,44 @@ class CriteoDataset(Dataset):
                 )
             ]
 
+        # a whole batch of indices (see make_criteo_batch_loader)
+        if isinstance(index, list):
+            index = np.asarray(index, dtype=np.int64)
+
         if self.memory_map:
-            if self.split == 'none' or self.split == 'train':
-                # check if need to swicth to next day and load data
-                if index == self.offset_per_file[self.day]:
-                    # print("day_boundary switch", index)
-                    self.day_boundary = self.offset_per_file[self.day]
-                    fi = self.npzfile + "_{0}_reordered.npz".format(
-                        self.day
-                    )
-                    # print('Loading file: ', fi)
-                    with np.load(fi) as data:
-                        self.X_int = data["X_int"]  # continuous  feature
-                        self.X_cat = data["X_cat"]  # categorical feature
-                        self.y = data["y"]          # target
-                    self.day = (self.day + 1) % self.max_day_range
-
-                i = index - self.day_boundary
-            elif self.split == 'test' or self.split == 'val':
-                # only a single day is used for testing
-                i = index + (0 if self.split == 'test' else self.test_size)
-            else:
-                sys.exit("ERROR: dataset split is neither none, nor train or test.")
+            # past the end of the split global_index runs into the next one
+            # (and past the last day into a missing file)
+            n = len(self)
+            if np.any(np.asarray(index) < 0) or np.any(np.asarray(index) >= n):
+                raise IndexError("index out of range for a split of %d samples" % n)
+            X_int, X_cat, y = self.day_files.gather(self.global_index(index))
         else:
-            i = index
+            i = self.indices[index]
+            X_int, X_cat, y = self.X_int[i], self.X_cat[i], self.y[i]
 
         if self.max_ind_range > 0:
-            return self.X_int[i], self.X_cat[i] % self.max_ind_range, self.y[i]
+            return X_int, X_cat % self.max_ind_range, y
+        else:
+            return X_int, X_cat, y
+
+    def get_batch(self, index):
+        # returns the (X_int, X_cat, y) arrays of the rows in index, gathered
+        # with a single fancy-index per array (and day)
+        return self[np.asarray(index, dtype=np.int64)]
+
+    def global_index(self, index):
+        # index of a sample (or array of samples) of the split over all days
+        if self.split == 'none' or self.split == 'train':
+            return index
+        elif self.split == 'test' or self.split == 'val':
+            # only a single day is used for testing
+            return self.offset_per_file[self.day] + index + \
+                (0 if self.split == 'test' else self.test_size)
         else:
-            return self.X_int[i], self.X_cat[i], self.y[i]
+            sys.exit("ERROR: dataset split is neither none, nor train or test.")
 
     def _default_preprocess(self, X_int, X_cat, y):
-        X_int = torch.log(torch.tensor(X_int, dtype=torch.float) + 1)
+        X_int = dense_features(X_int)
         if self.max_ind_range > 0:
             X_cat = torch.tensor(X_cat % self.max_ind_range, dtype=torch.long)
         else:
@@ -319,13 +480,119 @@ class CriteoDataset(Dataset):
             else:
                 sys.exit("ERROR: dataset split is neither none, nor train nor test.")
         else:
-            return len(self.y)
+            return len(self.indices)
+
+
+class CriteoLastDayDataset(Dataset):
+    # Test or val split of a Criteo dataset that is not memory-mapped (the
+    # first or the second half of the last day, as in CriteoDataset), read
+    # from the processed file of the last day alone instead of the processed
+    # file of all the days. The "npy" day is memory-mapped (every process maps
+    # it again), the rows of the "npz" day are loaded and moved to shared
+    # memory for the loader workers by share_memory.
+    #
+    # Inputs:
+    #   day_file (str): {kaggle|terabyte}_day_<last>_processed.npz
+    #   counts_file (str): {kaggle|terabyte}_fea_count.npz
+    #   num_samples (int): number of samples of the last day
+
+    def __init__(self, day_file, counts_file, num_samples, split="test", max_ind_range=-1):
+        test_size = int(np.ceil(num_samples / 2.))
+        if split == "test":
+            self.begin, self.end = 0, test_size
+        elif split == "val":
+            self.begin, self.end = test_size, num_samples
+        else:
+            sys.exit("ERROR: the last day only holds the test and val splits.")
+        self.day_file = day_file
+        self.split = split
+        self.max_ind_range = max_ind_range
+        self.memory_map = False
+        self.shared = None
+        self._open()
+        with np.load(counts_file) as data:
+            self.counts = data["counts"]
+        self.m_den = self.X_int.shape[1]
+        self.n_emb = len(self.counts)
+        print("Read the %s split (%d samples) from %s" % (split, len(self), day_file))
+
+    def _open(self):
+        with data_utils.loadArrays(self.day_file, mmap_mode="r") as data:
+            self.X_int = data["X_int"][self.begin:self.end]
+            self.X_cat = data["X_cat"][self.begin:self.end]
+            self.y = data["y"][self.begin:self.end]
+        self.mapped = isinstance(self.y, np.memmap)
+
+    def share_memory(self, shared=None):
+        # only the loaded ("npz") rows are moved, the workers map "npy" again
+        if self.mapped:
+            return None
+        if shared is None:
+            shared = shared_dataset.SharedArrays(
+                {"X_int": self.X_int, "X_cat": self.X_cat, "y": self.y}
+            )
+        self.shared = shared
+        self.X_int = shared["X_int"]
+        self.X_cat = shared["X_cat"]
+        self.y = shared["y"]
+        return shared
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.mapped or self.shared is not None:
+            for name in ["X_int", "X_cat", "y"]:
+                state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared is not None:
+            self.X_int = self.shared["X_int"]
+            self.X_cat = self.shared["X_cat"]
+            self.y = self.shared["y"]
+        elif self.mapped:
+            self._open()
+
+    def __getitem__(self, index):
+
+        if isinstance(index, slice):
+            return [
+                self[idx] for idx in range(
+                    index.start or 0, index.stop or len(self), index.step or 1
+                )
+            ]
+
+        # a whole batch of indices (see make_criteo_batch_loader)
+        if isinstance(index, list):
+            index = np.asarray(index, dtype=np.int64)
+
+        X_int, X_cat, y = self.X_int[index], self.X_cat[index], self.y[index]
+
+        if self.max_ind_range > 0:
+            return X_int, X_cat % self.max_ind_range, y
+        else:
+            return X_int, X_cat, y
+
+    def get_batch(self, index):
+        return self[np.asarray(index, dtype=np.int64)]
+
+    def __len__(self):
+        return self.end - self.begin
+
+
+def dense_features(X_int):
+    # log(x + 1) of the dense features (rows or arrays) as a float tensor, the
+    # transform is skipped if it was precomputed (floating point features, see
+    # data_utils.precomputeFeatures)
+    precomputed = np.asarray(X_int[0]).dtype.kind == "f"
+    X_int = torch.tensor(X_int, dtype=torch.float)
+    return X_int if precomputed else torch.log(X_int + 1)
 
 
 def collate_wrapper_criteo(list_of_tuples):
     # where each tuple is (X_int, X_cat, y)
     transposed_data = list(zip(*list_of_tuples))
-    X_int = torch.log(torch.tensor(transposed_data[0], dtype=torch.float) + 1)
+    X_int = dense_features(transposed_data[0])
     X_cat = torch.tensor(transposed_data[1], dtype=torch.long)
     T = torch.tensor(transposed_data[2], dtype=torch.float32).view(-1, 1)
 
@@ -338,6 +605,38 @@ def collate_wrapper_criteo(list_of_tuples):
     return X_int, torch.stack(lS_o), torch.stack(lS_i), T
 
 
+def collate_wrapper_criteo_batch(batch):
+    # batch is the (X_int, X_cat, y) arrays of a whole batch (see get_batch),
+    # the log transform is done on the batch tensor
+    X_int = dense_features(batch[0])
+    X_cat = torch.tensor(batch[1], dtype=torch.long)
+    T = torch.tensor(batch[2], dtype=torch.float32).view(-1, 1)
+
+    batchSize = X_cat.shape[0]
+    featureCnt = X_cat.shape[1]
+
+    lS_i = [X_cat[:, i] for i in range(featureCnt)]
+    lS_o = [torch.arange(batchSize) for _ in range(featureCnt)]
+
+    return X_int, torch.stack(lS_o), torch.stack(lS_i), T
+
+
+def make_criteo_batch_loader(data, batch_size, num_workers, distributed=False):
+    # loader serving whole batches of a CriteoDataset: the batch sampler yields
+    # the indices of a batch and the dataset gathers them at once
+    # (with distributed=True every process gets its own shard of the data)
+    sampler = DistributedSampler(data, shuffle=False) if distributed \
+        else SequentialSampler(data)
+    return torch.utils.data.DataLoader(
+        data,
+        batch_size=None,
+        sampler=BatchSampler(sampler, batch_size, drop_last=False),
+        num_workers=num_workers,
+        collate_fn=collate_wrapper_criteo_batch,
+        pin_memory=False,
+    )
+
+
 def ensure_dataset_preprocessed(args, d_path):
     _ = CriteoDataset(
         args.data_set,
@@ -348,7 +647,11 @@ def ensure_dataset_preprocessed(args, d_path):
         args.raw_data_file,
         args.processed_data_file,
         args.memory_map,
-        args.dataset_multiprocessing
+        args.dataset_multiprocessing,
+        getattr(args, "data_renumber_by_freq", False),
+        getattr(args, "data_intermediate_format", "npz"),
+        getattr(args, "data_shuffle_mem_gb", 16.0),
+        getattr(args, "data_precompute_features", False)
     )
 
     _ = CriteoDataset(
@@ -360,27 +663,25 @@ def ensure_dataset_preprocessed(args, d_path):
         args.raw_data_file,
         args.processed_data_file,
         args.memory_map,
-        args.dataset_multiprocessing
+        args.dataset_multiprocessing,
+        getattr(args, "data_renumber_by_freq", False),
+        getattr(args, "data_intermediate_format", "npz"),
+        getattr(args, "data_shuffle_mem_gb", 16.0),
+        getattr(args, "data_precompute_features", False)
     )
 
-    for split in ['train', 'val', 'test']:
-        print('Running preprocessing for split =', split)
-
-        train_files = ['{}_{}_reordered.npz'.format(args.raw_data_file, day)
-                       for
-                       day in range(0, 23)]
-
-        test_valid_file = args.raw_data_file + '_23_reordered.npz'
-
-        output_file = d_path + '_{}.bin'.format(split)
-
-        input_files = train_files if split == 'train' else [test_valid_file]
-        data_loader_terabyte.numpy_to_binary(input_files=input_files,
-                                             output_file_path=output_file,
-                                             split=split)
+    # convert the days 0-22 (train) and 23 (test and val) into binary files,
+    # skipped if they are up to date
+    lstr = args.raw_data_file.split("/")
+    data_utils.convertCriteoToBinary(
+        args.raw_data_file,
+        24,
+        d_path,
+        data_utils.criteoManifestDir("/".join(lstr[0:-1]) + "/", lstr[-1])
+    )
 
 
-def make_criteo_data_and_loaders(args):
+def make_criteo_data_and_loaders(args, distributed=False):
 
     if args.mlperf_logging and args.memory_map and args.data_set == "terabyte":
         # more efficient for larger batches
@@ -399,30 +700,47 @@ def make_criteo_data_and_loaders(args):
                                                 counts_file]):
                 ensure_dataset_preprocessed(args, d_path)
 
+            shuffle_window = getattr(args, "mlperf_bin_shuffle_window", 0)
+            read_ahead = getattr(args, "mlperf_bin_read_ahead", False)
+            seed = getattr(args, "numpy_rand_seed", 123)
             train_data = data_loader_terabyte.CriteoBinDataset(
                 data_file=train_file,
                 counts_file=counts_file,
                 batch_size=args.mini_batch_size,
-                max_ind_range=args.max_ind_range
+                max_ind_range=args.max_ind_range,
+                shuffle_window=shuffle_window,
+                seed=seed,
+                read_ahead=read_ahead
             )
 
+            if args.mlperf_bin_shuffle and shuffle_window > 0:
+                # shuffles the samples within windows of batches
+                train_sampler = data_loader_terabyte.CriteoBinShuffleSampler(
+                    train_data, seed
+                )
+            elif args.mlperf_bin_shuffle:
+                train_sampler = RandomSampler(train_data)
+            else:
+                train_sampler = None
+
             train_loader = torch.utils.data.DataLoader(
                 train_data,
                 batch_size=None,
                 batch_sampler=None,
                 shuffle=False,
-                num_workers=0,
+                num_workers=args.num_workers,
                 collate_fn=None,
                 pin_memory=False,
                 drop_last=False,
-                sampler=RandomSampler(train_data) if args.mlperf_bin_shuffle else None
+                sampler=train_sampler
             )
 
             test_data = data_loader_terabyte.CriteoBinDataset(
                 data_file=test_file,
                 counts_file=counts_file,
                 batch_size=args.test_mini_batch_size,
-                max_ind_range=args.max_ind_range
+                max_ind_range=args.max_ind_range,
+                read_ahead=read_ahead
             )
 
             test_loader = torch.utils.data.DataLoader(
@@ -430,7 +748,7 @@ def make_criteo_data_and_loaders(args):
                 batch_size=None,
                 batch_sampler=None,
                 shuffle=False,
-                num_workers=0,
+                num_workers=args.test_num_workers,
                 collate_fn=None,
                 pin_memory=False,
                 drop_last=False,
@@ -447,7 +765,11 @@ def make_criteo_data_and_loaders(args):
                 args.raw_data_file,
                 args.processed_data_file,
                 args.memory_map,
-                args.dataset_multiprocessing
+                args.dataset_multiprocessing,
+                getattr(args, "data_renumber_by_freq", False),
+                getattr(args, "data_intermediate_format", "npz"),
+                getattr(args, "data_shuffle_mem_gb", 16.0),
+                getattr(args, "data_precompute_features", False)
             )
 
             test_data = CriteoDataset(
@@ -459,7 +781,11 @@ def make_criteo_data_and_loaders(args):
                 args.raw_data_file,
                 args.processed_data_file,
                 args.memory_map,
-                args.dataset_multiprocessing
+                args.dataset_multiprocessing,
+                getattr(args, "data_renumber_by_freq", False),
+                getattr(args, "data_intermediate_format", "npz"),
+                getattr(args, "data_shuffle_mem_gb", 16.0),
+                getattr(args, "data_precompute_features", False)
             )
 
             train_loader = data_loader_terabyte.DataLoader(
@@ -468,7 +794,8 @@ def make_criteo_data_and_loaders(args):
                 days=list(range(23)),
                 batch_size=args.mini_batch_size,
                 max_ind_range=args.max_ind_range,
-                split="train"
+                split="train",
+                num_workers=args.num_workers
             )
 
             test_loader = data_loader_terabyte.DataLoader(
@@ -477,7 +804,8 @@ def make_criteo_data_and_loaders(args):
                 days=[23],
                 batch_size=args.test_mini_batch_size,
                 max_ind_range=args.max_ind_range,
-                split="test"
+                split="test",
+                num_workers=args.test_num_workers
             )
     else:
         train_data = CriteoDataset(
@@ -489,7 +817,11 @@ def make_criteo_data_and_loaders(args):
             args.raw_data_file,
             args.processed_data_file,
             args.memory_map,
-            args.dataset_multiprocessing
+            args.dataset_multiprocessing,
+            getattr(args, "data_renumber_by_freq", False),
+            getattr(args, "data_intermediate_format", "npz"),
+            getattr(args, "data_shuffle_mem_gb", 16.0),
+            getattr(args, "data_precompute_features", False)
         )
 
         test_data = CriteoDataset(
@@ -501,33 +833,161 @@ def make_criteo_data_and_loaders(args):
             args.raw_data_file,
             args.processed_data_file,
             args.memory_map,
-            args.dataset_multiprocessing
+            args.dataset_multiprocessing,
+            getattr(args, "data_renumber_by_freq", False),
+            getattr(args, "data_intermediate_format", "npz"),
+            getattr(args, "data_shuffle_mem_gb", 16.0),
+            getattr(args, "data_precompute_features", False)
+        )
+
+        # the workers map a single copy of the arrays (both splits hold the
+        # whole data) instead of getting their own
+        if args.num_workers > 0 or args.test_num_workers > 0:
+            test_data.share_memory(train_data.share_memory())
+
+        # with distributed=True every process gets its own shard of the data
+        train_loader = make_criteo_batch_loader(
+            train_data, args.mini_batch_size, args.num_workers, distributed
         )
 
-        train_loader = torch.utils.data.DataLoader(
-            train_data,
-            batch_size=args.mini_batch_size,
-            shuffle=False,
-            num_workers=args.num_workers,
-            collate_fn=collate_wrapper_criteo,
-            pin_memory=False,
-            drop_last=False,  # True
+        test_loader = make_criteo_batch_loader(
+            test_data, args.test_mini_batch_size, args.test_num_workers, distributed
         )
 
-        test_loader = torch.utils.data.DataLoader(
-            test_data,
-            batch_size=args.test_mini_batch_size,
-            shuffle=False,
-            num_workers=args.test_num_workers,
-            collate_fn=collate_wrapper_criteo,
-            pin_memory=False,
-            drop_last=False,  # True
+    if getattr(args, "batch_cache_dir", ""):
+        train_loader, test_loader = cache_criteo_loaders(
+            args, train_loader, test_loader, distributed
         )
 
     return train_data, train_loader, test_data, test_loader
 
-def load_test_data_and_loaders(args):
 
+def cache_criteo_loaders(args, train_loader, test_loader, distributed=False):
+    # The collated batches of the loaders are recorded in args.batch_cache_dir
+    # and replayed by the later epochs and runs (see batch_cache.py), under a
+    # key made of the manifests of the pre-processed data and of the
+    # parameters the batches depend on.
+    lstr = args.raw_data_file.split("/")
+    d_path = "/".join(lstr[0:-1]) + "/"
+    d_file = lstr[-1].split(".")[0] if args.data_set == "kaggle" else lstr[-1]
+    manifest_dir = data_utils.criteoManifestDir(d_path, d_file)
+    params = dict(
+        (name, getattr(args, name, None)) for name in [
+            "data_set", "raw_data_file", "processed_data_file", "max_ind_range",
+            "data_sub_sample_rate", "data_randomize", "memory_map",
+            "numpy_rand_seed", "mlperf_logging", "mlperf_bin_loader",
+            "mlperf_bin_shuffle", "mlperf_bin_shuffle_window",
+            "data_renumber_by_freq", "data_precompute_features",
+        ]
+    )
+    if distributed:
+        params["rank"] = torch.distributed.get_rank()
+        params["world_size"] = torch.distributed.get_world_size()
+    files = [args.processed_data_file] if args.processed_data_file else []
+
+    train_params = dict(params, split="train", batch_size=args.mini_batch_size)
+    test_params = dict(params, split="test", batch_size=args.test_mini_batch_size)
+    # only the binary loader shuffles: whole batches (replayed shuffled) or,
+    # with a shuffle window, samples into new batches every epoch (a replay
+    # would repeat the batches of the first epoch, not cached)
+    bin_shuffle = bool(
+        args.mlperf_logging and args.mlperf_bin_loader and args.mlperf_bin_shuffle
+    )
+    if bin_shuffle and getattr(args, "mlperf_bin_shuffle_window", 0) > 0:
+        print("The train batches are not cached (--mlperf-bin-shuffle-window)")
+    else:
+        train_loader = batch_cache.BatchCache(
+            train_loader,
+            args.batch_cache_dir,
+            batch_cache.cache_key(train_params, [manifest_dir], files),
+            shuffle=bin_shuffle,
+            seed=args.numpy_rand_seed,
+        )
+    test_loader = batch_cache.BatchCache(
+        test_loader,
+        args.batch_cache_dir,
+        batch_cache.cache_key(test_params, [manifest_dir], files),
+    )
+    return train_loader, test_loader
+
+def make_criteo_last_day_data(args, split="test"):
+    # test or val dataset without the training days: the not memory-mapped
+    # data is read from its last processed day (CriteoLastDayDataset), the
+    # memory-mapped CriteoDataset already only reads the last reordered day
+    if args.data_set == "kaggle":
+        days = 7
+    elif args.data_set == "terabyte":
+        days = 3
+    else:
+        raise(ValueError("Data set option is not supported"))
+    lstr = args.raw_data_file.split("/")
+    d_path = "/".join(lstr[0:-1]) + "/"
+    d_file = lstr[-1].split(".")[0] if args.data_set == "kaggle" else lstr[-1]
+    npzfile = d_path + ((d_file + "_day") if args.data_set == "kaggle" else d_file)
+    day_file = npzfile + "_{0}_processed.npz".format(days - 1)
+    day_count_file = d_path + d_file + "_day_count.npz"
+
+    # the pipeline is run (or checked) first if there is one, without it the
+    # processed days of older runs may have been removed
+    if not args.memory_map and path.isdir(data_utils.criteoManifestDir(d_path, d_file)):
+        data_utils.getCriteoAdData(
+            args.raw_data_file,
+            "kaggleAdDisplayChallenge_processed" if args.data_set == "kaggle"
+            else "terabyte_processed",
+            args.max_ind_range,
+            args.data_sub_sample_rate,
+            days,
+            split,
+            args.data_randomize,
+            args.data_set == "kaggle",
+            args.memory_map,
+            args.dataset_multiprocessing,
+            getattr(args, "data_renumber_by_freq", False),
+            getattr(args, "data_intermediate_format", "npz"),
+            shuffle_mem_gb=getattr(args, "data_shuffle_mem_gb", 16.0),
+            precompute_features=getattr(args, "data_precompute_features", False)
+        )
+
+    if not args.memory_map and data_utils.existsArrays(day_file) \
+            and path.exists(day_count_file):
+        with np.load(day_count_file) as data:
+            total_per_file = data["total_per_file"]
+        # draws the random numbers CriteoDataset would draw to shuffle the
+        # training days, the model initialized next is the same
+        if args.data_randomize == "day":
+            for i in range(days - 1):
+                np.random.permutation(total_per_file[i])
+        if args.data_randomize == "total":
+            np.random.permutation(np.sum(total_per_file[:days - 1]))
+        return CriteoLastDayDataset(
+            day_file,
+            d_path + d_file + "_fea_count.npz",
+            total_per_file[days - 1],
+            split,
+            args.max_ind_range
+        )
+
+    return CriteoDataset(
+        args.data_set,
+        args.max_ind_range,
+        args.data_sub_sample_rate,
+        args.data_randomize,
+        split,
+        args.raw_data_file,
+        args.processed_data_file,
+        args.memory_map,
+        args.dataset_multiprocessing,
+        getattr(args, "data_renumber_by_freq", False),
+        getattr(args, "data_intermediate_format", "npz"),
+        getattr(args, "data_shuffle_mem_gb", 16.0),
+        getattr(args, "data_precompute_features", False)
+    )
+
+
+def load_test_data_and_loaders(args, distributed=False):
+
+    test_data = make_criteo_last_day_data(args, "test")
+    '''
     test_data = CriteoDataset(
             args.data_set,
             args.max_ind_range,
@@ -537,26 +997,37 @@ def load_test_data_and_loaders(args):
             args.raw_data_file,
             args.processed_data_file,
             args.memory_map,
-            args.dataset_multiprocessing
+            args.dataset_multiprocessing,
+            getattr(args, "data_renumber_by_freq", False),
+            getattr(args, "data_intermediate_format", "npz"),
+            getattr(args, "data_shuffle_mem_gb", 16.0),
+            getattr(args, "data_precompute_features", False)
         )
-    test_loader = torch.utils.data.DataLoader(
-            test_data,
-            batch_size=args.test_mini_batch_size,
-            shuffle=False,
-            num_workers=args.test_num_workers,
-            collate_fn=collate_wrapper_criteo,
-            pin_memory=False,
-            drop_last=False,  # True
+    '''
+    if args.test_num_workers > 0:
+        test_data.share_memory()
+    # with distributed=True every process gets its own shard (the shards are
+    # padded to the same number of batches, the processes step in lockstep)
+    test_loader = make_criteo_batch_loader(
+            test_data, args.test_mini_batch_size, args.test_num_workers, distributed
         )
 
     return test_loader
 
-def load_criteo_preprocessed_data_and_loaders(args, train_hot, train_normal):
+def load_criteo_preprocessed_data_and_loaders(args, train_hot, train_normal, distributed=False):
+
+    # the workers map the rows from shared memory instead of copying the lists
+    train_hot = shared_dataset.share_rows(train_hot, args.num_workers)
+    train_normal = shared_dataset.share_rows(train_normal, args.num_workers)
+
+    hot_sampler = DistributedSampler(train_hot, shuffle=False) if distributed else None
+    normal_sampler = DistributedSampler(train_normal, shuffle=False) if distributed else None
 
     train_hot_loader = torch.utils.data.DataLoader(
         train_hot,
         batch_size=args.mini_batch_size,
         shuffle=False,
+        sampler=hot_sampler,
         num_workers=args.num_workers,
         collate_fn=collate_wrapper_criteo,
         pin_memory=False,
@@ -567,6 +1038,7 @@ def load_criteo_preprocessed_data_and_loaders(args, train_hot, train_normal):
         train_normal,
         batch_size=args.mini_batch_size,
         shuffle=False,
+        sampler=normal_sampler,
         num_workers=args.num_workers,
         collate_fn=collate_wrapper_criteo,
         pin_memory=False,
@@ -683,7 +1155,7 @@ def collate_wrapper_random(list_of_tuples):
             T)
 
 
-def make_random_data_and_loader(args, ln_emb, m_den):
+def make_random_data_and_loader(args, ln_emb, m_den, distributed=False):
 
     train_data = RandomDataset(
         m_den,
@@ -705,6 +1177,7 @@ def make_random_data_and_loader(args, ln_emb, m_den):
         train_data,
         batch_size=1,
         shuffle=False,
+        sampler=DistributedSampler(train_data, shuffle=False) if distributed else None,
         num_workers=args.num_workers,
         collate_fn=collate_wrapper_random,
         pin_memory=False,
@@ -788,6 +1261,122 @@ def generate_random_output_batch(n, num_targets, round_targets=False):
     return torch.tensor(P)
 
 
+# sizes of the bags of a batch: num_indices_per_lookup each, or drawn uniformly
+# in [1, min(size, num_indices_per_lookup)]
+def generate_bag_sizes(n, size, num_indices_per_lookup, num_indices_per_lookup_fixed):
+    if num_indices_per_lookup_fixed:
+        return np.full(n, num_indices_per_lookup, dtype=np.int64)
+    r = ra.random(n)
+    return np.round(
+        np.maximum(1.0, r * min(size, num_indices_per_lookup))
+    ).astype(np.int64)
+
+
+# offsets and indices of bags given as concatenated indices and bag sizes, the
+# indices of every bag are sorted and their duplicates removed (as np.unique
+# per bag) with a single sort of the whole batch
+def make_unique_bags(sizes, indices):
+    n = len(sizes)
+    bags = np.repeat(np.arange(n, dtype=np.int64), sizes)
+    order = np.lexsort((indices, bags))
+    bags = bags[order]
+    indices = indices[order]
+    keep = np.ones(len(indices), dtype=bool)
+    keep[1:] = (bags[1:] != bags[:-1]) | (indices[1:] != indices[:-1])
+    counts = np.bincount(bags[keep], minlength=n)
+    offsets = np.zeros(n, dtype=np.int64)
+    np.cumsum(counts[:-1], out=offsets[1:])
+    return torch.from_numpy(offsets), torch.from_numpy(indices[keep])
+
+
+# uniform ditribution (input data)
+def generate_uniform_input_batch(
+    m_den,
+    ln_emb,
+    n,
+    num_indices_per_lookup,
+    num_indices_per_lookup_fixed,
+):
+    # dense feature
+    Xt = torch.tensor(ra.rand(n, m_den).astype(np.float32))
+
+    # sparse feature (sparse indices)
+    lS_emb_offsets = []
+    lS_emb_indices = []
+    # for each embedding generate the n lookups at once, where each lookup
+    # is composed of multiple sparse indices
+    for size in ln_emb:
+        # num of sparse indices to be used per embedding
+        sparse_group_sizes = generate_bag_sizes(
+            n, size, num_indices_per_lookup, num_indices_per_lookup_fixed
+        )
+        # sparse indices to be used per embedding (duplicates within a lookup
+        # are removed, the offsets account for it)
+        r = ra.random(int(np.sum(sparse_group_sizes)))
+        sparse_indices = np.round(r * (size - 1)).astype(np.int64)
+        lS_batch_offsets, lS_batch_indices = make_unique_bags(
+            sparse_group_sizes, sparse_indices
+        )
+        lS_emb_offsets.append(lS_batch_offsets)
+        lS_emb_indices.append(lS_batch_indices)
+
+    return (Xt, lS_emb_offsets, lS_emb_indices)
+
+
+# synthetic distribution (input data)
+def generate_synthetic_input_batch(
+    m_den,
+    ln_emb,
+    n,
+    num_indices_per_lookup,
+    num_indices_per_lookup_fixed,
+    trace_file,
+    enable_padding=False,
+):
+    # dense feature
+    Xt = torch.tensor(ra.rand(n, m_den).astype(np.float32))
+
+    # sparse feature (sparse indices)
+    lS_emb_offsets = []
+    lS_emb_indices = []
+    # for each embedding generate a list of n lookups,
+    # where each lookup is composed of multiple sparse indices
+    for i, size in enumerate(ln_emb):
+        # num of sparse indices to be used per embedding
+        sparse_group_sizes = generate_bag_sizes(
+            n, size, num_indices_per_lookup, num_indices_per_lookup_fixed
+        )
+        # the distribution is read once per table, every lookup starts from
+        # its initial reference order (shared, not copied per lookup)
+        file_path = trace_file
+        line_accesses, list_sd, cumm_sd = read_dist_from_file(
+            file_path.replace("j", str(i))
+        )
+        # approach 2: lru (see trace_generate_rand for approach 1), all the
+        # lookups of the table at once
+        counts, r = synthesize_bags(
+            line_accesses, list_sd, cumm_sd, sparse_group_sizes, enable_padding
+        )
+        r = r.astype(np.int64)
+        # WARNING: if the distribution in the file is not consistent
+        # with embedding table dimensions, below mod guards against out
+        # of range access
+        if len(r) > 0 and ((np.min(r) < 0) or (size <= np.max(r))):
+            print(
+                "WARNING: distribution is inconsistent with embedding "
+                + "table size (using mod to recover and continue)"
+            )
+            r = np.mod(r, size).astype(np.int64)
+        # duplicates within a lookup are removed, the offsets account for it
+        lS_batch_offsets, lS_batch_indices = make_unique_bags(counts, r)
+        lS_emb_offsets.append(lS_batch_offsets)
+        lS_emb_indices.append(lS_batch_indices)
+
+    return (Xt, lS_emb_offsets, lS_emb_indices)
+
+
+'''
+# per lookup generation (a Python loop over the lookups of every table)
 # uniform ditribution (input data)
 def generate_uniform_input_batch(
     m_den,
@@ -907,6 +1496,7 @@ def generate_synthetic_input_batch(
         lS_emb_indices.append(torch.tensor(lS_batch_indices))
 
     return (Xt, lS_emb_offsets, lS_emb_indices)
+'''
 
 
 def generate_stack_distance(cumm_val, cumm_dist, max_i, i, enable_padding=False):
@@ -930,6 +1520,302 @@ def generate_stack_distance(cumm_val, cumm_dist, max_i, i, enable_padding=False)
 cache_line_size = 1
 
 
+def generate_stack_distances(cumm_val, cumm_dist, n, enable_padding=False):
+    # n stack distances drawn as by n calls of generate_stack_distance (the
+    # same random numbers, drawn at once): while fewer than max(cumm_val) new
+    # references were drawn the support depends on their number and the
+    # distances are drawn one by one, after that they are all mapped with a
+    # single searchsorted
+    cumm_val = list(cumm_val)
+    cumm_dist = list(cumm_dist)
+    max_i = cumm_val[-1]
+    u = ra.rand(n)
+    sd = np.empty(n, dtype=np.int64)
+    i = 0
+    t = 0
+    while t < n and i < max_i:
+        # only generate stack distances up to the number of new references seen so far
+        j = bisect.bisect(cumm_val, i) - 1
+        k = bisect.bisect_left(cumm_dist, u[t] * cumm_dist[j])
+        sd[t] = cumm_val[min(k, len(cumm_val) - 1)]
+        if sd[t] == 0:
+            i += 1
+        t += 1
+    u = u[t:]
+    if enable_padding:
+        # WARNING: disable generation of new references (once all have been seen)
+        fi = cumm_dist[0]
+        u = (1.0 - fi) * u + fi  # remap distribution support to exclude first value
+    k = np.searchsorted(np.asarray(cumm_dist, dtype=np.float64), u, side="left")
+    sd[t:] = np.asarray(cumm_val, dtype=np.int64)[np.minimum(k, len(cumm_val) - 1)]
+    return sd
+
+
+def generate_bag_stack_distances(cumm_val, cumm_dist, sizes, enable_padding=False):
+    # stack distances of lookups of the given sizes, as generate_stack_distances
+    # per lookup (the same random numbers, drawn at once) and concatenated:
+    # the support of a draw depends on the new references of its own lookup,
+    # the draws are made position by position over all the lookups at once
+    #
+    # Outputs:
+    #   sd (np.int64): stack distances of the lookups, one after the other
+    #   new (np.int64): number of new references of every lookup
+    #   bounded (bool array): the distances of the lookup never exceed the
+    #       new references drawn before them (always with a distribution
+    #       starting at 0, e.g. stack_distance_histogram)
+    cumm_val = np.asarray(cumm_val, dtype=np.int64)
+    cumm_dist = np.asarray(cumm_dist, dtype=np.float64)
+    max_i = cumm_val[-1]
+    sizes = np.asarray(sizes, dtype=np.int64)
+    starts = np.cumsum(sizes) - sizes
+    u = ra.rand(int(np.sum(sizes)))
+    sd = np.empty(len(u), dtype=np.int64)
+    new = np.zeros(len(sizes), dtype=np.int64)
+    bounded = np.ones(len(sizes), dtype=bool)
+    for p in range(int(np.max(sizes)) if len(sizes) > 0 else 0):
+        b = np.flatnonzero(sizes > p)
+        t = starts[b] + p
+        i = new[b]
+        warm = i < max_i
+        # only generate stack distances up to the number of new references
+        # seen so far, or (enable_padding) no new references after that
+        j = np.searchsorted(cumm_val, i, side="right") - 1
+        x = np.where(warm, u[t] * cumm_dist[j], u[t])
+        if enable_padding:
+            fi = cumm_dist[0]
+            x = np.where(warm, x, (1.0 - fi) * x + fi)
+        k = np.searchsorted(cumm_dist, x, side="left")
+        sd[t] = cumm_val[np.minimum(k, len(cumm_val) - 1)]
+        bounded[b] &= sd[t] <= i
+        new[b] += sd[t] == 0
+    return sd, new, bounded
+
+
+def synthesize_bags(line_accesses, list_sd, cumm_sd, sizes, enable_padding=False):
+    # Distinct references of lookups of the given sizes, each synthesized as
+    # synthesize_short_trace from the stack line_accesses. When its distances
+    # never exceed its new references (bounded), a lookup only moves the
+    # references it pulled from the bottom: with n new ones it accesses the
+    # n bottom references of line_accesses, whatever their order. The other
+    # lookups are synthesized one by one.
+    #
+    # Outputs:
+    #   counts (np.int64): number of references of every lookup
+    #   refs (np.uint64): references of the lookups, one after the other
+    #       (bounded lookups without duplicates)
+    sizes = np.asarray(sizes, dtype=np.int64)
+    sd, new, bounded = generate_bag_stack_distances(
+        list_sd, cumm_sd, sizes, enable_padding
+    )
+    l = len(line_accesses)
+    refs = np.asarray(line_accesses, dtype=np.uint64) * np.uint64(cache_line_size)
+    counts = np.minimum(new, l)
+    traces = {}
+    starts = np.cumsum(sizes) - sizes
+    for b in np.flatnonzero(~bounded).tolist():
+        traces[b] = synthesize_short_trace(
+            line_accesses, sd[starts[b]:starts[b] + sizes[b]]
+        )
+        counts[b] = len(traces[b])
+    offsets = np.cumsum(counts) - counts
+    # the first counts[b] references of line_accesses for every bounded lookup
+    pos = np.arange(int(np.sum(counts)), dtype=np.int64)
+    pos -= np.repeat(offsets, counts)
+    fast = np.repeat(bounded, counts)
+    out = np.empty(len(pos), dtype=np.uint64)
+    out[fast] = refs[pos[fast]]
+    for b, trace in traces.items():
+        out[offsets[b]:offsets[b] + counts[b]] = trace
+    return counts, out
+
+
+class LRUStack:
+    # Stack of references ordered by last access, with the k-th reference from
+    # the bottom (least recently accessed) and its move to the top in
+    # O(log n). The references sit in slots in access order, a Fenwick tree
+    # counts the occupied slots: the k-th reference is found by descending the
+    # tree, a move frees its slot and takes the next free slot after the top.
+    # The references are compacted into the first slots when none is left.
+
+    def __init__(self, refs, spare=1 << 16):
+        self.spare = spare
+        self.compactions = 0
+        self._compact(list(refs))
+
+    def _compact(self, refs):
+        # refs from the bottom to the top in slots 0..size-1
+        self.size = len(refs)
+        self.capacity = 2 * self.size + self.spare
+        self.slots = refs + [None] * (self.capacity - self.size)
+        self.next = self.size
+        self.compactions += 1
+        # Fenwick tree (1-based) of the occupied slots, built in O(capacity)
+        tree = [0] + [1 if k < self.size else 0 for k in range(self.capacity)]
+        for k in range(1, self.capacity + 1):
+            parent = k + (k & -k)
+            if parent <= self.capacity:
+                tree[parent] += tree[k]
+        self.tree = tree
+        self.log = 1 << (self.capacity.bit_length() - 1)
+
+    def _find(self, k):
+        # slot of the k-th occupied slot (1-based)
+        tree = self.tree
+        pos = 0
+        step = self.log
+        while step > 0:
+            nxt = pos + step
+            if nxt <= self.capacity and tree[nxt] < k:
+                pos = nxt
+                k -= tree[nxt]
+            step >>= 1
+        return pos
+
+    def _add(self, slot, delta):
+        tree = self.tree
+        i = slot + 1
+        while i <= self.capacity:
+            tree[i] += delta
+            i += i & -i
+
+    def access(self, k):
+        # reference k-th from the bottom (1-based), moved to the top
+        slot = self._find(k)
+        ref = self.slots[slot]
+        self.move_to_top(slot)
+        return ref
+
+    def depth(self, slot):
+        # position of the reference in slot from the top (1: top)
+        tree = self.tree
+        below = 0
+        i = slot
+        while i > 0:
+            below += tree[i]
+            i &= i - 1
+        return self.size - below
+
+    def move_to_top(self, slot):
+        # moves the reference in slot to the top, returns its new slot (all
+        # the slots change when they are compacted, see compactions)
+        if slot == self.next - 1:
+            return slot  # already at the top
+        ref = self.slots[slot]
+        if self.next == self.capacity:
+            bottom = self.depth(slot)
+            self._compact(self.to_list())
+            slot = self.size - bottom
+        self.slots[slot] = None
+        self._add(slot, -1)
+        self.slots[self.next] = ref
+        self._add(self.next, 1)
+        self.next += 1
+        return self.next - 1
+
+    def push(self, ref):
+        # adds a new reference on top, returns its slot
+        if self.next == self.capacity:
+            self._compact(self.to_list())
+        self.slots[self.next] = ref
+        self._add(self.next, 1)
+        self.next += 1
+        self.size += 1
+        return self.next - 1
+
+    def to_list(self):
+        # references from the bottom to the top
+        return [r for r in self.slots[:self.next] if r is not None]
+
+
+def synthesize_trace(
+    line_accesses, list_sd, cumm_sd, out_trace_len, enable_padding=False, lru=True
+):
+    # Synthetic trace of out_trace_len references (np.uint64) drawn from a
+    # stack distance distribution, as trace_generate_lru (lru=True) or
+    # trace_generate_rand (lru=False). The stack distances are drawn first
+    # (generate_stack_distances), a new reference (distance 0) is the one at
+    # the bottom of the stack and any reference is moved to the top. With lru
+    # every access moves its reference (LRUStack), otherwise only the new
+    # ones do: the stack is rotated by the number of new references so far
+    # and the trace is computed with array operations.
+    #
+    # Outputs:
+    #   trace (np.uint64 array): generated memory references
+    #   line_accesses (list): the stack at the end, from the bottom to the top
+    sd = generate_stack_distances(list_sd, cumm_sd, out_trace_len, enable_padding)
+    l = len(line_accesses)
+    if lru:
+        # spare slots for the moves (compacted at most every max(l, 1024) moves)
+        stack = LRUStack(line_accesses, max(1, min(out_trace_len, max(l, 1024))))
+        trace = np.fromiter(
+            (stack.access(l - s + 1 if s > 0 else 1) for s in sd.tolist()),
+            dtype=np.uint64,
+            count=out_trace_len,
+        )
+        line_accesses = stack.to_list()
+    else:
+        refs = np.asarray(line_accesses, dtype=np.uint64)
+        new = sd == 0
+        # new references drawn before every access
+        rotation = np.cumsum(new) - new
+        trace = refs[(rotation + np.where(new, 0, l - sd)) % l]
+        shift = int(np.sum(new)) % l if l > 0 else 0
+        line_accesses = refs[shift:].tolist() + refs[:shift].tolist()
+    # memory references within a line (mem_ref_within_line = 0)
+    trace = trace * np.uint64(cache_line_size)
+    return trace, line_accesses
+
+
+def synthesize_short_trace(line_accesses, sd):
+    # Trace of the stack distances sd (np.uint64) from the stack line_accesses
+    # (from the bottom to the top), as synthesize_trace with lru but without
+    # building an LRUStack: for a short trace (a lookup) from a large stack,
+    # the stack is the untouched references in their initial order below the
+    # few touched ones, in access order. The initial order is not copied,
+    # the k-th untouched reference skips the touched initial positions.
+    l = len(line_accesses)
+    touched = []  # initial positions, from the least to the most recent
+    trace = np.empty(len(sd), dtype=np.uint64)
+    for t, s in enumerate(sd.tolist()):
+        # k-th reference from the bottom (1-based), see synthesize_trace
+        k = max(l - s + 1 if s > 0 else 1, 1)
+        untouched = l - len(touched)
+        if k <= untouched:
+            q = k - 1
+            for p in sorted(touched):
+                if p <= q:
+                    q += 1
+        else:
+            q = touched.pop(k - untouched - 1)
+        touched.append(q)
+        trace[t] = line_accesses[q]
+    return trace * np.uint64(cache_line_size)
+
+
+def trace_generate_lru(
+    line_accesses, list_sd, cumm_sd, out_trace_len, enable_padding=False
+):
+    # see synthesize_trace, line_accesses is updated to the final stack
+    trace, stack = synthesize_trace(
+        line_accesses, list_sd, cumm_sd, out_trace_len, enable_padding, lru=True
+    )
+    line_accesses[:] = stack
+    return trace.tolist()
+
+
+def trace_generate_rand(
+    line_accesses, list_sd, cumm_sd, out_trace_len, enable_padding=False
+):
+    # see synthesize_trace, line_accesses is updated to the final stack
+    trace, stack = synthesize_trace(
+        line_accesses, list_sd, cumm_sd, out_trace_len, enable_padding, lru=False
+    )
+    line_accesses[:] = stack
+    return trace.tolist()
+
+
+'''
+# one reference at a time, O(n) list operations per reference
 def trace_generate_lru(
     line_accesses, list_sd, cumm_sd, out_trace_len, enable_padding=False
 ):
@@ -980,8 +1866,92 @@ def trace_generate_rand(
         ztrace.append(mem_ref)
 
     return ztrace
+'''
+
+
+def trace_stack_distances(trace):
+    # Stack distances of a trace in O(n log n) (trace_profile moves every
+    # reference within a Python list, O(n^2)). The distance of an access at
+    # time t to a reference last accessed at time p is the number of distinct
+    # references accessed in [p, t): the t - p accesses minus those that are
+    # no longer the last access of their reference. The latter are counted
+    # with a Fenwick tree over the times, a time is added to it when its
+    # reference is accessed again.
+    #
+    # Inputs:
+    #   trace (array-like): memory references
+    #
+    # Outputs (numpy arrays, in time order):
+    #   refs (np.uint64): line references of the accesses
+    #   sd (np.int64): stack distance of every access (0: new reference)
+    #   prev (np.int64): time of the previous access to the reference (-1: none)
+    refs = np.asarray(trace).astype(np.uint64).reshape(-1) // np.uint64(cache_line_size)
+    n = len(refs)
+    # previous access of every reference (the accesses of a reference are
+    # consecutive in a stable sort)
+    _, inverse = np.unique(refs, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind="stable")
+    same = inverse[order[1:]] == inverse[order[:-1]]
+    prev = np.full(n, -1, dtype=np.int64)
+    prev[order[1:][same]] = order[:-1][same]
+
+    sd = np.zeros(n, dtype=np.int64)
+    tree = [0] * (n + 1)  # 1-based, counts of the replaced times
+    replaced = 0
+    for t, p in zip(np.flatnonzero(prev >= 0).tolist(), prev[prev >= 0].tolist()):
+        # replaced times before p
+        q = 0
+        i = p
+        while i > 0:
+            q += tree[i]
+            i &= i - 1
+        # all the replaced times are before t
+        sd[t] = t - p - (replaced - q)
+        # p is replaced by t
+        i = p + 1
+        while i <= n:
+            tree[i] += 1
+            i += i & -i
+        replaced += 1
+
+    return refs, sd, prev
+
+
+def stack_distance_histogram(stack_distances):
+    # distinct stack distances and their cumulative distribution, the
+    # (list_sd, cumm_sd) of the distribution files
+    list_sd, counts = np.unique(np.asarray(stack_distances, dtype=np.int64), return_counts=True)
+    cumm_sd = np.cumsum(counts) / float(max(len(stack_distances), 1))
+    return list_sd.tolist(), cumm_sd.tolist()
 
 
+def trace_profile(trace, enable_padding=False):
+    # LRU stack, stack distances and new references of a trace, as the lists
+    # of the list based version below: the stack from the least to the most
+    # recently accessed reference, the stack distances and the new references
+    # in reverse time order
+    refs, sd, prev = trace_stack_distances(trace)
+
+    # the last access of every reference, by time
+    last = np.ones(len(refs), dtype=bool)
+    last[prev[prev >= 0]] = False
+    rstack = refs[last].tolist()
+    stack_distances = sd[::-1].tolist()
+    line_accesses = refs[prev < 0][::-1].tolist()
+
+    if enable_padding and len(stack_distances) > 0:
+        # WARNING: see the list based version below
+        l = len(stack_distances)
+        c = max(stack_distances)
+        padding = int(np.ceil(l / c))
+        stack_distances = stack_distances + [0] * padding
+
+    return (rstack, stack_distances, line_accesses)
+
+
+'''
+# list based version, O(n^2)
 def trace_profile(trace, enable_padding=False):
     # number of elements in the array (assuming 1D)
     # n = trace.size
@@ -1028,9 +1998,110 @@ def trace_profile(trace, enable_padding=False):
         stack_distances = stack_distances + [0] * padding
 
     return (rstack, stack_distances, line_accesses)
+'''
+
+
+class StackDistanceProfiler:
+    # Online version of trace_profile for traces read in chunks (e.g.
+    # data_utils.iterTraceChunks): the memory holds the distinct references
+    # and the histogram of the stack distances, not the trace. The references
+    # are kept in an LRUStack, the distance of an access is the depth of its
+    # reference (0 for a new one) and the reference is moved to the top.
+
+    def __init__(self):
+        self.stack = LRUStack([], 1 << 16)
+        self.slot = {}  # slot of every reference in the stack
+        self.compactions = self.stack.compactions
+        self.hist = collections.Counter()
+        self.line_accesses = []  # new references, in time order
+        self.count = 0
+
+    def update(self, trace):
+        stack = self.stack
+        slots = self.slot
+        hist = self.hist
+        refs = np.asarray(trace).astype(np.uint64).reshape(-1) // np.uint64(cache_line_size)
+        for r in refs.tolist():
+            s = slots.get(r)
+            if s is None:
+                hist[0] += 1
+                self.line_accesses.append(r)
+                s = stack.push(r)
+            else:
+                hist[stack.depth(s)] += 1
+                s = stack.move_to_top(s)
+            if stack.compactions != self.compactions:
+                # every reference moved to a new slot (a move after the
+                # compaction leaves a free slot, the slots are not the ranks)
+                slots.clear()
+                slots.update(
+                    (ref, k) for k, ref in enumerate(stack.slots[:stack.next]) if ref is not None
+                )
+                self.compactions = stack.compactions
+            else:
+                slots[r] = s
+        self.count += len(refs)
+
+    def histogram(self, enable_padding=False):
+        # distinct stack distances and their cumulative distribution, as
+        # stack_distance_histogram on the distances of trace_profile
+        hist = collections.Counter(self.hist)
+        total = self.count
+        if enable_padding and total > 0:
+            # WARNING: see the list based trace_profile
+            padding = int(np.ceil(total / max(hist)))
+            hist[0] += padding
+            total += padding
+        list_sd = sorted(hist)
+        cumm_sd = (np.cumsum([hist[k] for k in list_sd]) / float(max(total, 1))).tolist()
+        return list_sd, cumm_sd
 
 
 # auxiliary read/write routines
+def read_trace_from_file(file_path, binary_type=False):
+    # references of a trace file as a np.uint64 array: memory-mapped for the
+    # files with a header (see data_utils.writeTraceFile), otherwise a raw
+    # binary array (binary_type) or a text line of comma separated references
+    try:
+        if data_utils.isTraceFile(file_path):
+            return data_utils.loadTraceFile(file_path)[1]
+        if binary_type:
+            return np.fromfile(file_path, dtype=np.uint64)
+        with open(file_path) as f:
+            return np.fromstring(f.readline(), dtype=np.uint64, sep=",")
+    except Exception:
+        print("ERROR: no input trace file has been provided")
+
+
+def iter_trace_chunks(file_path, binary_type=False, chunk_size=1 << 22):
+    # references of a trace file in chunks, only the files with a header are
+    # read chunk by chunk
+    if data_utils.isTraceFile(file_path):
+        return data_utils.iterTraceChunks(file_path, chunk_size)
+    return [read_trace_from_file(file_path, binary_type)]
+
+
+def write_trace_to_file(file_path, trace, binary_type=False, table=-1):
+    # trace: array, list or iterable of chunks; binary_type writes a file with
+    # a header (data_utils.writeTraceFile), otherwise a text line
+    try:
+        if binary_type:
+            data_utils.writeTraceFile(file_path, trace, table, cache_line_size)
+        else:
+            chunks = [trace] if isinstance(trace, (np.ndarray, list)) else trace
+            with open(file_path, "w+") as f:
+                sep = ""
+                for chunk in chunks:
+                    chunk = np.asarray(chunk).astype(np.uint64).reshape(-1)
+                    if len(chunk) > 0:
+                        f.write(sep + ", ".join(map(str, chunk.tolist())))
+                        sep = ", "
+    except Exception:
+        print("ERROR: no output trace file has been provided")
+
+
+'''
+# list based, with the global args of the __main__ below
 def read_trace_from_file(file_path):
     try:
         with open(file_path) as f:
@@ -1056,6 +2127,7 @@ def write_trace_to_file(file_path, trace):
                 f.write(s[1 : len(s) - 1])
     except Exception:
         print("ERROR: no output trace file has been provided")
+'''
 
 
 def read_dist_from_file(file_path):
@@ -1111,6 +2183,17 @@ if __name__ == "__main__":
     np.random.seed(args.numpy_rand_seed)
     np.set_printoptions(precision=args.print_precision)
 
+    ### read and profile trace (in chunks) ###
+    profiler = StackDistanceProfiler()
+    for chunk in iter_trace_chunks(args.trace_file, args.trace_file_binary_type):
+        profiler.update(chunk)
+    line_accesses = profiler.line_accesses
+    trace_len = profiler.count
+    # print(line_accesses)
+
+    ### compute probability distribution ###
+    list_sd, cumm_sd = profiler.histogram(args.trace_enable_padding)
+    '''
     ### read trace ###
     trace = read_trace_from_file(args.trace_file)
     # print(trace)
@@ -1125,6 +2208,9 @@ if __name__ == "__main__":
     # print(stack_distances)
 
     ### compute probability distribution ###
+    list_sd, cumm_sd = stack_distance_histogram(stack_distances)
+    '''
+    '''
     # count items
     l = len(stack_distances)
     dc = sorted(
@@ -1143,16 +2229,20 @@ if __name__ == "__main__":
         else:
             # add the 2nd element of the i-th tuple in the dist_sd list
             cumm_sd.append(cumm_sd[i - 1] + (k / float(l)))
+    '''
 
     ### write stack_distance and line_accesses to a file ###
     write_dist_to_file(args.dist_file, line_accesses, list_sd, cumm_sd)
 
     ### generate correspondinf synthetic ###
     # line_accesses, list_sd, cumm_sd = read_dist_from_file(args.dist_file)
-    synthetic_trace = trace_generate_lru(
-        line_accesses, list_sd, cumm_sd, len(trace), args.trace_enable_padding
+    synthetic_trace, _ = synthesize_trace(
+        line_accesses, list_sd, cumm_sd, trace_len, args.trace_enable_padding
     )
-    # synthetic_trace = trace_generate_rand(
-    #     line_accesses, list_sd, cumm_sd, len(trace), args.trace_enable_padding
+    # synthetic_trace, _ = synthesize_trace(
+    #     line_accesses, list_sd, cumm_sd, trace_len, args.trace_enable_padding,
+    #     lru=False
     # )
-    write_trace_to_file(args.synthetic_file, synthetic_trace)
+    write_trace_to_file(
+        args.synthetic_file, synthetic_trace, args.trace_file_binary_type
+    )
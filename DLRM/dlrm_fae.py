@@ -62,6 +62,13 @@ import time
 import json
 # data generation
 import dlrm_data_pytorch as dp
+import shared_dataset
+# cpu core partitioning
+import cpu_partition
+# hogwild multithreaded training of the cold batches
+import cpu_hogwild
+# multi-process cpu training
+import extend_distributed as ext_dist
 
 # numpy
 import numpy as np
@@ -249,6 +256,8 @@ class DLRM_Net(nn.Module):
 		qr_threshold=200,
 		md_flag=False,
 		md_threshold=200,
+		device="cuda:0",
+		create_cold_emb=True,
 	):
 		super(DLRM_Net, self).__init__()
 
@@ -280,16 +289,22 @@ class DLRM_Net(nn.Module):
 			self.md_flag = md_flag
 			if self.md_flag:
 				self.md_threshold = md_threshold
+			# cold tables held by another rank (distributed mode only)
+			self.cold_emb = None
 			
-			self.emb_l = self.create_emb(m_spa, ln_emb)
+			# in distributed mode only the owner rank holds the cold tables
+			if create_cold_emb:
+				self.emb_l = self.create_emb(m_spa, ln_emb)
+			else:
+				self.emb_l = nn.ModuleList()
 			print("EMB : ", ln_emb)
 			self.hot_emb_l = self.create_hot_emb(m_spa, ln_hot_emb)
 			print("Hot EMB : ", ln_hot_emb)
-			self.hot_emb_l = self.hot_emb_l.to("cuda:0")
+			self.hot_emb_l = self.hot_emb_l.to(device)
 			self.bot_l = self.create_mlp(ln_bot, sigmoid_bot)
-			self.bot_l = self.bot_l.to("cuda:0")
+			self.bot_l = self.bot_l.to(device)
 			self.top_l = self.create_mlp(ln_top, sigmoid_top)
-			self.top_l = self.top_l.to("cuda:0")
+			self.top_l = self.top_l.to(device)
 
 	def apply_mlp(self, x, layers):
 		# approach 1: use ModuleList
@@ -386,7 +401,9 @@ class DLRM_Net(nn.Module):
 
 	def forward(self, dense_x, lS_o, lS_i, data):
 				
-		if data == "hot":
+		if self.cold_emb is not None:
+			return self.distributed_forward(dense_x, lS_o, lS_i, data)
+		elif data == "hot":
 			return self.parallel_forward(dense_x, lS_o, lS_i)
 		else:
 			return self.mixed_forward(dense_x, lS_o, lS_i)
@@ -541,6 +558,39 @@ class DLRM_Net(nn.Module):
 
 		return z0
 
+	def distributed_forward(self, dense_x, lS_o, lS_i, data):
+		# data parallel forward on CPU (one process per rank): hot lookups use
+		# the local replica of the hot table, cold lookups go to the owner rank
+		x = self.apply_mlp(dense_x, self.bot_l)
+
+		if data == "hot":
+			ly = self.apply_hot_emb(lS_o, lS_i, self.hot_emb_l)
+		else:
+			ly = self.cold_emb.forward(lS_o, lS_i, requires_grad=(data != "test"))
+
+		z = self.interact_features(x, ly)
+
+		p = self.apply_mlp(z, self.top_l)
+
+		# clamp output if needed
+		if 0.0 < self.loss_threshold and self.loss_threshold < 1.0:
+			z0 = torch.clamp(p, min=self.loss_threshold, max=(1.0 - self.loss_threshold))
+		else:
+			z0 = p
+
+		return z0
+
+	def distributed_backward(self, data):
+		# to be called after the local backward pass (and before the optimizer):
+		# cold gradients go back to the owner, replicated gradients are averaged
+		if data != "hot":
+			self.cold_emb.backward()
+		ext_dist.all_reduce_grads(
+			list(self.bot_l.parameters())
+			+ list(self.top_l.parameters())
+			+ list(self.hot_emb_l.parameters())
+		)
+
 def dash_separated_ints(value):
 	vals = value.split('-')
 	for val in vals:
@@ -630,6 +680,14 @@ if __name__ == "__main__":
 						with more than 7 CPU cores and more than 20 GB of memory. \n \
 						The Terabyte dataset can be multiprocessed in an environment \
 						with more than 24 CPU cores and at least 1 TB of memory.")
+	# categories renumbered by descending frequency (hot rows first)
+	parser.add_argument("--data-renumber-by-freq", action="store_true", default=False)
+	# format of the pre-processed day files: npz (compressed) or npy (raw, can be memory-mapped)
+	parser.add_argument("--data-intermediate-format", type=str, choices=["npz", "npy"], default="npz")
+	# memory budget (GB) of the shuffle across days when pre-processing with --memory-map
+	parser.add_argument("--data-shuffle-mem-gb", type=float, default=16.0)
+	# store log(x + 1) of the dense and the narrowest type of the sparse features
+	parser.add_argument("--data-precompute-features", action="store_true", default=False)
 	# training
 	parser.add_argument("--mini-batch-size", type=int, default=1)
 	parser.add_argument("--nepochs", type=int, default=1)
@@ -643,6 +701,19 @@ if __name__ == "__main__":
 	parser.add_argument("--save-onnx", action="store_true", default=False)
 	# gpu
 	parser.add_argument("--use-gpu", action="store_true", default=True)
+	# cpu core partitioning of the cold (normal) batches: embedding work on
+	# --emb-cores, mlp work on --mlp-cores (cpulists, e.g. 0-13)
+	parser.add_argument("--emb-cores", type=str, default="")
+	parser.add_argument("--mlp-cores", type=str, default="")
+	parser.add_argument("--emb-threads", type=int, default=-1)
+	parser.add_argument("--mlp-threads", type=int, default=-1)
+	parser.add_argument("--num-micro-batches", type=int, default=2)
+	# or train the cold batches on hogwild worker threads: lock-free embedding
+	# updates, mlp updates locked (lock) or averaged (average)
+	parser.add_argument("--hogwild-workers", type=int, default=0)
+	parser.add_argument("--hogwild-cores", type=str, default="")
+	parser.add_argument("--hogwild-dense", type=str, default="lock")
+	parser.add_argument("--hogwild-sync-freq", type=int, default=1)
 	# debugging and profiling
 	parser.add_argument("--print-freq", type=int, default=1)
 	parser.add_argument("--test-freq", type=int, default=-1)
@@ -663,12 +734,26 @@ if __name__ == "__main__":
 	parser.add_argument("--mlperf-auc-threshold", type=float, default=0.0)
 	parser.add_argument("--mlperf-bin-loader", action='store_true', default=False)
 	parser.add_argument("--mlperf-bin-shuffle", action='store_true', default=False)
+	# shuffle the samples within windows of batches (0: whole batches only)
+	parser.add_argument("--mlperf-bin-shuffle-window", type=int, default=0)
+	parser.add_argument("--mlperf-bin-read-ahead", action='store_true', default=False)
 	# LR policy
 	parser.add_argument("--lr-num-warmup-steps", type=int, default=0)
 	parser.add_argument("--lr-decay-start-step", type=int, default=0)
 	parser.add_argument("--lr-num-decay-steps", type=int, default=0)
+	# multi-process cpu data parallelism (launch with torchrun), the cold
+	# tables are held by --dist-cold-owner
+	parser.add_argument("--dist-backend", type=str, default="")  # gloo
+	parser.add_argument("--dist-cold-owner", type=int, default=0)
+	# or shard the cold tables across the ranks, whole tables or row ranges,
+	# placed using the row counts and the access counts saved by the profiler
+	parser.add_argument("--dist-cold-sharding", type=str, default="")  # table or row
+	parser.add_argument("--emb-access-file", type=str, default="")  # emb_access_count.npz
 	args = parser.parse_args()
 
+	if args.dist_backend != "":
+		ext_dist.init_distributed(backend=args.dist_backend)
+
 	if args.mlperf_logging:
 		print('command line args: ', json.dumps(vars(args)))
 
@@ -685,7 +770,11 @@ if __name__ == "__main__":
 		# if the parameter is not set, use the same parameter for training
 		args.test_num_workers = args.num_workers
 
-	use_gpu = args.use_gpu and torch.cuda.is_available()
+	use_gpu = args.use_gpu and torch.cuda.is_available() and not ext_dist.is_enabled()
+	shard_cold = ext_dist.is_enabled() and args.dist_cold_sharding != ""
+	# rank holding the whole cold tables
+	own_cold = not ext_dist.is_enabled() or (
+		not shard_cold and ext_dist.my_rank == args.dist_cold_owner)
 	if use_gpu:
 		torch.cuda.manual_seed_all(args.numpy_rand_seed)
 		torch.backends.cudnn.deterministic = True
@@ -703,7 +792,7 @@ if __name__ == "__main__":
 	if (args.data_generation == "dataset"):
 
 		# =================== Commenting actual dataset load and using just test data =====================
-		test_ld = dp.load_test_data_and_loaders(args)
+		test_ld = dp.load_test_data_and_loaders(args, distributed=ext_dist.is_enabled())
 		# =================================================================================================
 
 		# ============================== Loading processed hot data and normal data =======================
@@ -712,11 +801,14 @@ if __name__ == "__main__":
 		train_normal = np.load(args.train_normal_file, allow_pickle = True)
 		train_normal = train_normal['arr_0']
 		train_normal = train_normal.tolist()
+		# one copy of the rows in shared memory for all the loader workers
+		train_normal = shared_dataset.share_rows(train_normal, args.num_workers)
 		print("Length Train normal : ", len(train_normal))
 
 		train_hot = np.load(args.train_hot_file, allow_pickle = True)
 		train_hot = train_hot['arr_0']
 		train_hot = train_hot.tolist()
+		train_hot = shared_dataset.share_rows(train_hot, args.num_workers)
 		print("Length Train hot : ", len(train_hot))
 
 		hot_emb_dict = np.load(args.hot_emb_dict_file, allow_pickle = True)
@@ -727,6 +819,9 @@ if __name__ == "__main__":
 		for i, dict in enumerate(hot_emb_dict):
 			ln_hot_emb	= ln_hot_emb + len(dict)
 		print("ln_hot_emb : ", ln_hot_emb)
+		# (cold row, hot row) pairs per table, for the distributed copies
+		cold_rows = [torch.tensor([row for (_, row) in d], dtype=torch.long) for d in hot_emb_dict]
+		hot_rows = [torch.tensor([d[key] for key in d], dtype=torch.long) for d in hot_emb_dict]
 		
 
 		path = args.raw_data_file.split('/')
@@ -736,7 +831,8 @@ if __name__ == "__main__":
 		data = np.load(path)
 		counts = data["counts"]
 
-		train_hot_ld, train_normal_ld = dp.load_criteo_preprocessed_data_and_loaders(args, train_hot, train_normal)
+		train_hot_ld, train_normal_ld = dp.load_criteo_preprocessed_data_and_loaders(
+			args, train_hot, train_normal, distributed=ext_dist.is_enabled())
 	
 		# ===================================================================================================
 		nbatches_hot = args.num_batches if args.num_batches > 0 else len(train_hot_ld)
@@ -911,7 +1007,36 @@ if __name__ == "__main__":
 		qr_threshold=args.qr_threshold,
 		md_flag=args.md_flag,
 		md_threshold=args.md_threshold,
+		device=device,
+		create_cold_emb=own_cold,
 	)
+	if shard_cold:
+		# cold lookups go through the owners of the shards
+		access = None
+		if args.emb_access_file != "":
+			access = np.load(args.emb_access_file)
+			access = [access["arr_%d" % k].astype(np.float64) for k in range(ln_emb.size)]
+			# only the cold rows are looked up in the cold tables
+			for k in range(ln_emb.size):
+				access[k][cold_rows[k].numpy()] = 0
+		shards, rank_cost = ext_dist.plan_emb_shards(
+			ln_emb, ext_dist.my_size, args.dist_cold_sharding, access)
+		print("Cold EMB shards (table, row begin, row end, rank) : ", shards)
+		print("Cold EMB cost per rank : ", rank_cost)
+		dlrm.cold_emb = ext_dist.ShardedEmbeddings(shards, ln_emb, m_spa)
+		dlrm.emb_l = dlrm.cold_emb.local_emb
+	elif ext_dist.is_enabled():
+		# cold lookups go through the owner rank
+		dlrm.cold_emb = ext_dist.OwnedEmbeddings(
+			dlrm.emb_l, dlrm.apply_emb, [m_den_out] * ln_emb.size, args.dist_cold_owner)
+	if ext_dist.is_enabled():
+		# the replicas start identical
+		ext_dist.broadcast_params(
+			list(dlrm.bot_l.parameters())
+			+ list(dlrm.top_l.parameters())
+			+ list(dlrm.hot_emb_l.parameters()),
+			src=args.dist_cold_owner
+		)
 	# test prints
 	if args.debug_mode:
 		print("initial parameters (weights and bias):")
@@ -936,6 +1061,36 @@ if __name__ == "__main__":
 		lr_scheduler = LRPolicyScheduler(optimizer, args.lr_num_warmup_steps, args.lr_decay_start_step,
 										 args.lr_num_decay_steps)
 
+	# with sharded cold tables every rank saves its own shards
+	save_model_file = args.save_model
+	if shard_cold and args.save_model != "":
+		save_model_file = args.save_model + ".rank" + str(ext_dist.my_rank)
+
+	# pipeline the cold batches across pinned embedding and mlp worker pools
+	# (the cold embeddings stay on the CPU, the mlps run on device)
+	partition = None
+	if args.emb_cores != "" and args.mlp_cores != "" and not ext_dist.is_enabled() \
+			and args.hogwild_workers == 0:
+		partition = cpu_partition.PartitionedTrainer(
+			cpu_partition.parse_core_list(args.emb_cores),
+			cpu_partition.parse_core_list(args.mlp_cores),
+			emb_threads=args.emb_threads,
+			mlp_threads=args.mlp_threads,
+			num_micro_batches=args.num_micro_batches,
+			dense_device=device,
+		)
+
+	hogwild = None
+	if args.hogwild_workers > 0 and not args.inference_only and not ext_dist.is_enabled():
+		hogwild = cpu_hogwild.HogwildTrainer(
+			dlrm,
+			args.hogwild_workers,
+			cpu_partition.parse_core_list(args.hogwild_cores),
+			dense=args.hogwild_dense,
+			sync_freq=args.hogwild_sync_freq,
+			dense_device=device,
+		)
+
 	### main loop ###
 	def time_wrap(use_gpu):
 		if use_gpu:
@@ -1073,8 +1228,17 @@ if __name__ == "__main__":
 			if args.mlperf_logging:
 				previous_iteration_time = None
 
+			train_normal_iter = train_normal_ld
+			if hogwild is not None:
+				# the batches are trained by the workers, in completion order
+				train_normal_iter = hogwild.train(
+					train_normal_ld, nbatches_normal,
+					lambda Z, T: loss_fn_wrap(Z, T, use_gpu, device),
+					optimizer
+				)
+
 			# Using Normal Train Data
-			for j, (X, lS_o, lS_i, T) in enumerate(train_normal_ld):
+			for j, (X, lS_o, lS_i, T) in enumerate(train_normal_iter):
 				data = "normal"
 
 				if j < skip_upto_batch:
@@ -1099,12 +1263,24 @@ if __name__ == "__main__":
 				begin_forward = time_wrap(use_gpu)
 				# forward pass
 				
-				Z = dlrm_wrap(X, lS_o, lS_i, use_gpu, device, data)
+				if hogwild is not None:
+					# forward, backward and update already ran on a worker
+					Z, E = hogwild.last_output
+				elif partition is not None:
+					# forward, backward and update are pipelined across the pools
+					Z, E = partition.train_step(
+						dlrm, X, lS_o, lS_i, T,
+						lambda Z, T: loss_fn_wrap(Z, T, use_gpu, device),
+						None if args.inference_only else optimizer
+					)
+				else:
+					Z = dlrm_wrap(X, lS_o, lS_i, use_gpu, device, data)
 
 				end_forward = time_wrap(use_gpu)
 
 				# loss
-				E = loss_fn_wrap(Z, T, use_gpu, device)
+				if partition is None and hogwild is None:
+					E = loss_fn_wrap(Z, T, use_gpu, device)
 				
 				# compute loss and accuracy
 				L = E.detach().cpu().numpy()  # numpy array
@@ -1113,12 +1289,22 @@ if __name__ == "__main__":
 				mbs = T.shape[0]  # = args.mini_batch_size except maybe for last
 				A = np.sum((np.round(S, 0) == T).astype(np.uint8))
 
-				if not args.inference_only:
+				if not args.inference_only and (partition is not None or hogwild is not None):
+					# backward and optimizer already ran inside train_step (or on a worker)
+					end_backward = end_forward
+					end_optimizing = end_forward
+
+					lr_scheduler.step()
+
+					end_scheduling = time_wrap(use_gpu)
+				elif not args.inference_only:
 					# scaled error gradient propagation
 					# (where we do not accumulate gradients across mini-batches)
 					optimizer.zero_grad()
 					# backward pass
 					E.backward()
+					if ext_dist.is_enabled():
+						dlrm.distributed_backward(data)
 					# debug prints (check gradient norm)
 					# for l in mlp.layers:
 					#     if hasattr(l, 'weight'):
@@ -1162,6 +1348,10 @@ if __name__ == "__main__":
 					gT = 1000.0 * total_time / total_iter if args.print_time else -1
 					total_time = 0
 
+					if ext_dist.is_enabled():
+						total_accu, total_loss, total_samp = ext_dist.all_reduce_sum(
+							[total_accu, total_loss, total_samp])
+
 					gA = total_accu / total_samp
 					total_accu = 0
 
@@ -1189,6 +1379,13 @@ if __name__ == "__main__":
 					print("Loss ", gL)
 					print("Accuracy ", gA*100)
 					print("Train_data ", data)
+					if ext_dist.is_enabled():
+						# communication volume per iteration (summed over the ranks)
+						comm = ext_dist.comm_report()
+						print("Emb_comm_MB ", comm["emb"] / total_iter)
+						print("Allreduce_comm_MB ", comm["allreduce"] / total_iter)
+					if partition is not None:
+						partition.report()
 					print("\n")
 
 					# Uncomment the line below to print out the total time with overhead
@@ -1254,6 +1451,9 @@ if __name__ == "__main__":
 					if args.mlperf_logging:
 						scores = np.concatenate(scores, axis=0)
 						targets = np.concatenate(targets, axis=0)
+						if ext_dist.is_enabled():
+							scores = torch.cat(ext_dist.all_gather_varlen(torch.tensor(scores))).numpy()
+							targets = torch.cat(ext_dist.all_gather_varlen(torch.tensor(targets))).numpy()
 
 						metrics = {
 							'loss' : sklearn.metrics.log_loss,
@@ -1304,14 +1504,17 @@ if __name__ == "__main__":
 						gA_test = validation_results['accuracy']
 						gL_test = validation_results['loss']
 					else:
+						if ext_dist.is_enabled():
+							test_accu, test_loss, test_samp = ext_dist.all_reduce_sum(
+								[test_accu, test_loss, test_samp])
 						gA_test = test_accu / test_samp
 						gL_test = test_loss / test_samp
 
 					is_best = gA_test > best_gA_test
 					if is_best:
 						best_gA_test = gA_test
-						if not (args.save_model == ""):
-							print("Saving model to {}".format(args.save_model))
+						if not (args.save_model == "") and (own_cold or shard_cold):
+							print("Saving model to {}".format(save_model_file))
 							torch.save(
 								{
 									"epoch": k,
@@ -1328,7 +1531,7 @@ if __name__ == "__main__":
 									"total_accu": total_accu,
 									"opt_state_dict": optimizer.state_dict(),
 								},
-								args.save_model,
+								save_model_file,
 							)
 
 					if args.mlperf_logging:
@@ -1385,11 +1588,16 @@ if __name__ == "__main__":
 			if stop == 0:
 				begin_emb_update = time_wrap(use_gpu)
 
-				for _, emb_dict in enumerate(hot_emb_dict):
-					for _, (emb_no, emb_row) in enumerate(emb_dict):
-						hot_row = emb_dict[(emb_no, emb_row)]
-						data = dlrm.emb_l[emb_no].weight.data[emb_row]
-						dlrm.hot_emb_l[0].weight.data[hot_row] = data
+				if ext_dist.is_enabled():
+					# every replica reads the rows from their owners
+					for k in range(len(hot_emb_dict)):
+						dlrm.hot_emb_l[0].weight.data[hot_rows[k]] = dlrm.cold_emb.read_rows(k, cold_rows[k])
+				else:
+					for _, emb_dict in enumerate(hot_emb_dict):
+						for _, (emb_no, emb_row) in enumerate(emb_dict):
+							hot_row = emb_dict[(emb_no, emb_row)]
+							data = dlrm.emb_l[emb_no].weight.data[emb_row]
+							dlrm.hot_emb_l[0].weight.data[hot_row] = data
 
 				end_emb_update = time_wrap(use_gpu)
 
@@ -1446,6 +1654,8 @@ if __name__ == "__main__":
 						optimizer.zero_grad()
 						# backward pass
 						E.backward()
+						if ext_dist.is_enabled():
+							dlrm.distributed_backward(data)
 
 						end_backward = time_wrap(use_gpu)
 
@@ -1485,6 +1695,10 @@ if __name__ == "__main__":
 						gT = 1000.0 * total_time / total_iter if args.print_time else -1
 						total_time = 0
 
+						if ext_dist.is_enabled():
+							total_accu, total_loss, total_samp = ext_dist.all_reduce_sum(
+								[total_accu, total_loss, total_samp])
+
 						gA = total_accu / total_samp
 						total_accu = 0
 
@@ -1512,6 +1726,11 @@ if __name__ == "__main__":
 						print("Loss ", gL)
 						print("Accuracy ", gA*100)
 						print("Train_data ", data)
+						if ext_dist.is_enabled():
+							# communication volume per iteration (summed over the ranks)
+							comm = ext_dist.comm_report()
+							print("Emb_comm_MB ", comm["emb"] / total_iter)
+							print("Allreduce_comm_MB ", comm["allreduce"] / total_iter)
 						print("\n")
 
 						total_iter = 0
@@ -1530,13 +1749,19 @@ if __name__ == "__main__":
 						
 						begin_emb_update = time_wrap(use_gpu)
 
-						hot_emb = dlrm.hot_emb_l[0].weight.detach().cpu().numpy()
+						if ext_dist.is_enabled():
+							# the hot replicas are identical, the owners update their rows
+							hot_emb = dlrm.hot_emb_l[0].weight.detach()
+							for k in range(len(hot_emb_dict)):
+								dlrm.cold_emb.write_rows(k, cold_rows[k], hot_emb[hot_rows[k]])
+						else:
+							hot_emb = dlrm.hot_emb_l[0].weight.detach().cpu().numpy()
 						
-						for _, emb_dict in enumerate(hot_emb_dict):
-							for _, (emb_no, emb_row) in enumerate(emb_dict):
-								hot_row = emb_dict[(emb_no, emb_row)]
-								data = torch.tensor(hot_emb[hot_row])
-								dlrm.emb_l[emb_no].weight.data[emb_row] = data
+							for _, emb_dict in enumerate(hot_emb_dict):
+								for _, (emb_no, emb_row) in enumerate(emb_dict):
+									hot_row = emb_dict[(emb_no, emb_row)]
+									data = torch.tensor(hot_emb[hot_row])
+									dlrm.emb_l[emb_no].weight.data[emb_row] = data
 
 						end_emb_update = time_wrap(use_gpu)
 
@@ -1590,6 +1815,9 @@ if __name__ == "__main__":
 						if args.mlperf_logging:
 							scores = np.concatenate(scores, axis=0)
 							targets = np.concatenate(targets, axis=0)
+							if ext_dist.is_enabled():
+								scores = torch.cat(ext_dist.all_gather_varlen(torch.tensor(scores))).numpy()
+								targets = torch.cat(ext_dist.all_gather_varlen(torch.tensor(targets))).numpy()
 
 							metrics = {
 								'loss' : sklearn.metrics.log_loss,
@@ -1640,14 +1868,17 @@ if __name__ == "__main__":
 							gA_test = validation_results['accuracy']
 							gL_test = validation_results['loss']
 						else:
+							if ext_dist.is_enabled():
+								test_accu, test_loss, test_samp = ext_dist.all_reduce_sum(
+									[test_accu, test_loss, test_samp])
 							gA_test = test_accu / test_samp
 							gL_test = test_loss / test_samp
 
 						is_best = gA_test > best_gA_test
 						if is_best:
 							best_gA_test = gA_test
-							if not (args.save_model == ""):
-								print("Saving model to {}".format(args.save_model))
+							if not (args.save_model == "") and (own_cold or shard_cold):
+								print("Saving model to {}".format(save_model_file))
 								torch.save(
 									{
 										"epoch": k,
@@ -1664,7 +1895,7 @@ if __name__ == "__main__":
 										"total_accu": total_accu,
 										"opt_state_dict": optimizer.state_dict(),
 									},
-									args.save_model,
+									save_model_file,
 								)
 
 						if args.mlperf_logging:
@@ -1719,13 +1950,19 @@ if __name__ == "__main__":
 						
 				begin_emb_update = time_wrap(use_gpu)
 
-				hot_emb = dlrm.hot_emb_l[0].weight.detach().cpu().numpy()
+				if ext_dist.is_enabled():
+					# the hot replicas are identical, the owners update their rows
+					hot_emb = dlrm.hot_emb_l[0].weight.detach()
+					for k in range(len(hot_emb_dict)):
+						dlrm.cold_emb.write_rows(k, cold_rows[k], hot_emb[hot_rows[k]])
+				else:
+					hot_emb = dlrm.hot_emb_l[0].weight.detach().cpu().numpy()
 							
-				for _, emb_dict in enumerate(hot_emb_dict):
-					for _, (emb_no, emb_row) in enumerate(emb_dict):
-						hot_row = emb_dict[(emb_no, emb_row)]
-						data = torch.tensor(hot_emb[hot_row])
-						dlrm.emb_l[emb_no].weight.data[emb_row] = data
+					for _, emb_dict in enumerate(hot_emb_dict):
+						for _, (emb_no, emb_row) in enumerate(emb_dict):
+							hot_row = emb_dict[(emb_no, emb_row)]
+							data = torch.tensor(hot_emb[hot_row])
+							dlrm.emb_l[emb_no].weight.data[emb_row] = data
 
 				end_emb_update = time_wrap(use_gpu)
 
@@ -1739,6 +1976,11 @@ if __name__ == "__main__":
 		accum_time_end = time_wrap(use_gpu)
 		print("Total_Execution_Time ", 1000*(accum_time_end - accum_time_begin))
 
+	if partition is not None:
+		partition.shutdown()
+	if hogwild is not None:
+		hogwild.shutdown()
+
 	# profiling
 	if args.enable_profiling:
 		with open("dlrm_s_pytorch.prof", "w") as prof_f:
@@ -67,6 +67,7 @@ import math
 import subprocess
 # data generation
 import dlrm_data_pytorch as dp
+import data_utils
 
 # numpy
 import numpy as np
@@ -154,6 +155,14 @@ if __name__ == "__main__":
 						with more than 7 CPU cores and more than 20 GB of memory. \n \
 						The Terabyte dataset can be multiprocessed in an environment \
 						with more than 24 CPU cores and at least 1 TB of memory.")
+	# categories renumbered by descending frequency (hot rows first)
+	parser.add_argument("--data-renumber-by-freq", action="store_true", default=False)
+	# format of the pre-processed day files: npz (compressed) or npy (raw, can be memory-mapped)
+	parser.add_argument("--data-intermediate-format", type=str, choices=["npz", "npy"], default="npz")
+	# memory budget (GB) of the shuffle across days when pre-processing with --memory-map
+	parser.add_argument("--data-shuffle-mem-gb", type=float, default=16.0)
+	# store log(x + 1) of the dense and the narrowest type of the sparse features
+	parser.add_argument("--data-precompute-features", action="store_true", default=False)
 	# mlperf logging (disables other output and stops early)
 	parser.add_argument("--mlperf-logging", action="store_true", default=False)
 	# stop at target accuracy Kaggle 0.789, Terabyte (sub-sampled=0.875) 0.8107
@@ -162,6 +171,9 @@ if __name__ == "__main__":
 	parser.add_argument("--mlperf-auc-threshold", type=float, default=0.0)
 	parser.add_argument("--mlperf-bin-loader", action='store_true', default=False)
 	parser.add_argument("--mlperf-bin-shuffle", action='store_true', default=False)
+	# shuffle the samples within windows of batches (0: whole batches only)
+	parser.add_argument("--mlperf-bin-shuffle-window", type=int, default=0)
+	parser.add_argument("--mlperf-bin-read-ahead", action='store_true', default=False)
 	# training
 	parser.add_argument("--mini-batch-size", type=int, default=1)
 	# debugging and profiling
@@ -218,55 +230,83 @@ if __name__ == "__main__":
 	sampled_train_data = np.random.randint(0, len(train_data), size = sample_train_data_len)
 	print("Sampled Training Input Dataset Length (D^) : ", len(sampled_train_data))
 
-	# ================== Skew Table Creation ======================
-	skew_table = []
+	if args.data_renumber_by_freq:
+		# =================== Per-table cut points =========================
+		# the categories are ranked by frequency at pre-processing time, so the
+		# hot rows of table t are simply the ids < hot_cut[t]; the cut points are
+		# chosen on the (full) frequencies saved with the id map
+		_, emb_freq = data_utils.loadCriteoFreqMap(train_data.d_path, train_data.d_file)
+		emb_access_count = [emb_freq[i][0:ln_emb[i]] for i in range(len(ln_emb))]
+		freq_all = np.concatenate(emb_access_count)
+		table_all = np.repeat(np.arange(len(ln_emb)), [len(f) for f in emb_access_count])
+		top = np.argsort(-freq_all, kind="stable")[0:num_hot_emb]
+		hot_cut = np.bincount(table_all[top], minlength=len(ln_emb))
+		hot_offset = np.concatenate(([0], np.cumsum(hot_cut)[:-1]))
+		del freq_all, table_all, top
+		for i in range(len(ln_emb)):
+			print("Table ", i, " hot rows : ", hot_cut[i], " / ", ln_emb[i])
+
+		# hot row (t, r) is stored at hot_offset[t] + r of the hot embedding table
+		hot_emb_dict = []
+		for i in range(len(ln_emb)):
+			hot_emb_dict.append(
+				{(i, j): np.float32(hot_offset[i] + j) for j in range(hot_cut[i])}
+			)
+		len_hot_emb_dict = int(np.sum(hot_cut))
+		print("Hot Emb Dict Size : ", (len_hot_emb_dict * 4 * args.arch_sparse_feature_size) / (1024 ** 2), " MB")
+	else:
+		# ================== Skew Table Creation ======================
+		skew_table = []
 			
-	for i in range(len(ln_emb)):
-		temp_list = np.zeros((ln_emb[i],3), dtype = int)
-		skew_table.append(temp_list)
-
-	# =================== Filling Skew Table Emb Table ======================
-	for i in range(len(ln_emb)):
-		for j in range(ln_emb[i]):
-			skew_table[i][j][0] = i
+		for i in range(len(ln_emb)):
+			temp_list = np.zeros((ln_emb[i],3), dtype = int)
+			skew_table.append(temp_list)
+
+		# =================== Filling Skew Table Emb Table ======================
+		for i in range(len(ln_emb)):
+			for j in range(ln_emb[i]):
+				skew_table[i][j][0] = i
 			
-	# =================== Filling Skew Table Emb Index ======================
-	for i in range(len(ln_emb)):
-		for j in range(ln_emb[i]):
-			skew_table[i][j][1] = j	
-
-	# =================== Filling Skew Table Emb Counter ======================
-	# Updating Skew table with sampled input profiling data
-	for i, sample in enumerate(sampled_train_data):
-		X, lS_i, label = train_data[sample]
-		for j, lS_i_index in enumerate(lS_i):
-			skew_table[j][int(lS_i_index)][2] = skew_table[j][int(lS_i_index)][2] + 1
-
-	# Combining skew table list into a 2D array
-	skew_table_array = np.vstack(skew_table) 
-
-	# =================== Sorting Skew Table based on Counter ==============
-	skew_table_array = skew_table_array[skew_table_array[:,2].argsort()[::-1]]
+		# =================== Filling Skew Table Emb Index ======================
+		for i in range(len(ln_emb)):
+			for j in range(ln_emb[i]):
+				skew_table[i][j][1] = j	
+
+		# =================== Filling Skew Table Emb Counter ======================
+		# Updating Skew table with sampled input profiling data
+		for i, sample in enumerate(sampled_train_data):
+			X, lS_i, label = train_data[sample]
+			for j, lS_i_index in enumerate(lS_i):
+				skew_table[j][int(lS_i_index)][2] = skew_table[j][int(lS_i_index)][2] + 1
+
+		# Sampled access counts per embedding row (used to place the embedding shards)
+		emb_access_count = [skew_table[i][:, 2] for i in range(len(ln_emb))]
+
+		# Combining skew table list into a 2D array
+		skew_table_array = np.vstack(skew_table) 
+
+		# =================== Sorting Skew Table based on Counter ==============
+		skew_table_array = skew_table_array[skew_table_array[:,2].argsort()[::-1]]
 			
-	# =================== Getting hot embedding entries ====================
-	hot_emb_entries = skew_table_array[0:num_hot_emb]
-
-	# =================== Getting Top Emb Dict ==============================
-	hot_emb_dict = []
-	emb_dict = {}
-	for i in range(len(ln_emb)):
-		new_emb_dict = copy.deepcopy(emb_dict)
-		hot_emb_dict.append(new_emb_dict)
-
-	for i in range(len(hot_emb_entries)):
-		hot_emb_dict[hot_emb_entries[i][0]][(hot_emb_entries[i][0], hot_emb_entries[i][1])] = np.float32(i)
+		# =================== Getting hot embedding entries ====================
+		hot_emb_entries = skew_table_array[0:num_hot_emb]
+
+		# =================== Getting Top Emb Dict ==============================
+		hot_emb_dict = []
+		emb_dict = {}
+		for i in range(len(ln_emb)):
+			new_emb_dict = copy.deepcopy(emb_dict)
+			hot_emb_dict.append(new_emb_dict)
+
+		for i in range(len(hot_emb_entries)):
+			hot_emb_dict[hot_emb_entries[i][0]][(hot_emb_entries[i][0], hot_emb_entries[i][1])] = np.float32(i)
 	
-	len_hot_emb_dict = 0
-	for i in range(len(hot_emb_dict)):
-		len_hot_emb_dict += len(hot_emb_dict[i])
+		len_hot_emb_dict = 0
+		for i in range(len(hot_emb_dict)):
+			len_hot_emb_dict += len(hot_emb_dict[i])
 
-	del skew_table_array
-	print("Hot Emb Dict Size : ", (len_hot_emb_dict * 4 * args.arch_sparse_feature_size) / (1024 ** 2), " MB")
+		del skew_table_array
+		print("Hot Emb Dict Size : ", (len_hot_emb_dict * 4 * args.arch_sparse_feature_size) / (1024 ** 2), " MB")
 	print("Hot Emb Dict Creation Completed!!")
 	
 	# ===================== Input Profiling ========================
@@ -276,6 +316,15 @@ if __name__ == "__main__":
 	train_normal = []
 
 	for i, train_tuple in enumerate(train_data):
+		if args.data_renumber_by_freq:
+			# hot iff every id is below the cut point of its table
+			if np.all(train_tuple[1] < hot_cut):
+				lS_i = (hot_offset + train_tuple[1]).astype(np.float32)
+				train_hot.append((train_tuple[0], lS_i, train_tuple[2]))
+			else:
+				train_normal.append(train_tuple)
+			continue
+
 		lS_i = []
 		for j, lS_i_index in enumerate(train_tuple[1]):
 			if (j, int(lS_i_index)) in hot_emb_dict[j].keys():
@@ -307,10 +356,12 @@ if __name__ == "__main__":
 		np.savez_compressed('./input/kaggle/kaggle_hot_cold/train_hot.npz', train_hot)
 		np.savez_compressed('./input/kaggle/kaggle_hot_cold/train_normal.npz', train_normal)
 		np.savez_compressed('./input/kaggle/kaggle_hot_cold/hot_emb_dict.npz', hot_emb_dict)
+		np.savez_compressed('./input/kaggle/kaggle_hot_cold/emb_access_count.npz', *emb_access_count)
 	elif args.data_set == "terabyte":
 		np.savez_compressed('./input/terabyte/terabyte_hot_cold/train_hot.npz', train_hot)
 		np.savez_compressed('./input/terabyte/terabyte_hot_cold/train_normal.npz', train_normal)
 		np.savez_compressed('./input/terabyte/terabyte_hot_cold/hot_emb_dict.npz', hot_emb_dict)
+		np.savez_compressed('./input/terabyte/terabyte_hot_cold/emb_access_count.npz', *emb_access_count)
 				
 	print("Save Hot/Cold Data Completed")
 	sys.exit("FAE pre-processing completed!!")
\ No newline at end of file
@@ -62,6 +62,8 @@ import time
 import json
 # data generation
 import dlrm_data_pytorch as dp
+# model-parallel embeddings
+import extend_distributed as ext_dist
 
 # numpy
 import numpy as np
@@ -229,6 +231,7 @@ class DLRM_Net(nn.Module):
 		qr_threshold=200,
 		md_flag=False,
 		md_threshold=200,
+		create_emb=True,
 	):
 		super(DLRM_Net, self).__init__()
 
@@ -259,9 +262,11 @@ class DLRM_Net(nn.Module):
 			self.md_flag = md_flag
 			if self.md_flag:
 				self.md_threshold = md_threshold
+			# embedding tables sharded across the ranks (distributed mode only)
+			self.sharded_emb = None
 			# create operators
 			
-			self.emb_l = self.create_emb(m_spa, ln_emb)
+			self.emb_l = self.create_emb(m_spa, ln_emb) if create_emb else nn.ModuleList()
 			print(ln_emb)
 			self.bot_l = self.create_mlp(ln_bot, sigmoid_bot)
 			self.top_l = self.create_mlp(ln_top, sigmoid_top)
@@ -346,7 +351,10 @@ class DLRM_Net(nn.Module):
 		# print(x.detach().cpu().numpy())
 
 		# process sparse features(using embeddings), resulting in a list of row vectors
-		ly = self.apply_emb(lS_o, lS_i, self.emb_l)
+		if self.sharded_emb is not None:
+			ly = self.sharded_emb.forward(lS_o, lS_i, requires_grad=torch.is_grad_enabled())
+		else:
+			ly = self.apply_emb(lS_o, lS_i, self.emb_l)
 		#print(len(ly))
 		#print(ly)
 		#sys.exit(1)
@@ -453,6 +461,18 @@ if __name__ == "__main__":
 						with more than 7 CPU cores and more than 20 GB of memory. \n \
 						The Terabyte dataset can be multiprocessed in an environment \
 						with more than 24 CPU cores and at least 1 TB of memory.")
+	# categories renumbered by descending frequency (hot rows first)
+	parser.add_argument("--data-renumber-by-freq", action="store_true", default=False)
+	# format of the pre-processed day files: npz (compressed) or npy (raw, can be memory-mapped)
+	parser.add_argument("--data-intermediate-format", type=str, choices=["npz", "npy"], default="npz")
+	# memory budget (GB) of the shuffle across days when pre-processing with --memory-map
+	parser.add_argument("--data-shuffle-mem-gb", type=float, default=16.0)
+	# store log(x + 1) of the dense and the narrowest type of the sparse features
+	parser.add_argument("--data-precompute-features", action="store_true", default=False)
+	# stop once the data is pre-processed and the loaders are built
+	parser.add_argument("--preprocess-only", action="store_true", default=False)
+	# cache of the collated batches, replayed by later epochs and runs ("": none)
+	parser.add_argument("--batch-cache-dir", type=str, default="")
 	# training
 	parser.add_argument("--mini-batch-size", type=int, default=1)
 	parser.add_argument("--nepochs", type=int, default=1)
@@ -486,12 +506,24 @@ if __name__ == "__main__":
 	parser.add_argument("--mlperf-auc-threshold", type=float, default=0.0)
 	parser.add_argument("--mlperf-bin-loader", action='store_true', default=False)
 	parser.add_argument("--mlperf-bin-shuffle", action='store_true', default=False)
+	# shuffle the samples within windows of batches (0: whole batches only)
+	parser.add_argument("--mlperf-bin-shuffle-window", type=int, default=0)
+	parser.add_argument("--mlperf-bin-read-ahead", action='store_true', default=False)
 	# LR policy
 	parser.add_argument("--lr-num-warmup-steps", type=int, default=0)
 	parser.add_argument("--lr-decay-start-step", type=int, default=0)
 	parser.add_argument("--lr-num-decay-steps", type=int, default=0)
+	# multi-process cpu training (launch with torchrun): the embedding tables
+	# are sharded across the ranks, whole tables or row ranges, placed using
+	# the row counts and the access counts saved by the profiler
+	parser.add_argument("--dist-backend", type=str, default="")  # gloo
+	parser.add_argument("--emb-sharding", type=str, default="table")  # or row
+	parser.add_argument("--emb-access-file", type=str, default="")  # emb_access_count.npz
 	args = parser.parse_args()
 
+	if args.dist_backend != "":
+		ext_dist.init_distributed(backend=args.dist_backend)
+
 	if args.mlperf_logging:
 		print('command line args: ', json.dumps(vars(args)))
 
@@ -519,7 +551,7 @@ if __name__ == "__main__":
 	if (args.data_generation == "dataset"):
 
 		train_data, train_ld, test_data, test_ld = \
-			dp.make_criteo_data_and_loaders(args)
+			dp.make_criteo_data_and_loaders(args, distributed=ext_dist.is_enabled())
 		nbatches = args.num_batches if args.num_batches > 0 else len(train_ld)
 		nbatches_test = len(test_ld)
 
@@ -536,10 +568,12 @@ if __name__ == "__main__":
 		# input and target at random
 		ln_emb = np.fromstring(args.arch_embedding_size, dtype=int, sep="-")
 		m_den = ln_bot[0]
-		train_data, train_ld = dp.make_random_data_and_loader(args, ln_emb, m_den)
+		train_data, train_ld = dp.make_random_data_and_loader(
+			args, ln_emb, m_den, distributed=ext_dist.is_enabled())
 		nbatches = args.num_batches if args.num_batches > 0 else len(train_ld)
 
-	sys.exit("Data pre-processing completed!!")
+	if args.preprocess_only:
+		sys.exit("Data pre-processing completed!!")
 
 	### parse command line arguments ###
 	m_spa = args.arch_sparse_feature_size
@@ -689,7 +723,23 @@ if __name__ == "__main__":
 		qr_threshold=args.qr_threshold,
 		md_flag=args.md_flag,
 		md_threshold=args.md_threshold,
+		create_emb=not ext_dist.is_enabled(),
 	)
+	if ext_dist.is_enabled():
+		if args.qr_flag or args.md_flag:
+			sys.exit("ERROR: sharded embeddings do not support --qr-flag and --md-flag")
+		access = None
+		if args.emb_access_file != "":
+			access = np.load(args.emb_access_file)
+			access = [access["arr_%d" % k] for k in range(ln_emb.size)]
+		shards, rank_cost = ext_dist.plan_emb_shards(
+			ln_emb, ext_dist.my_size, args.emb_sharding, access)
+		print("EMB shards (table, row begin, row end, rank) : ", shards)
+		print("EMB cost per rank : ", rank_cost)
+		dlrm.sharded_emb = ext_dist.ShardedEmbeddings(shards, ln_emb, m_spa)
+		dlrm.emb_l = dlrm.sharded_emb.local_emb
+		# the mlp replicas start identical
+		ext_dist.broadcast_params(list(dlrm.bot_l.parameters()) + list(dlrm.top_l.parameters()))
 	# test prints
 	if args.debug_mode:
 		print("initial parameters (weights and bias):")
@@ -715,6 +765,11 @@ if __name__ == "__main__":
 		lr_scheduler = LRPolicyScheduler(optimizer, args.lr_num_warmup_steps, args.lr_decay_start_step,
 										 args.lr_num_decay_steps)
 
+	# with sharded embeddings every rank saves its own shards
+	save_model_file = args.save_model
+	if ext_dist.is_enabled() and args.save_model != "":
+		save_model_file = args.save_model + ".rank" + str(ext_dist.my_rank)
+
 	### main loop ###
 	def time_wrap(use_gpu):
 		return time.time()
@@ -796,7 +851,7 @@ if __name__ == "__main__":
 		)
 
 	print("time/loss/accuracy (if enabled):")
-	with torch.autograd.profiler.profile(args.enable_profiling, use_gpu) as prof:
+	with torch.autograd.profiler.profile(enabled=args.enable_profiling) as prof:
 		while k < args.nepochs:
 			if k < skip_upto_epoch:
 				continue
@@ -807,6 +862,9 @@ if __name__ == "__main__":
 				previous_iteration_time = None
 
 
+			'''
+			# hot embedding profiling of the first epoch (see dlrm_input_profiler.py),
+			# it saved the hot and normal inputs and stopped the script
 			# =============================== PROFILING START ======================================
 			profiling_begin = time_wrap(use_gpu)
 			
@@ -888,6 +946,7 @@ if __name__ == "__main__":
 				sys.exit("Dataset pre-processing completed!!")
 
 			# =============================== PROFILING END ======================================
+			'''
 
 
 
@@ -950,6 +1009,11 @@ if __name__ == "__main__":
 					optimizer.zero_grad()
 					# backward pass
 					E.backward()
+					if ext_dist.is_enabled():
+						# embedding gradients to the shard owners, mlp gradients averaged
+						dlrm.sharded_emb.backward()
+						ext_dist.all_reduce_grads(
+							list(dlrm.bot_l.parameters()) + list(dlrm.top_l.parameters()))
 
 					end_backward = time_wrap(use_gpu)
 					# debug prints (check gradient norm)
@@ -992,6 +1056,10 @@ if __name__ == "__main__":
 					gT = 1000.0 * total_time / total_iter if args.print_time else -1
 					total_time = 0
 
+					if ext_dist.is_enabled():
+						total_accu, total_loss, total_samp = ext_dist.all_reduce_sum(
+							[total_accu, total_loss, total_samp])
+
 					gA = total_accu / total_samp
 					total_accu = 0
 
@@ -1018,6 +1086,11 @@ if __name__ == "__main__":
 					print("Iteration_time ", gT)
 					print("Loss ", gL)
 					print("Accuracy ", gA*100)
+					if ext_dist.is_enabled():
+						# communication volume per iteration (summed over the ranks)
+						comm = ext_dist.comm_report()
+						print("Emb_comm_MB ", comm["emb"] / total_iter)
+						print("Allreduce_comm_MB ", comm["allreduce"] / total_iter)
 					print("\n")
 
 					
@@ -1081,6 +1154,9 @@ if __name__ == "__main__":
 					if args.mlperf_logging:
 						scores = np.concatenate(scores, axis=0)
 						targets = np.concatenate(targets, axis=0)
+						if ext_dist.is_enabled():
+							scores = torch.cat(ext_dist.all_gather_varlen(torch.tensor(scores))).numpy()
+							targets = torch.cat(ext_dist.all_gather_varlen(torch.tensor(targets))).numpy()
 
 						metrics = {
 							'loss' : sklearn.metrics.log_loss,
@@ -1131,6 +1207,9 @@ if __name__ == "__main__":
 						gA_test = validation_results['accuracy']
 						gL_test = validation_results['loss']
 					else:
+						if ext_dist.is_enabled():
+							test_accu, test_loss, test_samp = ext_dist.all_reduce_sum(
+								[test_accu, test_loss, test_samp])
 						gA_test = test_accu / test_samp
 						gL_test = test_loss / test_samp
 
@@ -1138,7 +1217,7 @@ if __name__ == "__main__":
 					if is_best:
 						best_gA_test = gA_test
 						if not (args.save_model == ""):
-							print("Saving model to {}".format(args.save_model))
+							print("Saving model to {}".format(save_model_file))
 							torch.save(
 								{
 									"epoch": k,
@@ -1155,7 +1234,7 @@ if __name__ == "__main__":
 									"total_accu": total_accu,
 									"opt_state_dict": optimizer.state_dict(),
 								},
-								args.save_model,
+								save_model_file,
 							)
 
 					if args.mlperf_logging:
@@ -0,0 +1,513 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# Description: multi-process CPU training support (torch.distributed, gloo)
+#
+# The processes are expected to be launched by torchrun (or any launcher
+# setting RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT), e.g.
+#   torchrun --nproc_per_node=8 dlrm_fae.py --dist-backend=gloo ...
+#
+# FAE data-parallel scheme:
+#   - the dense mlps and the (small) hot embedding table are replicated on
+#     every rank, each rank trains on a disjoint shard of the batches and the
+#     gradients are averaged with allreduce,
+#   - the cold embedding tables are owned by a single rank; cold lookups (and
+#     their gradients) travel to and from the owner with gather/scatter.
+# Hot batches therefore need no embedding communication at all.
+#
+# Model-parallel scheme (ShardedEmbeddings):
+#   - the embedding tables are split into shards (whole tables or row ranges)
+#     placed on the ranks by a cost-based planner (plan_emb_shards),
+#   - every rank sends the indices of its batch to the owners of the shards
+#     and receives the pooled (partial) vectors back, with all-to-all.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import heapq
+import builtins
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+
+my_rank = -1
+my_size = -1
+my_local_rank = -1
+my_local_size = -1
+
+# bytes sent through the collectives, per kind of traffic
+comm_bytes = {"emb": 0, "allreduce": 0}
+
+
+def env2int(env_list, default=-1):
+    for e in env_list:
+        val = int(os.environ.get(e, -1))
+        if val >= 0:
+            return val
+    return default
+
+
+def init_distributed(rank=-1, size=-1, backend="gloo", quiet=True):
+    global my_rank
+    global my_size
+    global my_local_rank
+    global my_local_size
+
+    if rank < 0:
+        rank = env2int(["RANK", "PMI_RANK", "OMPI_COMM_WORLD_RANK"], 0)
+    if size < 0:
+        size = env2int(["WORLD_SIZE", "PMI_SIZE", "OMPI_COMM_WORLD_SIZE"], 1)
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", "29500")
+
+    if size > 1:
+        dist.init_process_group(backend, rank=rank, world_size=size)
+        my_rank = dist.get_rank()
+        my_size = dist.get_world_size()
+    else:
+        my_rank = 0
+        my_size = 1
+    my_local_rank = env2int(["LOCAL_RANK", "MPI_LOCALRANKID"], my_rank)
+    my_local_size = env2int(["LOCAL_WORLD_SIZE", "MPI_LOCALNRANKS"], my_size)
+
+    # split the cores of the host between the local processes
+    if my_local_size > 1 and "OMP_NUM_THREADS" not in os.environ:
+        torch.set_num_threads(max(1, os.cpu_count() // my_local_size))
+
+    # only rank 0 reports (errors still go to stderr)
+    if quiet and my_rank > 0:
+        builtins.print = lambda *args, **kwargs: None
+
+    return my_rank, my_size
+
+
+def is_enabled():
+    return my_size > 1
+
+
+def barrier():
+    if is_enabled():
+        dist.barrier()
+
+
+def broadcast_params(params, src=0):
+    # make the replicated parameters identical on all ranks
+    if not is_enabled():
+        return
+    for p in params:
+        dist.broadcast(p.data, src)
+
+
+def all_reduce_sum(values):
+    # sum a list of python numbers across ranks
+    if not is_enabled():
+        return values
+    t = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(t)
+    return t.tolist()
+
+
+def all_gather_sizes(n):
+    # all_gather a python int
+    if not is_enabled():
+        return [n]
+    t = torch.tensor([n], dtype=torch.long)
+    out = [torch.zeros_like(t) for _ in range(my_size)]
+    dist.all_gather(out, t)
+    return [int(x) for x in out]
+
+
+def all_gather_varlen(t):
+    # all_gather tensors whose first dimension differs across ranks
+    if not is_enabled():
+        return [t]
+    ns = all_gather_sizes(t.shape[0])
+    pad = t.new_zeros((max(ns),) + tuple(t.shape[1:]))
+    pad[:t.shape[0]] = t
+    out = [torch.zeros_like(pad) for _ in range(my_size)]
+    dist.all_gather(out, pad)
+    return [o[:k] for (o, k) in zip(out, ns)]
+
+
+def alltoall_varlen(inputs, kind="emb"):
+    # all-to-all of 1-d tensors whose lengths differ per destination;
+    # inputs[r] is sent to rank r, returns the list of received tensors
+    if not is_enabled():
+        return [inputs[0]]
+    send_sizes = torch.tensor([t.numel() for t in inputs], dtype=torch.long)
+    recv_sizes = torch.empty_like(send_sizes)
+    dist.all_to_all_single(recv_sizes, send_sizes)
+    send_sizes = send_sizes.tolist()
+    recv_sizes = recv_sizes.tolist()
+    send = torch.cat(inputs)
+    recv = send.new_empty(sum(recv_sizes))
+    dist.all_to_all_single(recv, send, recv_sizes, send_sizes)
+    comm_bytes[kind] += (sum(send_sizes) - send_sizes[my_rank]) * send.element_size()
+    return list(torch.split(recv, recv_sizes))
+
+
+def _all_reduce_sparse_grad(p):
+    # average a sparse gradient by exchanging its (index, value) pairs
+    g = p.grad.coalesce()
+    indices = all_gather_varlen(g._indices().t().contiguous())
+    values = all_gather_varlen(g._values())
+    comm_bytes["allreduce"] += (my_size - 1) * (
+        indices[my_rank].numel() * indices[my_rank].element_size()
+        + values[my_rank].numel() * values[my_rank].element_size()
+    )
+    p.grad = torch.sparse_coo_tensor(
+        torch.cat(indices).t(), torch.cat(values) / my_size, g.shape
+    ).coalesce()
+
+
+def all_reduce_grads(params):
+    # average the gradients of the replicated parameters across ranks;
+    # dense gradients are flattened into a single buffer
+    if not is_enabled():
+        return
+    dense = []
+    for p in params:
+        if p.grad is None:
+            continue
+        if p.grad.is_sparse:
+            _all_reduce_sparse_grad(p)
+        else:
+            dense.append(p)
+    if len(dense) == 0:
+        return
+    flat = torch.cat([p.grad.reshape(-1) for p in dense])
+    dist.all_reduce(flat)
+    flat /= my_size
+    comm_bytes["allreduce"] += 2 * (my_size - 1) * flat.numel() * flat.element_size() // my_size
+    offset = 0
+    for p in dense:
+        n = p.grad.numel()
+        p.grad.copy_(flat[offset:offset + n].view_as(p.grad))
+        offset += n
+
+
+def comm_report():
+    # return and reset the communication volume (in MB, summed over the
+    # ranks) since the last report; to be called by all ranks
+    keys = sorted(comm_bytes.keys())
+    total = all_reduce_sum([comm_bytes[k] for k in keys])
+    r = {k: v / (1024 ** 2) for (k, v) in zip(keys, total)}
+    for k in comm_bytes:
+        comm_bytes[k] = 0
+    return r
+
+
+def _pack_sparse(lS_o, lS_i):
+    # [batch, n_0, ..., n_{T-1}, offsets_0, ..., indices_0, ...] as int64
+    batch = int(lS_o[0].shape[0])
+    lens = [int(S_i.shape[0]) for S_i in lS_i]
+    return torch.cat(
+        [torch.tensor([batch] + lens, dtype=torch.long)]
+        + [S_o.long().reshape(-1) for S_o in lS_o]
+        + [S_i.long().reshape(-1) for S_i in lS_i]
+    )
+
+
+def _unpack_sparse(buf, ntables):
+    batch = int(buf[0])
+    lens = buf[1:1 + ntables].tolist()
+    pos = 1 + ntables
+    lS_o = []
+    for _ in range(ntables):
+        lS_o.append(buf[pos:pos + batch])
+        pos += batch
+    lS_i = []
+    for n in lens:
+        lS_i.append(buf[pos:pos + n])
+        pos += n
+    return lS_o, lS_i
+
+
+class OwnedEmbeddings:
+    """Embedding tables held by a single (owner) rank.
+
+    Every rank calls forward with the lookups of its own batch; the owner
+    performs the lookups for everyone and sends back the pooled vectors. After
+    the local backward pass, every rank calls backward, which returns the
+    gradients of the pooled vectors to the owner and back-propagates them
+    into its tables (to be applied by the owner's optimizer step).
+    """
+
+    def __init__(self, emb_l, apply_emb, dims, owner=0):
+        # emb_l is only used on the owner (it may be empty elsewhere)
+        self.emb_l = emb_l
+        self.apply_emb = apply_emb
+        self.dims = dims
+        self.owner = owner
+        self._remote = None
+        self._local = None
+
+    def read_rows(self, k, rows):
+        # rows of table k, returned on every rank (collective)
+        if self.is_owner() or not is_enabled():
+            V = self.emb_l[k].weight.data[rows]
+        else:
+            V = torch.zeros((len(rows), self.dims[k]))
+        if is_enabled():
+            dist.broadcast(V, self.owner)
+        return V
+
+    def write_rows(self, k, rows, values):
+        if self.is_owner() or not is_enabled():
+            self.emb_l[k].weight.data[rows] = values
+
+    def is_owner(self):
+        return my_rank == self.owner
+
+    def forward(self, lS_o, lS_i, requires_grad=True):
+        if not is_enabled():
+            return self.apply_emb(lS_o, lS_i, self.emb_l)
+
+        ntables = len(lS_o)
+        batch = int(lS_o[0].shape[0])
+        buf = _pack_sparse(lS_o, lS_i)
+        sizes = all_gather_sizes(buf.numel())
+        pad = buf.new_zeros(max(sizes))
+        pad[:buf.numel()] = buf
+        comm_bytes["emb"] += 0 if self.is_owner() else pad.numel() * pad.element_size()
+
+        # send the lookups to the owner
+        if self.is_owner():
+            bufs = [torch.zeros_like(pad) for _ in range(my_size)]
+            dist.gather(pad, gather_list=bufs, dst=self.owner)
+        else:
+            dist.gather(pad, dst=self.owner)
+
+        # owner: lookups for all ranks, keeping the graph for the backward
+        dim = sum(self.dims)
+        batches = all_gather_sizes(batch)
+        recv = torch.zeros((max(batches), dim))
+        if self.is_owner():
+            self._remote = []
+            outs = []
+            with torch.set_grad_enabled(requires_grad):
+                for r in range(my_size):
+                    r_o, r_i = _unpack_sparse(bufs[r][:sizes[r]], ntables)
+                    V = torch.cat(self.apply_emb(r_o, r_i, self.emb_l), dim=1)
+                    self._remote.append(V)
+                    out = V.new_zeros((max(batches), dim))
+                    out[:V.shape[0]] = V.detach()
+                    outs.append(out)
+            dist.scatter(recv, scatter_list=outs, src=self.owner)
+        else:
+            dist.scatter(recv, src=self.owner)
+            comm_bytes["emb"] += recv.numel() * recv.element_size()
+
+        self._local = recv[:batch].clone().requires_grad_(requires_grad)
+        return list(torch.split(self._local, self.dims, dim=1))
+
+    def backward(self):
+        # return the gradients of the pooled vectors to the owner
+        if not is_enabled():
+            return
+        batch = self._local.shape[0]
+        batches = all_gather_sizes(batch)
+        g = self._local.grad
+        pad = torch.zeros((max(batches), self._local.shape[1]))
+        if g is not None:
+            pad[:batch] = g
+        if self.is_owner():
+            grads = [torch.zeros_like(pad) for _ in range(my_size)]
+            dist.gather(pad, gather_list=grads, dst=self.owner)
+            # every rank back-propagated the mean over its own batch
+            for r in range(my_size):
+                torch.autograd.backward(
+                    self._remote[r], grads[r][:batches[r]] / my_size
+                )
+        else:
+            dist.gather(pad, dst=self.owner)
+            comm_bytes["emb"] += pad.numel() * pad.element_size()
+        self._remote = None
+        self._local = None
+
+
+def plan_emb_shards(ln_emb, nranks, mode="table", access=None):
+    """Place the embedding tables on the ranks.
+
+    The cost of a table is its share of the rows (memory) plus its share of
+    the lookups (access[k] is either the total or the per-row access counts
+    of table k, by default every table is looked up equally and uniformly).
+    mode="table" keeps tables whole, mode="row" splits the tables costing more
+    than 1/nranks of the total into row ranges of balanced cost. The shards
+    are assigned greedily, largest first, to the least loaded rank.
+
+    Returns the list of shards (table, row_begin, row_end, rank) and the cost
+    per rank.
+    """
+    ntables = len(ln_emb)
+    if access is None:
+        access = [1.0] * ntables
+    row_cost = []
+    for k in range(ntables):
+        acc = np.asarray(access[k], dtype=np.float64)
+        if acc.ndim == 0:
+            acc = np.full(ln_emb[k], float(acc) / max(1, ln_emb[k]))
+        row_cost.append(acc)
+    sum_rows = float(np.sum(ln_emb))
+    sum_access = float(sum(np.sum(acc) for acc in row_cost))
+    for k in range(ntables):
+        row_cost[k] = 1.0 / sum_rows + (
+            row_cost[k] / sum_access if sum_access > 0 else 0.0
+        )
+
+    # table or row-range pieces: (cost, table, begin, end)
+    target = sum(np.sum(c) for c in row_cost) / nranks
+    pieces = []
+    for k in range(ntables):
+        c = np.cumsum(row_cost[k])
+        cost = float(c[-1]) if c.size > 0 else 0.0
+        nparts = int(np.ceil(cost / target)) if mode == "row" and cost > target else 1
+        nparts = min(nparts, int(ln_emb[k]))
+        bounds = [0]
+        for i in range(1, nparts):
+            b = int(np.searchsorted(c, cost * i / nparts)) + 1
+            if bounds[-1] < b < ln_emb[k]:
+                bounds.append(b)
+        bounds.append(int(ln_emb[k]))
+        for (b0, b1) in zip(bounds[:-1], bounds[1:]):
+            pieces.append((float(c[b1 - 1] - (c[b0 - 1] if b0 > 0 else 0.0)), k, b0, b1))
+
+    # longest processing time first
+    load = [(0.0, r) for r in range(nranks)]
+    heapq.heapify(load)
+    shards = []
+    rank_cost = [0.0] * nranks
+    for (cost, k, b0, b1) in sorted(pieces, key=lambda x: -x[0]):
+        l, r = heapq.heappop(load)
+        shards.append((k, b0, b1, r))
+        rank_cost[r] = l + cost
+        heapq.heappush(load, (l + cost, r))
+    shards.sort()
+    return shards, rank_cost
+
+
+class ShardedEmbeddings:
+    """Embedding tables sharded across the ranks (model parallelism).
+
+    Every rank calls forward with the lookups of its own batch. The indices
+    falling into each shard travel to the shard's owner with all-to-all, the
+    owner pools them and the (partial) pooled vectors travel back, where the
+    partial sums of row-range shards are added up. backward returns the
+    gradients of the pooled vectors to the owners. local_emb holds the shards
+    of this rank (to be registered with the model and its optimizer).
+    """
+
+    def __init__(self, shards, ln_emb, m):
+        self.shards = shards
+        self.ntables = len(ln_emb)
+        self.m = m
+        self.dims = [m] * self.ntables
+        self.local = [s for s in shards if s[3] == my_rank]
+        # shards owned by each rank, in the order they are sent
+        self.per_rank = [[s for s in shards if s[3] == r] for r in range(max(1, my_size))]
+        self.local_emb = nn.ModuleList()
+        for (k, b0, b1, _) in self.local:
+            n = ln_emb[k]
+            EE = nn.EmbeddingBag(b1 - b0, m, mode="sum", sparse=True)
+            # same initialization as the whole table
+            W = np.random.uniform(
+                low=-np.sqrt(1 / n), high=np.sqrt(1 / n), size=(b1 - b0, m)
+            ).astype(np.float32)
+            EE.weight.data = torch.tensor(W, requires_grad=True)
+            self.local_emb.append(EE)
+        self._remote = None
+        self._local = None
+
+    def forward(self, lS_o, lS_i, requires_grad=True):
+        batch = int(lS_o[0].shape[0])
+
+        # bag of every lookup, per table
+        bags = []
+        for k in range(self.ntables):
+            S_o = lS_o[k].long()
+            lens = torch.diff(S_o, append=torch.tensor([lS_i[k].shape[0]]))
+            bags.append(torch.repeat_interleave(torch.arange(batch), lens))
+
+        # [batch, n_0, ..., bags_0, indices_0, ...] to every owner
+        send = []
+        for r in range(len(self.per_rank)):
+            lens = []
+            parts = []
+            for (k, b0, b1, _) in self.per_rank[r]:
+                S_i = lS_i[k].long()
+                mask = (S_i >= b0) & (S_i < b1)
+                lens.append(int(mask.sum()))
+                parts += [bags[k][mask], S_i[mask] - b0]
+            send.append(torch.cat([torch.tensor([batch] + lens, dtype=torch.long)] + parts))
+        recv = alltoall_varlen(send)
+
+        # owner: pooled vectors of the local shards for every rank
+        self._remote = []
+        outs = []
+        with torch.set_grad_enabled(requires_grad):
+            for buf in recv:
+                q_batch = int(buf[0])
+                lens = buf[1:1 + len(self.local)].tolist()
+                pos = 1 + len(self.local)
+                Vs = []
+                for (E, n) in zip(self.local_emb, lens):
+                    q_bags = buf[pos:pos + n]
+                    q_idx = buf[pos + n:pos + 2 * n]
+                    pos += 2 * n
+                    offsets = torch.searchsorted(q_bags, torch.arange(q_batch))
+                    Vs.append(E(q_idx, offsets))
+                V = torch.cat(Vs, dim=1) if len(Vs) > 0 else torch.zeros((q_batch, 0))
+                self._remote.append(V)
+                outs.append(V.detach().reshape(-1))
+
+        # requester: sum up the partial vectors of every table
+        recv = alltoall_varlen(outs)
+        self._local = torch.cat(recv).requires_grad_(requires_grad)
+        ly = [None] * self.ntables
+        pos = 0
+        for r in range(len(self.per_rank)):
+            n = len(self.per_rank[r])
+            V = self._local[pos:pos + batch * n * self.m].view(batch, n, self.m)
+            pos += batch * n * self.m
+            for (i, (k, _, _, _)) in enumerate(self.per_rank[r]):
+                ly[k] = V[:, i] if ly[k] is None else ly[k] + V[:, i]
+        return ly
+
+    def backward(self):
+        # return the gradients of the pooled vectors to the owners
+        g = self._local.grad
+        if g is None:
+            g = torch.zeros_like(self._local)
+        batch = self._local.numel() // (self.m * len(self.shards))
+        sizes = [batch * len(self.per_rank[r]) * self.m for r in range(len(self.per_rank))]
+        grads = alltoall_varlen(list(torch.split(g, sizes)))
+        # every rank back-propagated the mean over its own batch
+        for (V, gV) in zip(self._remote, grads):
+            if V.numel() > 0:
+                torch.autograd.backward(V, gV.view_as(V) / max(1, my_size))
+        self._remote = None
+        self._local = None
+
+    def read_rows(self, k, rows):
+        # rows of table k, returned on every rank (collective)
+        rows = torch.as_tensor(rows, dtype=torch.long)
+        V = torch.zeros((rows.numel(), self.m))
+        for ((t, b0, b1, _), E) in zip(self.local, self.local_emb):
+            if t == k:
+                mask = (rows >= b0) & (rows < b1)
+                V[mask] = E.weight.data[rows[mask] - b0]
+        if is_enabled():
+            dist.all_reduce(V)
+        return V
+
+    def write_rows(self, k, rows, values):
+        # every rank updates the rows it owns
+        rows = torch.as_tensor(rows, dtype=torch.long)
+        for ((t, b0, b1, _), E) in zip(self.local, self.local_emb):
+            if t == k:
+                mask = (rows >= b0) & (rows < b1)
+                E.weight.data[rows[mask] - b0] = values[mask]
@@ -0,0 +1,299 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# Description: resumable, manifest-driven preprocessing pipelines
+#
+# A pipeline is a set of stages, each one naming its input files, its
+# parameters and its output files (a stage depends on the stages producing its
+# inputs). When a stage completes, <manifest_dir>/<stage>.json records the
+# parameters, the content hashes of the inputs and the checksums of the outputs.
+# On the next run a stage is skipped only if its manifest still matches, i.e.
+# the parameters are the same, the inputs have the same content and the outputs
+# exist with the recorded checksums. Otherwise (no manifest because the last run
+# crashed, a changed parameter, a changed input, a missing or modified output)
+# its outputs are removed and it runs again, which in turn changes the inputs of
+# the stages downstream. Inputs that no longer exist are not checked (e.g. raw
+# data removed after preprocessing) and removed intermediate outputs are only
+# recreated if a stage reading them has to run.
+#
+# Stages whose inputs are ready run in parallel on a pool of processes (the
+# stage functions must be picklable, i.e. defined at module level).
+#
+# Hashing large files is expensive, so the hash of every file is cached in
+# <manifest_dir>/hash_cache.json together with its size and modification time
+# and only recomputed when these change.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import subprocess
+from os import path
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+
+def _hash_file(filename, block_bytes=16 * 1024 * 1024):
+    h = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as f:
+        block = f.read(block_bytes)
+        while block:
+            h.update(block)
+            block = f.read(block_bytes)
+    return h.hexdigest()
+
+
+class HashCache:
+    """Content hashes of files (and directories), cached by size and mtime."""
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.cache = {}
+        if path.exists(cache_file):
+            try:
+                with open(cache_file) as f:
+                    self.cache = json.load(f)
+            except ValueError:
+                self.cache = {}
+
+    def _file(self, filename):
+        st = os.stat(filename)
+        key = path.abspath(filename)
+        entry = self.cache.get(key)
+        if entry is not None and entry["size"] == st.st_size \
+                and entry["mtime_ns"] == st.st_mtime_ns:
+            return entry["hash"]
+        digest = _hash_file(filename)
+        self.cache[key] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "hash": digest}
+        return digest
+
+    def get(self, name):
+        # hash of a file, of a directory (over its files) or None if missing
+        if path.isdir(name):
+            h = hashlib.blake2b(digest_size=16)
+            for root, dirs, files in sorted(os.walk(name)):
+                dirs.sort()
+                for f in sorted(files):
+                    full = path.join(root, f)
+                    h.update(path.relpath(full, name).encode())
+                    h.update(self._file(full).encode())
+            return h.hexdigest()
+        if path.exists(name):
+            return self._file(name)
+        return None
+
+    def save(self):
+        tmp = self.cache_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.cache, f)
+        os.replace(tmp, self.cache_file)
+
+
+def remove_output(name):
+    if path.isdir(name):
+        shutil.rmtree(name)
+    elif path.exists(name):
+        os.remove(name)
+
+
+class Stage:
+    """A step of a pipeline: fn(*args) reads inputs and writes outputs."""
+
+    def __init__(self, name, fn, args=(), inputs=(), outputs=(), params=None):
+        self.name = name
+        self.fn = fn
+        self.args = tuple(args)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        # parameters recorded in the manifest (json serializable)
+        self.params = json.loads(json.dumps(params if params is not None else {}))
+
+
+class Pipeline:
+    """Runs the stale stages of a set of stages in dependency order."""
+
+    def __init__(self, manifest_dir, num_workers=1):
+        self.manifest_dir = manifest_dir
+        self.num_workers = max(1, num_workers)
+        self.stages = []
+        if not path.isdir(manifest_dir):
+            os.makedirs(manifest_dir)
+        self.hashes = HashCache(path.join(manifest_dir, "hash_cache.json"))
+
+    def add(self, stage):
+        if any(s.name == stage.name for s in self.stages):
+            sys.exit("ERROR: duplicate stage " + stage.name)
+        self.stages.append(stage)
+        return stage
+
+    def _manifest_file(self, stage):
+        return path.join(self.manifest_dir, stage.name + ".json")
+
+    def _deps(self):
+        producer = {}
+        for s in self.stages:
+            for o in s.outputs:
+                producer[path.abspath(o)] = s.name
+        deps = {}
+        for s in self.stages:
+            deps[s.name] = set(
+                producer[path.abspath(i)] for i in s.inputs
+                if path.abspath(i) in producer and producer[path.abspath(i)] != s.name
+            )
+        return deps
+
+    def is_stale(self, stage, needed=True):
+        # returns the reason why the stage must run, "" if it is up to date
+        # (missing inputs, e.g. raw data removed after preprocessing, are not
+        # checked, missing outputs only count if the stage is needed)
+        manifest_file = self._manifest_file(stage)
+        if not path.exists(manifest_file):
+            return "no manifest"
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if manifest.get("params") != stage.params:
+            return "parameters changed"
+        if sorted(manifest.get("inputs", {})) != sorted(stage.inputs):
+            return "inputs changed"
+        for i in stage.inputs:
+            digest = self.hashes.get(i)
+            if digest is not None and digest != manifest["inputs"][i]:
+                return "input " + i + " changed"
+        if sorted(manifest.get("outputs", {})) != sorted(stage.outputs):
+            return "outputs changed"
+        for o in stage.outputs:
+            digest = self.hashes.get(o)
+            if digest is None:
+                if needed:
+                    return "output " + o + " missing"
+            elif digest != manifest["outputs"][o]:
+                return "output " + o + " modified"
+        return ""
+
+    def _needed(self, deps):
+        # Stages that may have to run: the stale ones, the ones missing a final
+        # output (not read by other stages) and everything downstream of them,
+        # plus the producers of their missing inputs. Intermediate files that
+        # were removed (to save space) are only recreated if they are needed.
+        consumers = dict((s.name, set()) for s in self.stages)
+        for s in self.stages:
+            for d in deps[s.name]:
+                consumers[d].add(s.name)
+        producer = {}
+        for s in self.stages:
+            for o in s.outputs:
+                producer[path.abspath(o)] = s.name
+        consumed = set(path.abspath(i) for s in self.stages for i in s.inputs)
+        needed = set()
+        for s in self.stages:
+            if self.is_stale(s, needed=False) != "" or any(
+                    path.abspath(o) not in consumed and self.hashes.get(o) is None
+                    for o in s.outputs):
+                needed.add(s.name)
+        changed = True
+        while changed:
+            changed = False
+            for s in self.stages:
+                if s.name not in needed:
+                    continue
+                more = set(consumers[s.name])
+                more.update(
+                    producer[path.abspath(i)] for i in s.inputs
+                    if path.abspath(i) in producer and self.hashes.get(i) is None
+                )
+                if not more <= needed:
+                    needed.update(more)
+                    changed = True
+        return needed
+
+    def _prepare(self, stage):
+        for i in stage.inputs:
+            if self.hashes.get(i) is None:
+                sys.exit("ERROR: stage " + stage.name + " input " + i + " does not exist")
+        # never reuse the outputs of an incomplete or outdated run
+        for o in stage.outputs:
+            remove_output(o)
+
+    def _complete(self, stage, elapsed):
+        manifest = {
+            "stage": stage.name,
+            "params": stage.params,
+            "inputs": dict((i, self.hashes.get(i)) for i in stage.inputs),
+            "outputs": {},
+            "time": elapsed,
+        }
+        for o in stage.outputs:
+            digest = self.hashes.get(o)
+            if digest is None:
+                sys.exit("ERROR: stage " + stage.name + " did not create " + o)
+            manifest["outputs"][o] = digest
+        manifest_file = self._manifest_file(stage)
+        with open(manifest_file + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(manifest_file + ".tmp", manifest_file)
+        self.hashes.save()
+        print("Stage %s completed (%.1f s)" % (stage.name, elapsed))
+
+    def run(self, force=False):
+        # runs the stale stages (all of them if force), returns their names
+        deps = self._deps()
+        needed = self._needed(deps)
+        done = set()
+        ran = []
+        running = {}
+        executor = ProcessPoolExecutor(self.num_workers) if self.num_workers > 1 else None
+        try:
+            while len(done) < len(self.stages):
+                ready = [
+                    s for s in self.stages
+                    if s.name not in done and s.name not in running.values()
+                    and deps[s.name] <= done
+                ]
+                if len(ready) == 0 and len(running) == 0:
+                    sys.exit("ERROR: cyclic dependencies between stages")
+                for s in ready:
+                    reason = "forced" if force else self.is_stale(s, s.name in needed)
+                    if reason == "":
+                        print("Stage %s is up to date" % s.name)
+                        done.add(s.name)
+                        continue
+                    print("Stage %s: running (%s)" % (s.name, reason))
+                    self._prepare(s)
+                    if executor is None:
+                        t0 = time.time()
+                        s.fn(*s.args)
+                        self._complete(s, time.time() - t0)
+                        done.add(s.name)
+                        ran.append(s.name)
+                    else:
+                        running[executor.submit(_timed, s.fn, s.args)] = s.name
+                if len(running) == 0:
+                    continue
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for f in finished:
+                    name = running.pop(f)
+                    stage = [s for s in self.stages if s.name == name][0]
+                    self._complete(stage, f.result())
+                    done.add(name)
+                    ran.append(name)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+        self.hashes.save()
+        return ran
+
+
+def _timed(fn, args):
+    t0 = time.time()
+    fn(*args)
+    return time.time() - t0
+
+
+def run_command(argv):
+    # stage running an external command (e.g. a profiler script)
+    subprocess.check_call(list(argv))
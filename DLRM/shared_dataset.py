@@ -0,0 +1,137 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# Description: datasets whose arrays are shared by the DataLoader workers
+#
+# A DataLoader with num_workers > 0 gives every worker a copy of its dataset:
+# pickled with the spawn start method, and after a fork the pages of Python
+# objects (the lists of (dense, sparse, target) tuples of the FAE hot and
+# normal data) are copied as soon as their reference counts are touched.
+# SharedArrays writes named numpy arrays once into .npy files of a directory
+# in shared memory (/dev/shm when it exists) and pickles as the name of that
+# directory, the workers memory-map the same files again, so there is a single
+# copy of the data in RAM whatever the number of workers. The directory is
+# removed by the process that created it, at exit or when it is collected.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+import tempfile
+import weakref
+from os import path
+
+import numpy as np
+from torch.utils.data import Dataset
+
+
+def default_dir():
+    # tmpfs, the files of the arrays are never written to disk
+    return "/dev/shm" if path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+def _remove_dir(directory, pid):
+    # only the creating process removes the arrays (forked workers inherit the
+    # finalizers of their parent)
+    if os.getpid() == pid:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class SharedArrays:
+    """Named numpy arrays in shared memory, pickled as a handle."""
+
+    def __init__(self, arrays, directory=None):
+        self.dir = tempfile.mkdtemp(prefix="shared_arrays_", dir=directory or default_dir())
+        weakref.finalize(self, _remove_dir, self.dir, os.getpid())
+        self.names = list(arrays)
+        for name in self.names:
+            a = np.asarray(arrays[name])
+            out = np.lib.format.open_memmap(self._file(name), mode="w+",
+                                            dtype=a.dtype, shape=a.shape)
+            if a.size > 0:
+                out[...] = a
+                out.flush()
+            del out
+        self._open()
+
+    def _file(self, name):
+        return path.join(self.dir, name + ".npy")
+
+    def _open(self):
+        # copy-on-write, like the other memory-mapped data of the loaders
+        self.arrays = {}
+        for name in self.names:
+            try:
+                self.arrays[name] = np.load(self._file(name), mmap_mode="c")
+            except ValueError:
+                # empty arrays cannot be mapped
+                self.arrays[name] = np.load(self._file(name))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["arrays"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def nbytes(self):
+        return sum(a.nbytes for a in self.arrays.values())
+
+
+class SharedRowDataset(Dataset):
+    """Rows of aligned columns in shared memory, item i is (c[i] for c in columns)."""
+
+    def __init__(self, columns, directory=None):
+        self.num_columns = len(columns)
+        self.shared = SharedArrays(
+            {"column_%d" % k: c for k, c in enumerate(columns)}, directory
+        )
+        self.columns = [self.shared["column_%d" % k] for k in range(self.num_columns)]
+        self.length = len(self.columns[0]) if self.num_columns > 0 else 0
+
+    @classmethod
+    def from_rows(cls, rows, directory=None):
+        # rows: list of tuples of arrays (or scalars) of the same shapes, e.g.
+        # the (X_int, X_cat, y) tuples saved by the input profilers
+        num_columns = len(rows[0]) if len(rows) > 0 else 0
+        columns = [np.stack([np.asarray(r[k]) for r in rows]) for k in range(num_columns)]
+        return cls(columns, directory)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["columns"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.columns = [self.shared["column_%d" % k] for k in range(self.num_columns)]
+
+    def __getitem__(self, index):
+
+        if isinstance(index, slice):
+            return [
+                self[idx] for idx in range(
+                    index.start or 0, index.stop or len(self), index.step or 1
+                )
+            ]
+
+        return tuple(c[index] for c in self.columns)
+
+    def __len__(self):
+        return self.length
+
+
+def share_rows(rows, num_workers, directory=None):
+    # the list of tuples itself when there are no workers to share it with
+    if num_workers > 0 and not isinstance(rows, SharedRowDataset):
+        rows = SharedRowDataset.from_rows(rows, directory)
+        print("Shared %d rows (%d bytes) with the loader workers in %s"
+              % (len(rows), rows.shared.nbytes(), rows.shared.dir))
+    return rows
@@ -0,0 +1,210 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# Description: synthetic Criteo-shaped dataset with power-law sparse features
+#
+# Writes the pre-processed files of a Kaggle or Terabyte dataset (as produced
+# by data_utils.getCriteoAdData) filled with synthetic samples, so that the
+# whole FAE flow (dlrm_input_profiler.py, then dlrm_fae.py) can be run and
+# benchmarked at any scale without the Criteo downloads:
+#   <d_file>_day_<i>_processed.npz     processed days (test split: last day)
+#   <d_file>_day_<i>_reordered.npz     reordered days (--memory-map)
+#   <processed-data-file>              all the days (without --memory-map)
+#   <d_file>_day_count.npz, <d_file>_fea_count.npz
+# with the naming of CriteoDataset (e.g. train_day_0_processed.npz for
+# --raw-data-file=<dir>/train.txt, the raw file itself is not needed).
+#
+# The row of table t is drawn with probability proportional to
+# (rank + 1)^-alpha[t] (alpha 0 is uniform), the ranks are scattered over the
+# ids of the table by an affine permutation. The exponents are given, or
+# fitted on the per-row access counts of an earlier profiler run
+# (emb_access_count.npz of dlrm_input_profiler.py). The cardinalities of the
+# tables are the ones of --arch-embedding-size.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import sys
+import math
+from os import path
+
+import numpy as np
+
+import data_utils
+
+# dense features of a Criteo sample
+den_fea = 13
+
+
+def fit_power_law(counts, default=0.0):
+    # exponent of the rank-frequency power law of the access counts of the
+    # rows of a table (least squares fit of log(count) on log(rank) over the
+    # accessed rows), default if fewer than two rows were accessed
+    counts = np.sort(np.asarray(counts, dtype=np.float64))[::-1]
+    counts = counts[counts > 0]
+    if len(counts) < 2:
+        return default
+    ranks = np.arange(1, len(counts) + 1, dtype=np.float64)
+    slope = np.polyfit(np.log(ranks), np.log(counts), 1)[0]
+    return float(max(0.0, -slope))
+
+
+def fit_power_laws(counts_file, num_tables, default=0.0):
+    # exponents of the tables fitted on emb_access_count.npz (arr_<t>)
+    with np.load(counts_file) as data:
+        return [
+            fit_power_law(data["arr_%d" % t], default) if "arr_%d" % t in data.files
+            else default
+            for t in range(num_tables)
+        ]
+
+
+def draw_power_law(rng, n, size, alpha):
+    # n ranks in [0, size) with P(k) ~ (k + 1)^-alpha, by inversion of the
+    # continuous (bounded Pareto) distribution
+    u = rng.random_sample(n)
+    if abs(alpha - 1.0) < 1e-6:
+        x = np.exp(u * math.log(size + 1.0))
+    else:
+        e = 1.0 - alpha
+        x = (u * ((size + 1.0) ** e - 1.0) + 1.0) ** (1.0 / e)
+    return np.minimum(np.floor(x).astype(np.int64) - 1, size - 1)
+
+
+def rank_permutation(rng, size):
+    # (a, b) of the affine permutation rank -> (a * rank + b) % size
+    while True:
+        a = int(rng.randint(1, max(size, 2)))
+        if math.gcd(a, size) == 1:
+            return a, int(rng.randint(0, size))
+
+
+def generate_day(rng, n, ln_emb, alphas, permutations, ctr):
+    # X_int (int32 counts, log-normal), X_cat (int32 ids, power-law per table)
+    # and y (int32 clicks, logistic in the dense features, mean about ctr)
+    X_int = np.floor(rng.lognormal(1.0, 1.5, size=(n, den_fea))).astype(np.int32)
+    X_cat = np.empty((n, len(ln_emb)), dtype=np.int32)
+    for t, size in enumerate(ln_emb):
+        a, b = permutations[t]
+        ranks = draw_power_law(rng, n, size, alphas[t])
+        X_cat[:, t] = (ranks * a + b) % size
+    w = np.linspace(-0.5, 0.5, den_fea)
+    z = np.log1p(X_int) @ w
+    z = (z - z.mean()) / max(z.std(), 1e-6) + math.log(ctr / (1.0 - ctr))
+    y = (rng.random_sample(n) < 1.0 / (1.0 + np.exp(-z))).astype(np.int32)
+    return X_int, X_cat, y
+
+
+def generate_criteo_data(
+        dataset,
+        raw_path,
+        pro_data,
+        ln_emb,
+        num_samples,
+        alphas,
+        memory_map=False,
+        intermediate_format="npz",
+        ctr=0.25,
+        seed=123
+):
+    # writes the pre-processed files of num_samples synthetic samples spread
+    # over the days of the dataset (see the top of the file)
+    if dataset == "kaggle":
+        days = 7
+    elif dataset == "terabyte":
+        days = 3  # as in CriteoDataset
+    else:
+        raise(ValueError("Data set option is not supported"))
+    lstr = raw_path.split("/")
+    d_path = "/".join(lstr[0:-1]) + "/"
+    d_file = lstr[-1].split(".")[0] if dataset == "kaggle" else lstr[-1]
+    npzfile = d_path + ((d_file + "_day") if dataset == "kaggle" else d_file)
+    if path.isdir(data_utils.criteoManifestDir(d_path, d_file)):
+        # the loaders would run the pipeline on the (missing) raw data
+        sys.exit("ERROR: remove the manifests of the pipeline in "
+                 + data_utils.criteoManifestDir(d_path, d_file))
+
+    rng = np.random.RandomState(seed)
+    ln_emb = [int(s) for s in ln_emb]
+    permutations = [rank_permutation(rng, size) for size in ln_emb]
+    total_per_file = [len(d) for d in np.array_split(np.arange(num_samples), days)]
+    parts = []
+    for i in range(days):
+        X_int, X_cat, y = generate_day(
+            rng, total_per_file[i], ln_emb, alphas, permutations, ctr
+        )
+        for suffix in ["_processed.npz"] + (["_reordered.npz"] if memory_map else []):
+            filename = npzfile + "_{0}".format(i) + suffix
+            data_utils.removeArrays(filename)
+            data_utils.saveArrays(
+                filename, intermediate_format, X_int=X_int, X_cat=X_cat, y=y
+            )
+        print("Generated day %d: %d samples, ctr %.3f" % (i, len(y), np.mean(y)))
+        if not memory_map:
+            parts.append((X_int, X_cat, y))
+
+    counts = np.array(ln_emb, dtype=np.int32)
+    np.savez_compressed(d_path + d_file + "_day_count.npz",
+                        total_per_file=np.array(total_per_file))
+    np.savez_compressed(d_path + d_file + "_fea_count.npz", counts=counts)
+    if not memory_map:
+        np.savez_compressed(
+            pro_data,
+            X_cat=np.concatenate([p[1] for p in parts]),
+            X_int=np.concatenate([p[0] for p in parts]),
+            y=np.concatenate([p[2] for p in parts]),
+            counts=counts,
+        )
+        print("Saved %s" % pro_data)
+
+
+if __name__ == "__main__":
+    ### import packages ###
+    import argparse
+
+    ### parse arguments ###
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic Criteo dataset"
+    )
+    parser.add_argument("--data-set", type=str, default="kaggle")  # or terabyte
+    parser.add_argument("--raw-data-file", type=str, default="")
+    parser.add_argument("--processed-data-file", type=str, default="")
+    # cardinalities of the tables, e.g. 1460-583-10131227-...
+    parser.add_argument("--arch-embedding-size", type=str, default="")
+    parser.add_argument("--num-samples", type=int, default=1000000)
+    # power-law exponent of all the tables, or of every table (a0-a1-...)
+    parser.add_argument("--power-law-alpha", type=str, default="1.05")
+    # emb_access_count.npz of a profiler run, the exponents are fitted on it
+    parser.add_argument("--fit-access-counts", type=str, default="")
+    parser.add_argument("--ctr", type=float, default=0.25)
+    parser.add_argument("--memory-map", action="store_true", default=False)
+    parser.add_argument("--data-intermediate-format", type=str, choices=["npz", "npy"], default="npz")
+    parser.add_argument("--numpy-rand-seed", type=int, default=123)
+    args = parser.parse_args()
+
+    ln_emb = np.fromstring(args.arch_embedding_size, dtype=int, sep="-")
+    if len(ln_emb) == 0:
+        sys.exit("ERROR: --arch-embedding-size is required")
+    if args.fit_access_counts:
+        alphas = fit_power_laws(args.fit_access_counts, len(ln_emb))
+    else:
+        alphas = [float(a) for a in args.power_law_alpha.split("-")]
+        if len(alphas) == 1:
+            alphas = alphas * len(ln_emb)
+        elif len(alphas) != len(ln_emb):
+            sys.exit("ERROR: --power-law-alpha needs one exponent or one per table")
+    print("Power-law exponents: " + ", ".join("%.3f" % a for a in alphas))
+
+    generate_criteo_data(
+        args.data_set,
+        args.raw_data_file,
+        args.processed_data_file,
+        ln_emb,
+        args.num_samples,
+        alphas,
+        args.memory_map,
+        args.data_intermediate_format,
+        args.ctr,
+        args.numpy_rand_seed
+    )
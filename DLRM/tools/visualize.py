@@ -869,11 +869,12 @@ def analyze_model_data(output_dir,
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    # the arrays of CriteoDataset hold all the days, the split is its indices
     if skip_embedding is False:
 
         cat_counts = None
         
-        cat_counts = analyse_categorical_counts(X_cat=train_data.X_cat, emb_l=dlrm.emb_l, output_dir=output_dir)
+        cat_counts = analyse_categorical_counts(X_cat=train_data.X_cat[train_data.indices], emb_l=dlrm.emb_l, output_dir=output_dir)
 
         visualize_embeddings_umap(emb_l       = dlrm.emb_l,
                                   output_dir  = output_dir,
@@ -892,7 +893,7 @@ def analyze_model_data(output_dir,
 
     # analyse categorical variables
     if skip_categorical_analysis is False and args.data_randomize == "none":
-        analyse_categorical_data(X_cat=train_data.X_cat, n_days=10, output_dir=output_dir)
+        analyse_categorical_data(X_cat=train_data.X_cat[train_data.indices], n_days=10, output_dir=output_dir)
 
 
 
@@ -0,0 +1,229 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+#
+# Description: cache of collated batches, replayed in later epochs and runs
+#
+# The first pass over a loader writes its batches (tensors nested in lists and
+# tuples, e.g. (X, lS_o, lS_i, T)) into <cache_dir>/<key>/: the raw data of
+# the tensors back to back in shard_<k>.bin files and their layout in
+# index.json, written last (a failed pass leaves no cache). The later passes,
+# in the same run or in later runs, memory-map the shards and return tensors
+# viewing them instead of indexing and collating the data again.
+#
+# A pass stopped by its consumer (e.g. --num-batches) keeps the batches it
+# recorded as a prefix of the pass. The next pass replays the prefix and, if
+# it goes further, records the loader from its start again (the batches of
+# the prefix are collated but not returned) until the pass is complete.
+#
+# The key hashes the manifests of the pre-processed data (see
+# preprocess_manifest.py), the identity of the data files and the loader
+# parameters, so a change of any of them uses a new cache. A cache directory
+# in /dev/shm keeps the batches in RAM.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+from os import path
+
+import numpy as np
+import torch
+
+# offsets of the tensors in a shard are aligned to
+_ALIGN = 64
+
+
+def cache_key(params, manifest_dirs=(), files=()):
+    # hash of the loader parameters, of the stage manifests in manifest_dirs
+    # (their parameters and input/output hashes) and of the size and mtime of
+    # files (pre-processed data without manifest)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    for d in manifest_dirs:
+        if not path.isdir(d):
+            continue
+        for f in sorted(os.listdir(d)):
+            if f.endswith(".json") and f != "hash_cache.json":
+                with open(path.join(d, f)) as m:
+                    manifest = json.load(m)
+                # the run time differs between identical runs
+                manifest.pop("time", None)
+                h.update(f.encode())
+                h.update(json.dumps(manifest, sort_keys=True).encode())
+    for f in files:
+        if path.exists(f):
+            st = os.stat(f)
+            h.update(("%s %d %d" % (path.abspath(f), st.st_size, st.st_mtime_ns)).encode())
+    return h.hexdigest()
+
+
+def _flatten(batch, leaves):
+    # structure of a batch, its tensors are appended to leaves
+    if isinstance(batch, torch.Tensor):
+        leaves.append(batch)
+        return len(leaves) - 1
+    if isinstance(batch, (list, tuple)):
+        return ["t" if isinstance(batch, tuple) else "l",
+                [_flatten(b, leaves) for b in batch]]
+    sys.exit("ERROR: cannot cache a batch holding " + str(type(batch)))
+
+
+def _unflatten(structure, leaves):
+    if isinstance(structure, int):
+        return leaves[structure]
+    items = [_unflatten(s, leaves) for s in structure[1]]
+    return tuple(items) if structure[0] == "t" else items
+
+
+class BatchCache:
+    """Iterates over the batches of a loader, recorded once then replayed."""
+
+    def __init__(self, loader, cache_dir, key, shuffle=False, seed=0,
+                 shard_bytes=256 * 1024 * 1024):
+        self.loader = loader
+        self.dataset = getattr(loader, "dataset", None)
+        self.dir = path.join(cache_dir, key)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.shard_bytes = shard_bytes
+        self.epoch = 0
+        self.shards = None
+        self.index = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _read_index(self):
+        # index.json of the cache, None before a pass was recorded
+        filename = path.join(self.dir, "index.json")
+        if not path.exists(filename):
+            return None
+        with open(filename) as f:
+            return json.load(f)
+
+    def complete(self):
+        index = self._read_index()
+        return index is not None and index.get("complete", True)
+
+    def __iter__(self):
+        index = self._read_index()
+        if index is None:
+            return self._record()
+        if index.get("complete", True):
+            return self._replay()
+        return self._resume()
+
+    def _record(self, skip=0):
+        # records a pass over the loader, the first skip batches are not
+        # returned (see _resume)
+        tmp_dir = self.dir + ".tmp"
+        if path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        layouts = []
+        batches = []
+        shard = None
+        num_shards = 0
+        try:
+            for batch in self.loader:
+                leaves = []
+                structure = _flatten(batch, leaves)
+                layout = [structure, [[str(t.dtype).replace("torch.", ""), list(t.shape)]
+                                      for t in leaves]]
+                if layout not in layouts:
+                    layouts.append(layout)
+                if shard is None or shard.tell() >= self.shard_bytes:
+                    if shard is not None:
+                        shard.close()
+                    shard = open(path.join(tmp_dir, "shard_%d.bin" % num_shards), "wb")
+                    num_shards += 1
+                entry = [num_shards - 1, shard.tell(), layouts.index(layout)]
+                for t in leaves:
+                    data = t.detach().cpu().contiguous().numpy()
+                    shard.write(data.tobytes())
+                    shard.write(b"\0" * (-data.nbytes % _ALIGN))
+                # only indexed once its data is written
+                batches.append(entry)
+                if len(batches) > skip:
+                    yield batch
+            shard = self._commit(tmp_dir, shard, layouts, batches, num_shards, True)
+            print("Cached %d batches in %s" % (len(batches), self.dir))
+        except GeneratorExit:
+            # stopped by the consumer, the batches so far are a valid prefix
+            shard = self._commit(tmp_dir, shard, layouts, batches, num_shards, False)
+            print("Cached the first %d batches in %s" % (len(batches), self.dir))
+            raise
+        finally:
+            if shard is not None:
+                shard.close()
+            if path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir)
+
+    def _commit(self, tmp_dir, shard, layouts, batches, num_shards, complete):
+        # replaces the cache by the recorded batches, returns the closed shard
+        if shard is not None:
+            shard.close()
+        with open(path.join(tmp_dir, "index.json"), "w") as f:
+            json.dump({"layouts": layouts, "batches": batches,
+                       "num_shards": num_shards, "complete": complete}, f)
+        if path.isdir(self.dir):
+            shutil.rmtree(self.dir)
+        os.rename(tmp_dir, self.dir)
+        # the mapped shards of the old cache stay valid until released
+        self.index = None
+        self.shards = None
+        return None
+
+    def _open(self):
+        if self.index is None:
+            with open(path.join(self.dir, "index.json")) as f:
+                self.index = json.load(f)
+            # copy-on-write, the tensors are writable but never written back
+            self.shards = [
+                np.memmap(path.join(self.dir, "shard_%d.bin" % k), dtype=np.uint8, mode="c")
+                if path.getsize(path.join(self.dir, "shard_%d.bin" % k)) > 0
+                else np.zeros(0, dtype=np.uint8)
+                for k in range(self.index["num_shards"])
+            ]
+
+    def _batch(self, k):
+        shard, offset, layout = self.index["batches"][k]
+        structure, specs = self.index["layouts"][layout]
+        leaves = []
+        for dtype, shape in specs:
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape, dtype=np.int64))
+            a = self.shards[shard][offset:offset + count * dtype.itemsize]
+            leaves.append(torch.from_numpy(a.view(dtype).reshape(shape)))
+            nbytes = count * dtype.itemsize
+            offset += nbytes + (-nbytes % _ALIGN)
+        return _unflatten(structure, leaves)
+
+    def _replay(self):
+        self._open()
+        order = np.arange(len(self.index["batches"]))
+        if self.shuffle:
+            order = np.random.RandomState([self.seed, self.epoch]).permutation(order)
+        self.epoch += 1
+        for k in order:
+            yield self._batch(k)
+
+    def _resume(self):
+        # the recorded prefix of a pass, then the rest of the pass from the
+        # loader (recorded from its start, the cache holds a single pass)
+        self._open()
+        num_batches = len(self.index["batches"])
+        self.epoch += 1
+        for k in range(num_batches):
+            yield self._batch(k)
+        rest = self._record(skip=num_batches)
+        try:
+            for batch in rest:
+                yield batch
+        finally:
+            rest.close()
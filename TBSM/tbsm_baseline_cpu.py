@@ -812,6 +812,10 @@ if __name__ == "__main__":
 	parser.add_argument("--tsl-mechanism", type=str, default="mlp")  # mul or MLP
 	# data
 	parser.add_argument("--num-batches", type=int, default=0)
+	# cache of the collated batches, replayed by later epochs and runs ("": none)
+	parser.add_argument("--batch-cache-dir", type=str, default="")
+	# loader worker processes, they share the arrays of the data (0: no workers)
+	parser.add_argument("--num-workers", type=int, default=0)
 	# training
 	parser.add_argument("--mini-batch-size", type=int, default=1)
 	parser.add_argument("--nepochs", type=int, default=1)
@@ -10,6 +10,11 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 from os import path
 import sys
 
+# resumable preprocessing, cache of the collated batches
+from preprocess_manifest import Pipeline, Stage
+import batch_cache
+import shared_dataset
+
 # numpy and scikit-learn
 import numpy as np
 
@@ -30,6 +35,7 @@ class TBSMDataset():
             pro_data="",
             spa_fea_sizes="",
             num_pts=1,  # pts to train or test
+            load_data=True,
     ):
         # save arguments
         if mode == "train":
@@ -76,6 +82,9 @@ class TBSMDataset():
                     file,
                 )
 
+        if not load_data:
+            return
+
         # load data
         with np.load(file) as data:
             self.X_cat = data["X_cat"]
@@ -348,6 +357,30 @@ class TBSMDataset():
             )
         return
 
+    def share_memory(self):
+        # moves the arrays to shared memory (see shared_dataset.py), the loader
+        # workers map them instead of getting a copy
+        self.shared = shared_dataset.SharedArrays(
+            {"X_cat": self.X_cat, "X_int": self.X_int, "y": self.y}
+        )
+        self.X_cat = self.shared["X_cat"]
+        self.X_int = self.shared["X_int"]
+        self.y = self.shared["y"]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if getattr(self, "shared", None) is not None:
+            for name in ["X_cat", "X_int", "y"]:
+                state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if getattr(self, "shared", None) is not None:
+            self.X_cat = self.shared["X_cat"]
+            self.X_int = self.shared["X_int"]
+            self.y = self.shared["y"]
+
     def __getitem__(self, index):
 
         if isinstance(index, slice):
@@ -400,10 +433,80 @@ def collate_wrapper_tbsm(list_of_tuples):
 
     return X, lS_o, lS_i, T
 
+# builds a pre-processed file (stage of preprocess_tbsm_data)
+def build_tbsm_data(
+        datatype, mode, ts_length, points_per_user, numpy_rand_seed, raw_path,
+        pro_data, spa_fea_sizes, num_pts
+):
+    TBSMDataset(
+        datatype,
+        mode,
+        ts_length,
+        points_per_user,
+        numpy_rand_seed,
+        raw_path,
+        pro_data,
+        spa_fea_sizes,
+        num_pts,
+        load_data=False,
+    )
+
+# returns raw file, pre-processed file and number of points of a mode
+def tbsm_data_files(args, mode):
+    if mode == "train":
+        return args.raw_train_file, args.pro_train_file, args.num_train_pts
+    elif mode == "val":
+        return args.raw_train_file, args.pro_val_file, args.num_val_pts
+    else:
+        return args.raw_test_file, args.pro_test_file, 1
+
+# pre-processes the data of the given modes as (parallel) stages of a pipeline,
+# a manifest per pre-processed file records the raw file hash and the parameters
+# so that the file is only rebuilt when they change (see preprocess_manifest.py).
+# Pre-processed files from before the manifests are used as they are.
+def preprocess_tbsm_data(args, modes):
+    stages = []
+    manifest_dir = ""
+    for mode in modes:
+        raw, proc, numpts = tbsm_data_files(args, mode)
+        manifest_dir = path.join(path.dirname(path.abspath(proc)), "tbsm_manifest")
+        name = "build_" + path.basename(proc)
+        if path.exists(proc) and not path.exists(path.join(manifest_dir, name + ".json")):
+            continue
+        inputs = [raw] if args.datatype == "taobao" else []
+        if mode == "test" and args.datatype == "taobao" and not path.exists(raw) \
+                and not path.exists(proc):
+            continue
+        stages.append(Stage(
+            name,
+            build_tbsm_data,
+            args=(args.datatype, mode, args.ts_length, args.points_per_user,
+                  args.numpy_rand_seed, raw, proc, args.arch_embedding_size, numpts),
+            inputs=inputs,
+            outputs=[proc],
+            params={"datatype": args.datatype, "mode": mode,
+                    "ts_length": args.ts_length,
+                    "points_per_user": args.points_per_user,
+                    "numpy_rand_seed": args.numpy_rand_seed,
+                    "spa_fea_sizes": args.arch_embedding_size, "num_pts": numpts},
+        ))
+    if len(stages) == 0:
+        return
+    pipeline = Pipeline(manifest_dir, len(stages))
+    for stage in stages:
+        pipeline.add(stage)
+    pipeline.run()
+
 # creates a loader (train, val or test data) to be used in the main training loop
 # or during inference step
 def make_tbsm_data_and_loader(args, mode):
 
+    # pre-process (train and val are built together, test if available)
+    if mode == "test":
+        preprocess_tbsm_data(args, ["test"])
+    else:
+        preprocess_tbsm_data(args, ["train", "val", "test"])
+
     if mode == "train":
         raw = args.raw_train_file
         proc = args.pro_train_file
@@ -435,22 +538,50 @@ def make_tbsm_data_and_loader(args, mode):
         numpts,
     )
 
+    num_workers = getattr(args, "num_workers", 0)
+    if num_workers > 0:
+        data.share_memory()
+
     loader = torch.utils.data.DataLoader(
         data,
         batch_size=batchsize,
-        num_workers=0,
+        num_workers=num_workers,
         collate_fn=collate_wrapper_tbsm,
         shuffle=doshuffle,
     )
 
+    # the collated batches are recorded once and replayed by the later epochs
+    # and runs, shuffled if the loader is (see batch_cache.py)
+    if getattr(args, "batch_cache_dir", ""):
+        manifest_dir = path.join(path.dirname(path.abspath(proc)), "tbsm_manifest")
+        params = {
+            "datatype": args.datatype, "mode": mode, "ts_length": args.ts_length,
+            "points_per_user": args.points_per_user,
+            "numpy_rand_seed": args.numpy_rand_seed, "raw": raw, "proc": proc,
+            "arch_embedding_size": args.arch_embedding_size, "numpts": numpts,
+            "batch_size": batchsize,
+        }
+        loader = batch_cache.BatchCache(
+            loader,
+            args.batch_cache_dir,
+            batch_cache.cache_key(params, [manifest_dir], [proc]),
+            shuffle=doshuffle,
+            seed=args.numpy_rand_seed,
+        )
+
     return loader, len(data)
 
 # Loader for loading hot and normal pre-processed data
 def load_preprocessed_data_and_loaders(args, train_hot, train_normal):
+    # the workers map the rows from shared memory instead of copying the lists
+    num_workers = getattr(args, "num_workers", 0)
+    train_hot = shared_dataset.share_rows(train_hot, num_workers)
+    train_normal = shared_dataset.share_rows(train_normal, num_workers)
+
     train_hot_ld = torch.utils.data.DataLoader(
         train_hot,
         batch_size=args.mini_batch_size,
-        num_workers=0,
+        num_workers=num_workers,
         collate_fn=collate_wrapper_tbsm,
         pin_memory=False,
         drop_last=False,
@@ -459,7 +590,7 @@ def load_preprocessed_data_and_loaders(args, train_hot, train_normal):
     train_normal_ld = torch.utils.data.DataLoader(
         train_normal,
         batch_size=args.mini_batch_size,
-        num_workers=0,
+        num_workers=num_workers,
         collate_fn=collate_wrapper_tbsm,
         pin_memory=False,
         drop_last=False,
@@ -25,6 +25,7 @@ from torch.utils.tensorboard import SummaryWriter
 
 # tbsm data
 import tbsm_data_pytorch as tp
+import shared_dataset
 
 # set python, numpy and torch random seeds
 def set_seed(seed, use_gpu):
@@ -932,11 +933,14 @@ def train_tbsm(args, use_gpu):
 	train_normal = np.load(args.train_normal_file, allow_pickle = True)
 	train_normal = train_normal['arr_0']
 	train_normal = train_normal.tolist()
+	# one copy of the rows in shared memory for all the loader workers
+	train_normal = shared_dataset.share_rows(train_normal, args.num_workers)
 	print("Length Train normal : ", len(train_normal))
 
 	train_hot = np.load(args.train_hot_file, allow_pickle = True)
 	train_hot = train_hot['arr_0']
 	train_hot = train_hot.tolist()
+	train_hot = shared_dataset.share_rows(train_hot, args.num_workers)
 	print("Length Train hot : ", len(train_hot))
 
 	hot_emb_dict = np.load(args.hot_emb_dict_file, allow_pickle = True)
@@ -1101,6 +1105,8 @@ if __name__ == "__main__":
 	parser.add_argument("--train-hot-file", type=str, default="") # train_hot.npz
 	parser.add_argument("--train-normal-file", type=str, default="") # train_normal.npz
 	parser.add_argument("--hot-emb-dict-file", type=str, default="") # hot_emb_dict.npz
+	# loader worker processes, they share the arrays of the data (0: no workers)
+	parser.add_argument("--num-workers", type=int, default=0)
 	# ===================================================================================
 	# time series length for train/val and test
 	parser.add_argument("--ts-length", type=int, default=20)